@@ -0,0 +1,386 @@
+"""An asyncio client for restq (Python 3.5+).
+
+Realm and Realms mirror the synchronous client in restq.client, their
+methods are coroutines:
+
+    realms = Realms('http://localhost:8586/')
+    realm = realms['test']
+    await realm.add('job 1', 0, 'do the dishes')
+    jobs = await realm.pull(count=5, wait=30)
+    await realms.close()
+
+Requests are made over a pool of keep-alive HTTP/1.1 connections, shared by
+the Realm objects of a Realms, that holds at most pool_size connections open.
+A request waiting on a connection waits for one to be returned to the pool,
+so pool_size is also the number of requests that can be in flight at once.
+"""
+import asyncio
+from urllib.parse import quote, urlencode, urlsplit
+
+from restq import codec
+from restq import config
+from restq.aioserver import read_chunked
+from restq.client import WIRE_FORMATS, decode_response
+
+
+def _quote(segment):
+    return quote(str(segment), safe='')
+
+
+async def _read_response(reader):
+    """return status, headers, body and whether the connection is kept"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    version, status = lines[0].split(' ', 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    keep_alive = version == 'HTTP/1.1' and \
+        headers.get('connection', '').lower() != 'close'
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        body = await read_chunked(reader)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return int(status), headers, body, keep_alive
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive connections to host:port, holding at most size
+    connections open at once"""
+
+    def __init__(self, host, port, size=None):
+        if size is None:
+            size = config.client['pool_size']
+        self.host = host
+        self.port = port
+        self.size = size
+        self._idle = []
+        self._slots = None
+
+    async def request(self, method, target, body=b'', headers=None,
+                      timeout=None):
+        """make a request, returns (status, headers, body)"""
+        if self._slots is None:
+            # created here to bind to the running loop
+            self._slots = asyncio.Semaphore(self.size)
+        async with self._slots:
+            request = self._request(method, target, body, headers or {})
+            return await asyncio.wait_for(request, timeout)
+
+    async def _request(self, method, target, body, headers):
+        lines = ['%s %s HTTP/1.1' % (method, target),
+                 'Host: %s:%d' % (self.host, self.port),
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % header for header in headers.items())
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        while True:
+            reused = bool(self._idle)
+            if reused:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host,
+                                                               self.port)
+            try:
+                writer.write(data)
+                status, headers, body, keep_alive = \
+                    await _read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError) as exc:
+                writer.close()
+                partial = getattr(exc, 'partial', b'')
+                if reused and not partial:
+                    # the server closed the idle connection, try another
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return status, headers, body
+
+    def close(self):
+        """close the idle connections"""
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+
+class BaseClient(object):
+
+    def __init__(self, uri=None, pool=None, wire_format=None, timeout=None):
+        """pool defaults to a new ConnectionPool to the server at uri
+        wire_format is how bodies are encoded, 'json' or 'msgpack'
+        timeout is the seconds to wait for a response"""
+        if uri is None:
+            uri = config.client['uri']
+        uri = uri.rstrip('/')
+        parts = urlsplit(uri)
+        if pool is None:
+            pool = ConnectionPool(parts.hostname, parts.port or 80)
+        if wire_format is None:
+            wire_format = config.client['wire_format']
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError("Unknown wire format '%s'" % wire_format)
+        if timeout is None:
+            timeout = config.client['timeout']
+        self.pool = pool
+        self.wire_format = wire_format
+        self.timeout = timeout
+        self._mime = WIRE_FORMATS[wire_format]
+        self._uri = uri
+        self._path = parts.path
+
+    async def request(self, method, path, body=None, query=None,
+                      timeout=None):
+        """make a request for path under the uri, encoding body with the
+        wire format and returning the decoded response"""
+        target = self._path + path
+        if query:
+            target += '?' + urlencode(query)
+        headers = {'Accept': self._mime}
+        data = b''
+        if body is not None:
+            data = codec.dumps(body, self._mime)
+            headers['Content-Type'] = self._mime
+        if timeout is None:
+            timeout = self.timeout
+        status, headers, content = await self.pool.request(
+            method, target, data, headers, timeout)
+        return decode_response(status, headers.get('content-type'), content,
+                               self._uri + path)
+
+    async def close(self):
+        """close the connections held by the pool"""
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class Realm(BaseClient):
+
+    def __init__(self, name, uri=None, pool=None, wire_format=None,
+                 timeout=None):
+        BaseClient.__init__(self, uri, pool, wire_format, timeout)
+        self._name = name
+        self._path += '/' + _quote(name)
+        self._uri += '/' + _quote(name)
+
+    @property
+    def name(self):
+        return self._name
+
+    async def add(self, job_id, queue_id, data=None, tags=None,
+                  not_before=None, delay=None):
+        """store a job into a queue, not to be pulled before the time
+        not_before or delay seconds from now when one is given"""
+        body = {'queue_id': queue_id}
+        for key, value in (('data', data), ('tags', tags),
+                           ('not_before', not_before), ('delay', delay)):
+            if value is not None:
+                body[key] = value
+        await self.request('PUT', '/job/%s' % _quote(job_id), body)
+
+    async def bulk_add(self, jobs):
+        """add jobs in bulk, jobs = [{job_id, queue_id, data, tags}, ...]
+
+        returns {'added': count,
+                 'errors': [{index, job_id, exception, message}, ...]}
+        """
+        return await self.request('POST', '/jobs', {'jobs': jobs})
+
+    async def remove_job(self, job_id):
+        """remove job_id from the system"""
+        await self.request('DELETE', '/job/%s' % _quote(job_id))
+
+    async def bulk_remove(self, job_ids):
+        """remove jobs in bulk, job_ids = [job_id, ...]"""
+        await self.request('DELETE', '/jobs', {'jobs': job_ids})
+
+    async def remove_tagged_jobs(self, tag_id):
+        """remove all jobs related to this tag_id"""
+        await self.request('DELETE', '/tag/%s' % _quote(tag_id))
+
+    async def move_job(self, job_id, from_q, to_q):
+        """move the job from a queue to another queue"""
+        await self.request('GET', '/job/%s/from_q/%s/to_q/%s' %
+                           (_quote(job_id), _quote(from_q), _quote(to_q)))
+
+    async def bulk_move(self, moves):
+        """move jobs in bulk, moves = [(job_id, from_q, to_q), ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        return await self.request('POST', '/jobs/move', {'moves': moves})
+
+    async def renew(self, job_id, extra):
+        """extend the lease on job_id so it runs out extra seconds from now"""
+        await self.request('POST', '/job/%s/renew' % _quote(job_id),
+                           {'extra': extra})
+
+    async def bulk_renew(self, renewals):
+        """renew leases in bulk, renewals = [(job_id, extra), ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        return await self.request('POST', '/jobs/renew',
+                                  {'renewals': renewals})
+
+    async def release(self, job_id):
+        """end the lease on job_id so it can be handed out again now"""
+        await self.request('POST', '/job/%s/release' % _quote(job_id))
+
+    async def bulk_release(self, job_ids):
+        """release leases in bulk, job_ids = [job_id, ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        return await self.request('POST', '/jobs/release', {'jobs': job_ids})
+
+    async def get_job(self, job_id):
+        """return the status of a job"""
+        return await self.request('GET', '/job/%s' % _quote(job_id))
+
+    async def get_tagged_jobs(self, tag_id, fields='data'):
+        """return a dict of all jobs tagged by tag_id, fields is 'data',
+        'status' or 'ids', the parts of each job's status returned"""
+        query = {'fields': fields} if fields != 'data' else None
+        return await self.request('GET', '/tag/%s' % _quote(tag_id),
+                                  query=query)
+
+    async def get_tagged_page(self, tag_id, after=None, count=None,
+                              fields='data'):
+        """return a page of up to count jobs tagged by tag_id that follow
+        job_id after, {'jobs': {job_id: status, ...}, 'next': the after of
+        the next page or None}"""
+        if count is None:
+            count = config.client['tag_page_size']
+        query = {'fields': fields, 'count': count}
+        if after is not None:
+            # JSON encoded, so an int job_id isn't taken for a string
+            query['after'] = codec.json_dumps(after).decode('utf-8')
+        return await self.request('GET', '/tag/%s' % _quote(tag_id),
+                                  query=query)
+
+    async def get_tag_status(self, tag_id):
+        """return the progress of the jobs tagged by tag_id, the count of
+        them queued, available, leased and completed"""
+        return await self.request('GET', '/tag/%s/status' % _quote(tag_id))
+
+    async def pull(self, count=None, max_queue=None, wait=None,
+                   queue_id=None):
+        """pull out a max of count jobs, waiting up to wait seconds for a job
+        to become available if there are none, from queue_id alone if
+        given"""
+        if count is None:
+            count = config.client['count']
+        query = [('count', count)]
+        if max_queue is not None:
+            query.append(('max-queue', max_queue))
+        if queue_id is not None:
+            query.append(('queue', queue_id))
+        if wait:
+            query.append(('wait', wait))
+        return await self.request('GET', '/job', query=query,
+                                  timeout=self.timeout + (wait or 0))
+
+    async def clear_queue(self, queue_id):
+        """remove all jobs from the given queue"""
+        await self.request('GET', '/queues/%s/clear' % _quote(queue_id))
+
+    async def set_default_lease_time(self, lease_time):
+        """The number of seconds a job can be leased for before a job can be
+        handed out to a new requester"""
+        await self.request('POST', '/config',
+                           {'default_lease_time': lease_time})
+
+    async def set_retry_delay(self, retry_delay):
+        """The number of seconds a job whose lease ran out waits before it
+        can be handed out again"""
+        await self.request('POST', '/config', {'retry_delay': retry_delay})
+
+    async def set_queue_max_deliveries(self, queue_id, max_deliveries,
+                                       dead_letter_queue=None):
+        """move a job of queue_id whose lease runs out for the
+        max_deliveries time to dead_letter_queue"""
+        value = [queue_id, max_deliveries]
+        if dead_letter_queue is not None:
+            value.append(dead_letter_queue)
+        await self.request('POST', '/config',
+                           {'queue_max_deliveries': value})
+
+    async def set_queue_retry_delay(self, queue_id, retry_delay, backoff=1,
+                                    max_retry_delay=None):
+        """hold a job of queue_id whose lease ran out back for retry_delay
+        seconds, multiplied by backoff for each time it was handed out
+        before, up to max_retry_delay"""
+        value = [queue_id, retry_delay, backoff]
+        if max_retry_delay is not None:
+            value.append(max_retry_delay)
+        await self.request('POST', '/config', {'queue_retry_delay': value})
+
+    async def set_queue_lease_time(self, queue_id, lease_time):
+        """set the lease time for the given queue_id"""
+        await self.request('POST', '/config',
+                           {'queue_lease_time': [queue_id, lease_time]})
+
+    @property
+    def status(self):
+        """a coroutine returning the status of the realm"""
+        return self.request('GET', '/status')
+
+
+class Realms(BaseClient):
+
+    def __getitem__(self, name):
+        return Realm(name, self._uri, self.pool, self.wire_format,
+                     self.timeout)
+
+    def get(self, name):
+        """return the Realm called name"""
+        return self[name]
+
+    async def realms(self):
+        """return a dict of the realms on the server by name"""
+        return dict((name, self[name])
+                    for name in await self.request('GET', '/'))
+
+    async def bulk_add(self, jobs):
+        """add jobs in bulk across realms,
+        jobs = [{realm_id, job_id, queue_id, data, tags}, ...]
+
+        returns {'added': count,
+                 'errors': [{index, job_id, exception, message}, ...]}
+        """
+        return await self.request('POST', '/jobs', {'jobs': jobs})
+
+    async def bulk_remove(self, jobs):
+        """remove jobs in bulk across realms, jobs = [(realm_id, job_id), ...]
+        """
+        await self.request('DELETE', '/jobs', {'jobs': jobs})
+
+    async def pull(self, count=None, realms=None, wait=None):
+        """pull jobs across multiple realms, waiting up to wait seconds for
+        a job to become available if there are none.
+
+        realms = [realm_name, ...]
+        """
+        if count is None:
+            count = config.client['count']
+        query = [('count', count)]
+        if realms is not None:
+            query.append(('realms', ','.join(realms)))
+        if wait:
+            query.append(('wait', wait))
+        return await self.request('GET', '/job', query=query,
+                                  timeout=self.timeout + (wait or 0))
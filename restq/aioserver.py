@@ -0,0 +1,406 @@
+"""An asyncio HTTP/1.1 server for the restq web app (Python 3.5+).
+
+Connections are served by an event loop, so keep-alive connections are
+reused between requests and thousands of them can be held open at once
+without a thread each.  Each request is handed to a thread pool, where the
+WSGI app may wait for a realm's lock, sync its journal or call another node
+without stalling the other connections.  Pulls that wait for jobs have a
+pool of their own.  Only the routes in INLINE_ROUTES, which just read
+counters, are run on the loop.
+
+The app reads the request body from the connection as it needs it and the
+response is written out as the app produces it, with chunked encoding when
+it has no Content-Length.
+
+Use it with 'restq web --server=asyncio'.  uvloop is used when installed.
+"""
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, unquote_to_bytes
+
+import bottle
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+MAX_HEADER_SIZE = 65536
+
+# The most requests run by the app at once, more queue up.
+MAX_THREADS = 64
+
+# The most pulls that may block waiting for jobs at once, more queue up.
+# They have a pool of their own so they can't hold up the other requests.
+MAX_WAITING_REQUESTS = 256
+
+# GET routes answered from counters held in memory, which are run on the loop
+INLINE_ROUTES = frozenset(['/performance', '/profile', '/cluster',
+                           '/replication'])
+
+BUFSIZE = 65536
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _parse_head(head):
+    """return method, target, version and a list of (name, value) headers"""
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise BadRequest("bad request line %r" % lines[0])
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest("bad header %r" % line)
+        headers.append((name.strip().lower(), value.strip()))
+    return method, target, version, headers
+
+
+async def read_chunked(reader):
+    """return a chunked transfer encoded body read from reader"""
+    body = []
+    while True:
+        size = await reader.readline()
+        try:
+            size = int(size.split(b';')[0], 16)
+        except ValueError:
+            raise BadRequest("bad chunk size")
+        if size == 0:
+            # skip any trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(body)
+        body.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+class Body(object):
+    """The body of a request, read from the connection by the app's thread
+    as it asks for it.
+
+    A sized body ends at its Content-Length.  A chunked body is handed on
+    in its chunked framing, which the app decodes, and its chunks are
+    followed here to find where it ends.  Whatever the app leaves unread is
+    drained before the next request on the connection is read.
+    """
+
+    def __init__(self, reader, loop, length=0, chunked=False):
+        self._reader = reader
+        self._loop = loop
+        self._remaining = length
+        self._chunked = chunked
+        self._chunk = 0     # bytes left of the current chunk and its CRLF
+        self._buffer = b''
+        self.done = not chunked and not length
+        self.failed = False
+
+    async def _next(self):
+        """return the next piece of the body, b'' once it's all read"""
+        if self.done:
+            return b''
+        reader = self._reader
+        if not self._chunked or self._chunk:
+            want = self._chunk if self._chunked else self._remaining
+            data = await reader.read(min(BUFSIZE, want))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', want)
+            if self._chunked:
+                self._chunk -= len(data)
+            else:
+                self._remaining -= len(data)
+                self.done = not self._remaining
+            return data
+        line = await reader.readline()
+        try:
+            size = int(line.split(b';')[0], 16)
+        except ValueError:
+            raise BadRequest("bad chunk size")
+        if size:
+            self._chunk = size + 2
+            return b'%x\r\n' % size
+        # skip any trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        self.done = True
+        return b'0\r\n\r\n'
+
+    def _fetch(self):
+        if self.done:
+            return b''
+        future = asyncio.run_coroutine_threadsafe(self._next(), self._loop)
+        try:
+            return future.result()
+        except (BadRequest, ConnectionError, asyncio.IncompleteReadError):
+            # the app sees the body end, the connection is closed after
+            self.failed = self.done = True
+            return b''
+
+    def read(self, size=-1):
+        out = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            data = self._fetch()
+            if not data:
+                break
+            out.append(data)
+            length += len(data)
+        data = b''.join(out)
+        if size < 0:
+            self._buffer = b''
+            return data
+        data, self._buffer = data[:size], data[size:]
+        return data
+
+    def readline(self, size=-1):
+        buffer = self._buffer
+        while b'\n' not in buffer and (size < 0 or len(buffer) < size):
+            data = self._fetch()
+            if not data:
+                break
+            buffer += data
+        end = buffer.find(b'\n') + 1 or len(buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = buffer[:end], buffer[end:]
+        return line
+
+    async def drain(self):
+        """read and drop the rest of the body"""
+        try:
+            while not self.done:
+                await self._next()
+        except (BadRequest, ConnectionError, asyncio.IncompleteReadError):
+            self.failed = self.done = True
+
+
+def _environ(method, target, version, headers, body, sockname, peername):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': str(sockname[0]),
+        'SERVER_PORT': str(sockname[1]),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': str(peername[0]) if peername else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers:
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    return environ
+
+
+def _blocks(environ):
+    """return True if the request may block, i.e. a pull with a wait"""
+    query = environ['QUERY_STRING']
+    if environ['REQUEST_METHOD'] != 'GET' or 'wait=' not in query:
+        return False
+    wait = parse_qs(query).get('wait', ['0'])[0]
+    return wait not in ('', '0')
+
+
+# The pool for pulls that wait, made by run() in the process it serves from
+# since a forked worker doesn't inherit the parent's threads.
+_waiting_pool = None
+
+
+def _waiting_executor():
+    global _waiting_pool
+    if _waiting_pool is None:
+        _waiting_pool = ThreadPoolExecutor(MAX_WAITING_REQUESTS)
+    return _waiting_pool
+
+
+def _inline(environ, body):
+    """return True if the request can be run on the loop"""
+    return environ['REQUEST_METHOD'] == 'GET' and body.done and \
+        environ['PATH_INFO'] in INLINE_ROUTES
+
+
+def _head(version, status, headers):
+    lines = ['%s %s' % (version, status)]
+    lines.extend('%s: %s' % header for header in headers)
+    lines.append('\r\n')
+    return '\r\n'.join(lines).encode('latin-1')
+
+
+def _call(app, environ, version, keep_alive, send):
+    """call app and send its response, the whole of it with a single send
+    when it isn't streamed.  It runs on the app's thread, or on the loop
+    for an inline route."""
+    started = []
+    body = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, list(headers)]
+        return body.append
+    result = app(environ, start_response)
+    try:
+        if isinstance(result, (list, tuple)):
+            body.extend(result)
+            chunks = None
+        else:
+            # the app may only start the response with its first chunk
+            chunks = iter(result)
+            for chunk in chunks:
+                body.append(chunk)
+                break
+        status, headers = started
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        sized = 'content-length' in [name.lower() for name, _ in headers]
+        if chunks is None or not sized and version == 'HTTP/1.0':
+            # we have the response in full, or a client that can't do chunks
+            if chunks is not None:
+                body.extend(chunks)
+            data = b''.join(body)
+            if not sized:
+                headers.append(('Content-Length', str(len(data))))
+            send(_head(version, status, headers) + data)
+        elif sized:
+            send(_head(version, status, headers) + b''.join(body))
+            for chunk in chunks:
+                send(chunk)
+        else:
+            headers.append(('Transfer-Encoding', 'chunked'))
+            send(_head(version, status, headers))
+            for chunk in _chain(body, chunks):
+                if chunk:
+                    send(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            send(b'0\r\n\r\n')
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+
+async def _write(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+
+async def _respond(writer, app, environ, version, keep_alive):
+    """run app on a thread, or inline, writing its response.  returns False
+    to close the connection"""
+    body = environ['wsgi.input']
+    if _inline(environ, body):
+        _call(app, environ, version, keep_alive, writer.write)
+    else:
+        loop = asyncio.get_event_loop()
+        def send(data):
+            asyncio.run_coroutine_threadsafe(_write(writer, data),
+                                             loop).result()
+        executor = _waiting_executor() if _blocks(environ) else None
+        await loop.run_in_executor(executor, _call, app, environ, version,
+                                   keep_alive, send)
+        await body.drain()
+    await writer.drain()
+    return keep_alive and not body.failed
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+
+async def _serve(app, reader, writer):
+    loop = asyncio.get_event_loop()
+    sockname = writer.get_extra_info('sockname')
+    peername = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError:
+                writer.write(b'HTTP/1.1 431 Request Header Fields Too Large'
+                             b'\r\nConnection: close\r\n\r\n')
+                break
+            try:
+                method, target, version, headers = _parse_head(head)
+                fields = dict(headers)
+                if 'chunked' in fields.get('transfer-encoding', ''):
+                    body = Body(reader, loop, chunked=True)
+                else:
+                    length = int(fields.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                    body = Body(reader, loop, length)
+            except (BadRequest, ValueError):
+                writer.write(b'HTTP/1.1 400 Bad Request\r\n'
+                             b'Connection: close\r\n\r\n')
+                break
+            connection = fields.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+            environ = _environ(method, target, version, headers, body,
+                               sockname, peername)
+            if not await _respond(writer, app, environ, version, keep_alive):
+                break
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        # a connection left open when the loop is closed is closed with it
+        if not loop.is_closed():
+            writer.close()
+
+
+def run(app, host='127.0.0.1', port=8586, quiet=False):
+    """serve app on host:port until interrupted"""
+    global _waiting_pool
+    _waiting_pool = ThreadPoolExecutor(MAX_WAITING_REQUESTS)
+    if uvloop is not None:
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(ThreadPoolExecutor(MAX_THREADS))
+    start = asyncio.start_server(partial(_serve, app), host, port,
+                                 limit=MAX_HEADER_SIZE, backlog=2048)
+    server = loop.run_until_complete(start)
+    if not quiet:
+        print("restq asyncio server listening on http://%s:%d/" % \
+                (host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    """bottle server adapter, bottle.run(server='asyncio')"""
+
+    def run(self, handler):
+        run(handler, self.host, self.port, quiet=self.quiet)
+
+bottle.server_names['asyncio'] = AsyncioServer
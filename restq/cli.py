@@ -11,6 +11,10 @@ from restq import config
 
 
 def command_web():
+    if config.webapp['workers'] > 1:
+        from restq import router
+        router.run()
+        return 0
     from restq import webapp
     webapp.run()
     return 0
@@ -37,7 +41,7 @@ def command_add(arg):
 
 def command_pull():
     realm = restq.Realms()[config.cli['realm']]
-    jobs = realm.pull()
+    jobs = realm.pull(wait=config.cli['wait'])
     for arg, obj in jobs.items():
         _, data = obj
         if data:
@@ -99,24 +103,34 @@ def command_status(arg=None, tag=None):
             return -1
         else:
             print("%s jobs tagged with %s" % (status['count'], tag))
+            print("%(available)s available, %(leased)s leased, "
+                  "%(completed)s completed" % status)
     else:
         print("Status of realm %s:" % realm.name)
         status = realm.status
         print("Contains %(total_tags)s tags with %(total_jobs)s jobs" % \
                 (status))
         print("Defined queues: " + ", ".join(status['queues']))
+        counts = status.get('queue_status', {})
+        if counts:
+            print("queue id |    total | available |   leased |  expired")
+            for queue_id in sorted(counts):
+                print("%8s | %8d | %9d | %8d | %8d" % (queue_id,
+                        counts[queue_id]['total'],
+                        counts[queue_id]['available'],
+                        counts[queue_id]['leased'],
+                        counts[queue_id]['expired']))
     return 0
 
 
 def command_get(tag):
     realm = restq.Realms()[config.cli['realm']]
     try:
-        jobs = realm.get_tagged_jobs(tag)
+        # a page of the tag's ids at a time
+        for arg, _ in realm.iter_tagged_jobs(tag, fields='ids'):
+            print(base64.decodestring(arg))
     except KeyError:
         print("No jobs found for tag '%s'" % tag)
-    else:
-        for arg in jobs:
-            print(base64.decodestring(arg))
     return 0
 
 
@@ -141,11 +155,24 @@ COMMAND options:
 
         options
             --server=%(webapp_server)s
-                Choose the server adapter to use.
+                Choose the server adapter to use.  Any bottle adapter, or
+                asyncio (Python 3) to serve keep-alive connections from an
+                event loop.
             --debug=%(webapp_debug)s 
                 Run in debug mode.
             --quiet=%(webapp_quiet)s
                 Run in quite mode.
+            --workers=%(webapp_workers)s
+                Serve the realms from this many worker processes, each on
+                the port after the last, behind a router on PORT.
+            --cluster=URI,...
+                The uris of all of the nodes of a cluster, realms are spread
+                across them by a consistent hash.
+            --node=URI
+                The uri of this node in the cluster.
+            --replica-of=URI
+                Serve read-only copies of the realms of the primary at URI,
+                until promoted with POST /promote.
 
     add [OPTIONS] [ARG,...] 
         Add arguments into a REALM.
@@ -173,6 +200,8 @@ COMMAND options:
                 Specify which realm to operate in.
             --count=%(client_count)s
                 Number of jobs to pull from the queue
+            --wait=%(cli_wait)s
+                Seconds to wait for a job when there are none available.
             --uri=%(client_uri)s
                 Define the connection uri.
    
@@ -235,9 +264,10 @@ def main(args):
 
     try:
         opts, args = getopt(args, '-r', [
-            'server=', 'debug=', 'quiet=',
+            'server=', 'debug=', 'quiet=', 'workers=', 'cluster=', 'node=',
+            'replica-of=',
             'realm=', 'uri=',
-            'count=',
+            'count=', 'wait=',
             'tags=', 'queue=', 'file=',
         ])
     except Exception as exc:
@@ -251,6 +281,18 @@ def main(args):
             config.webapp['quite'] = arg.lower() != 'false'
         elif opt in ['--debug']:
             config.webapp['debug'] = arg.lower() != 'false'
+        elif opt in ['--workers']:
+            try:
+                config.webapp['workers'] = int(arg)
+            except ValueError:
+                print("failed to convert workers to int (%s)" % arg)
+                return -1
+        elif opt in ['--cluster']:
+            config.cluster['nodes'] = arg
+        elif opt in ['--node']:
+            config.cluster['node'] = arg
+        elif opt in ['--replica-of']:
+            config.replication['primary'] = arg
         elif opt in ['--realm']:
             config.cli['realm'] = arg
         elif opt in ['--uri']:
@@ -261,6 +303,12 @@ def main(args):
             except ValueError:
                 print("failed to convert count to int (%s)" % arg)
                 return -1
+        elif opt in ['--wait']:
+            try:
+                config.cli['wait'] = float(arg)
+            except ValueError:
+                print("failed to convert wait to float (%s)" % arg)
+                return -1
         elif opt in ['--queue']:
             config.cli['queue_id'] = arg
         elif opt in ['--tags']:
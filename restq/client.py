@@ -1,46 +1,112 @@
-import json
 import requests
 import sys
-from collections import MutableMapping
+import time
+import traceback
+from contextlib import contextmanager
+from itertools import groupby
+from threading import Condition, Lock, Thread
 if sys.version_info[0] < 3:
+    from collections import MutableMapping
+    from Queue import Queue
     builtins = __builtins__
 else:
+    from collections.abc import MutableMapping
+    from queue import Queue
     import builtins
 
 from restq import realms
 from restq import config
+from restq import codec
+
+
+WIRE_FORMATS = {'json': codec.JSON, 'msgpack': codec.MSGPACK}
+
+
+def session(pool_size=None):
+    """return a requests.Session that keeps up to pool_size connections
+    alive to each server, it is safe to share between threads"""
+    if pool_size is None:
+        pool_size = config.client['pool_size']
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+_session = None
+_session_lock = Lock()
+def shared_session():
+    """return the session clients use unless given a requester"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = session()
+        return _session
+
+
+def decode_response(status_code, content_type, content, url):
+    """return the decoded body of a response, raising the exception named
+    by an error response"""
+    if content_type not in (codec.JSON, codec.MSGPACK):
+        raise Exception(
+                "content-type!=application/json got %s(%s) %s\n'%s'" %\
+                    (content_type, status_code, url,
+                     content.decode('utf-8', 'replace')))
+    if status_code >= 400:
+        try:
+            out = codec.loads(content, content_type)
+        except Exception:
+            out = {}
+        etype = out.get('exception', 'Exception')
+        if etype in ('RealmMoved', 'ReadOnlyRealm'):
+            eclass = getattr(realms, etype)
+        elif isinstance(builtins, dict):
+            eclass = builtins.get(etype, 'Exception')
+        else:
+            eclass = getattr(builtins, etype, 'Exception')
+        raise eclass(out.get('message', 'status: %s' % status_code))
+    try:
+        return codec.loads(content, content_type)
+    except Exception:
+        raise Exception("Failed to decode response after a 200 response")
 
 
 class BaseClient(object):
-    __slots__ = ('requester',)
-
-    def __init__(self, requester=requests):
+    __slots__ = ('requester', 'wire_format', 'timeout', '_mime')
+
+    def __init__(self, requester=None, wire_format=None, timeout=None):
+        """requester defaults to a session shared by all clients
+        wire_format is how bodies are encoded, 'json' or 'msgpack'
+        timeout is the seconds to wait on a connect or a response"""
+        if requester is None:
+            requester = shared_session()
+        if wire_format is None:
+            wire_format = config.client['wire_format']
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError("Unknown wire format '%s'" % wire_format)
+        if timeout is None:
+            timeout = config.client['timeout']
         self.requester = requester
+        self.wire_format = wire_format
+        self.timeout = timeout
+        self._mime = WIRE_FORMATS[wire_format]
 
     def request(self, rtype, *args, **kwargs):
+        """make a request, encoding the body keyword with the wire format
+        and returning the decoded response"""
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('Accept', self._mime)
+        if 'body' in kwargs:
+            kwargs['data'] = codec.dumps(kwargs.pop('body'), self._mime)
+            headers['Content-Type'] = self._mime
+        kwargs['headers'] = headers
+        kwargs.setdefault('timeout', self.timeout)
         func = getattr(self.requester, rtype)
         r = func(*args, **kwargs)
-        content_type = r.headers.get('content-type', None)
-        if content_type != 'application/json':
-            raise Exception(
-                    "content-type!=application/json got %s(%s) %s\n'%s'" %\
-                        (content_type, r.status_code, r.url, r.text))
-        if not r.ok:
-            try:
-                out = r.json()
-            except Exception:
-                out = {}
-            etype = out.get('exception', 'Exception')
-            if isinstance(builtins, dict):
-                eclass = builtins.get(etype, 'Exception')
-            else:
-                eclass = getattr(builtins, etype, 'Exception')
-            raise eclass(out.get('message', 'status: %s' % r.status_code))
-        try:
-            out = r.json()
-        except Exception:
-            raise Exception("Failed to decode response after a 200 response")
-        return out
+        return decode_response(r.status_code, r.headers.get('content-type'),
+                               r.content, r.url)
 
     def bulk_remove(self, jobs):
         """bulk remove
@@ -49,9 +115,7 @@ class BaseClient(object):
 
         """
         uri = "%s/jobs" % (self._uri)
-        body = {'jobs': jobs}
-        body = json.dumps(body)
-        self.request('delete', uri, data=body)
+        self.request('delete', uri, body={'jobs': jobs})
 
     def bulk_add(self, jobs):
         """add jobs in bulk.
@@ -65,14 +129,31 @@ class BaseClient(object):
              # Optional tag values
              data:
              tags:}
+
+        returns {'added': count,
+                 'errors': [{index, job_id, exception, message}, ...]}
         """
         uri = "%s/jobs" % (self._uri)
-        body = {'jobs': jobs}
-        body = json.dumps(body)
-        self.request('post', uri, data=body)
+        return self.request('post', uri, body={'jobs': jobs})
 
-    def pull(self, count=None, realms=None):
-        """pull jobs across multiple realms.
+    def stream_add(self, jobs):
+        """add jobs from an iterable, streamed to the server as NDJSON so
+        neither side holds them all in memory.
+
+        jobs is an iterable of job dictionaries as for bulk_add, the
+        realm_id may be left out when adding to a Realm.
+
+        returns {'added': count,
+                 'errors': [{line, job_id, exception, message}, ...]}
+        """
+        uri = "%s/jobs" % (self._uri)
+        body = (codec.json_dumps(job) + b'\n' for job in jobs)
+        return self.request('post', uri, data=body,
+                headers={'Content-Type': 'application/x-ndjson'})
+
+    def pull(self, count=None, realms=None, wait=None):
+        """pull jobs across multiple realms, waiting up to wait seconds for
+        a job to become available if there are none.
 
         realms = [realm_name, ...]
         """
@@ -81,18 +162,107 @@ class BaseClient(object):
         uri = "%s/job?count=%s" % (self._uri, count)
         if realms is not None:
             uri += "&realms=%s" % ','.join(realms)
-        return self.request('get', uri)
+        if wait:
+            uri += "&wait=%s" % wait
+        return self.request('get', uri, timeout=self.timeout + (wait or 0))
 
 class Realm(BaseClient):
-    def __init__(self, name, uri, requester=requests):
-        BaseClient.__init__(self, requester)
+    def __init__(self, name, uri, requester=None, wire_format=None,
+                 timeout=None, locate=None):
+        """locate(name, refresh) returns the uri of the node serving the
+        realm in a cluster, a call answered with RealmMoved is made once
+        more on the node it returns after a refresh"""
+        BaseClient.__init__(self, requester, wire_format, timeout)
         self._name = name
         self._uri = "%s/%s" % (uri, name)
+        self._locate = locate
+        self._pipeline = None
+        self._pipeline_size = 0
+        self._pipeline_result = None
+        self._pipeline_lock = Lock()
 
     def __str__(self):
         return str(self.status)
 
+    def request(self, rtype, uri, **kwargs):
+        try:
+            return BaseClient.request(self, rtype, uri, **kwargs)
+        except realms.RealmMoved:
+            data = kwargs.get('data')
+            if self._locate is None or not uri.startswith(self._uri) or \
+                    not (data is None or isinstance(data, bytes)):
+                # a streamed body can't be sent again
+                raise
+        moved = "%s/%s" % (self._locate(self._name, True), self._name)
+        uri = moved + uri[len(self._uri):]
+        self._uri = moved
+        return BaseClient.request(self, rtype, uri, **kwargs)
+    request.__doc__ = BaseClient.request.__doc__
+
+    @contextmanager
+    def pipeline(self, size=None):
+        """queue the add and remove_job calls made on this realm within the
+        block, sending them through the bulk endpoints size at a time and
+        when the block exits.
+
+        Queued calls don't raise for a bad job, the block is given a dict
+        that gathers the results of each bulk_flush:
+            with realm.pipeline() as result:
+                ...
+            result == {'added': count, 'errors': [...]}
+        """
+        if size is None:
+            size = config.client['pipeline_size']
+        result = {'added': 0, 'errors': []}
+        self._pipeline = []
+        self._pipeline_size = size
+        self._pipeline_result = result
+        try:
+            yield result
+        finally:
+            try:
+                self.bulk_flush()
+            finally:
+                self._pipeline = None
+                self._pipeline_result = None
+
+    def _queue(self, op, item):
+        with self._pipeline_lock:
+            self._pipeline.append((op, item))
+            full = len(self._pipeline) >= self._pipeline_size
+        if full:
+            self.bulk_flush()
+
+    def bulk_flush(self):
+        """send the queued add and remove_job calls through the bulk
+        endpoints, in the order they were made.
+
+        returns {'added': count,
+                 'errors': [{index, job_id, exception, message}, ...]}
+        for the adds, job removals that fail are ignored.
+        """
+        result = {'added': 0, 'errors': []}
+        with self._pipeline_lock:
+            if not self._pipeline:
+                return result
+            ops = self._pipeline[:]
+            del self._pipeline[:]
+        for op, group in groupby(ops, key=lambda x: x[0]):
+            items = [item for _, item in group]
+            if op == 'add':
+                out = self.bulk_add(items)
+                result['added'] += out['added']
+                result['errors'].extend(out['errors'])
+            else:
+                self.bulk_remove(items)
+        if self._pipeline_result is not None:
+            self._pipeline_result['added'] += result['added']
+            self._pipeline_result['errors'].extend(result['errors'])
+        return result
+
     def remove_job(self, job_id):
+        if self._pipeline is not None:
+            return self._queue('remove', job_id)
         uri = "%s/job/%s" % (self._uri, job_id)
         self.request('delete', uri)
     remove_job.__doc__ = realms.Realm.remove_job.__doc__
@@ -110,60 +280,175 @@ class Realm(BaseClient):
         return self.request('get', uri)
     get_job.__doc__ = realms.Realm.get_job.__doc__
 
-    def get_tagged_jobs(self, tag_id):
+    def get_tagged_jobs(self, tag_id, fields='data'):
         uri = "%s/tag/%s" % (self._uri, tag_id)
-        return self.request('get', uri)
+        params = {'fields': fields} if fields != 'data' else None
+        return self.request('get', uri, params=params)
     get_tagged_jobs.__doc__ = realms.Realm.get_tagged_jobs.__doc__
 
+    def get_tagged_page(self, tag_id, after=None, count=None, fields='data'):
+        uri = "%s/tag/%s" % (self._uri, tag_id)
+        params = {'fields': fields}
+        if count is None:
+            count = config.client['tag_page_size']
+        params['count'] = count
+        if after is not None:
+            # JSON encoded, so an int job_id isn't taken for a string
+            params['after'] = codec.json_dumps(after).decode('utf-8')
+        return self.request('get', uri, params=params)
+    get_tagged_page.__doc__ = realms.Realm.get_tagged_page.__doc__
+
+    def iter_tagged_jobs(self, tag_id, fields='data', page_size=None):
+        """return an iterator of (job_id, status) for the jobs tagged by
+        tag_id in job_id order, fetching a page of page_size of them at a
+        time as they're needed.  See realms.Realm.iter_tagged_jobs"""
+        after = None
+        while True:
+            page = self.get_tagged_page(tag_id, after, page_size, fields)
+            for job_id in sorted(page['jobs'], key=realms.queue_key):
+                yield job_id, page['jobs'][job_id]
+            after = page['next']
+            if after is None:
+                break
+
     def move_job(self, job_id, from_q, to_q):
         uri = "%s/job/%s/from_q/%s/to_q/%s" % (self._uri, job_id, from_q, to_q)
         return self.request('get', uri)
     move_job.__doc__ = realms.Realm.move_job.__doc__
 
+    def renew(self, job_id, extra):
+        uri = "%s/job/%s/renew" % (self._uri, job_id)
+        self.request('post', uri, body={'extra': extra})
+    renew.__doc__ = realms.Realm.renew.__doc__
+
+    def release(self, job_id):
+        uri = "%s/job/%s/release" % (self._uri, job_id)
+        self.request('post', uri)
+    release.__doc__ = realms.Realm.release.__doc__
+
     def set_default_lease_time(self, lease_time):
         uri = "%s/config" % (self._uri)
         data = {'default_lease_time': lease_time}
-        self.request('post', uri, data=json.dumps(data))
+        self.request('post', uri, body=data)
     set_default_lease_time.__doc__ = realms.Realm.set_default_lease_time.__doc__
 
+    def set_retry_delay(self, retry_delay):
+        uri = "%s/config" % (self._uri)
+        self.request('post', uri, body={'retry_delay': retry_delay})
+    set_retry_delay.__doc__ = realms.Realm.set_retry_delay.__doc__
+
+    def set_queue_max_deliveries(self, queue_id, max_deliveries,
+                                 dead_letter_queue=None):
+        uri = "%s/config" % (self._uri)
+        data = {'queue_max_deliveries': [queue_id, max_deliveries]}
+        if dead_letter_queue is not None:
+            data['queue_max_deliveries'].append(dead_letter_queue)
+        self.request('post', uri, body=data)
+    set_queue_max_deliveries.__doc__ = \
+        realms.Realm.set_queue_max_deliveries.__doc__
+
+    def set_queue_retry_delay(self, queue_id, retry_delay, backoff=1,
+                              max_retry_delay=None):
+        uri = "%s/config" % (self._uri)
+        data = {'queue_retry_delay': [queue_id, retry_delay, backoff]}
+        if max_retry_delay is not None:
+            data['queue_retry_delay'].append(max_retry_delay)
+        self.request('post', uri, body=data)
+    set_queue_retry_delay.__doc__ = \
+        realms.Realm.set_queue_retry_delay.__doc__
+
     def set_queue_lease_time(self, queue_id, lease_time):
         uri = "%s/config" % (self._uri)
         data = {'queue_lease_time': [queue_id, lease_time]}
-        self.request('post', uri, data=json.dumps(data))
+        self.request('post', uri, body=data)
     set_queue_lease_time.__doc__ = realms.Realm.set_queue_lease_time.__doc__
 
+    def set_durability(self, durability):
+        uri = "%s/config" % (self._uri)
+        data = {'durability': durability}
+        self.request('post', uri, body=data)
+    set_durability.__doc__ = realms.Realm.set_durability.__doc__
+
     def clear_queue(self, queue_id):
         uri = "%s/queues/%s/clear" % (self._uri, queue_id)
         self.request('get', uri)
     clear_queue.__doc__ = realms.Realm.clear_queue.__doc__
 
-    def add(self, job_id, queue_id, data=None, tags=None):
-        uri = "%s/job/%s" % (self._uri, job_id)
+    def delete(self):
+        uri = "%s/" % (self._uri)
+        self.request('delete', uri)
+    delete.__doc__ = realms.delete.__doc__
+
+    def add(self, job_id, queue_id, data=None, tags=None, not_before=None,
+            delay=None):
         body = {'queue_id': queue_id}
-        if data is not None:
-            body['data'] = data
-        if tags is not None:
-            body['tags'] = tags
-        body = json.dumps(body)
-        self.request('put', uri, data=body)
+        for key, value in (('data', data), ('tags', tags),
+                           ('not_before', not_before), ('delay', delay)):
+            if value is not None:
+                body[key] = value
+        if self._pipeline is not None:
+            # a delay runs from when the pipeline is sent
+            body['job_id'] = job_id
+            return self._queue('add', body)
+        uri = "%s/job/%s" % (self._uri, job_id)
+        self.request('put', uri, body=body)
     add.__doc__ = realms.Realm.add.__doc__
 
     def bulk_add(self, jobs):
-        for job in jobs.values():
-            job['realm_id'] = self._name
-        super(Realm, self).bulk_add(jobs)
+        """add jobs in bulk.
 
-    def bulk_remove(self, jobs):
-        jobs = [(self._name, job) for job in jobs]
-        super(Realm, self).bulk_remove(jobs)
+        jobs = [{job_id, queue_id, data, tags, not_before, delay}, ...]
+        """
+        return super(Realm, self).bulk_add(jobs)
+
+    def bulk_remove(self, job_ids):
+        """bulk remove
+
+        job_ids = [job_id, ...]
+        """
+        super(Realm, self).bulk_remove(job_ids)
+
+    def bulk_move(self, moves):
+        """move jobs in bulk.
+
+        moves = [(job_id, from_q, to_q), ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        uri = "%s/jobs/move" % (self._uri)
+        return self.request('post', uri, body={'moves': moves})
+
+    def bulk_renew(self, renewals):
+        """renew leases in bulk.
 
-    def pull(self, count=None, max_queue=None):
+        renewals = [(job_id, extra), ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        uri = "%s/jobs/renew" % (self._uri)
+        return self.request('post', uri, body={'renewals': renewals})
+
+    def bulk_release(self, job_ids):
+        """release leases in bulk.
+
+        job_ids = [job_id, ...]
+
+        returns {'errors': [{index, job_id, exception, message}, ...]}
+        """
+        uri = "%s/jobs/release" % (self._uri)
+        return self.request('post', uri, body={'jobs': job_ids})
+
+    def pull(self, count=None, max_queue=None, wait=None, queue_id=None):
         if count is None:
             count = config.client['count']
         uri = "%s/job?count=%s" % (self._uri, count)
         if max_queue is not None:
             uri += "&max-queue=%s" % max_queue
-        return self.request('get', uri)
+        if queue_id is not None:
+            uri += "&queue=%s" % queue_id
+        if wait:
+            uri += "&wait=%s" % wait
+        return self.request('get', uri, timeout=self.timeout + (wait or 0))
     pull.__doc__ = realms.Realm.pull.__doc__
 
     def get_tag_status(self, tag_id):
@@ -183,30 +468,171 @@ class Realm(BaseClient):
 
 
 class Realms(MutableMapping, BaseClient):
+    """The realms served at uri.  When uri is a node of a cluster the nodes
+    are learnt from its GET /cluster and each realm's calls are sent
+    straight to the node that owns it, see restq.cluster."""
     __slots__ = ('_reserved',
                  '_uri',
                  '_realms',
-                 '_requester')
+                 '_requester',
+                 '_ring')
 
-    def __init__(self, uri=None, requester=requests):
-        BaseClient.__init__(self, requester)
+    def __init__(self, uri=None, requester=None, wire_format=None,
+                 timeout=None):
+        BaseClient.__init__(self, requester, wire_format, timeout)
         if uri is None:
             uri = config.client['uri']
         if uri.endswith('/'):
             uri = uri[:-1]
         self._realms = None
-        self._requester = requester
+        self._requester = self.requester
         self._uri = uri
+        self._ring = None
+
+    def _cluster(self, refresh=False):
+        """return the HashRing of the cluster uri is a node of, or False"""
+        if self._ring is None or refresh:
+            from restq.cluster import HashRing
+            try:
+                status = self.request('get', "%s/cluster" % self._uri)
+            except Exception:
+                # not a cluster node, or a router or older server
+                status = {}
+            if status.get('nodes'):
+                self._ring = HashRing(status['nodes'], status['replicas'])
+            else:
+                self._ring = False
+        return self._ring
+
+    def _locate(self, realm_id, refresh=False):
+        """return the uri of the node that serves realm_id"""
+        ring = self._cluster(refresh)
+        if not ring:
+            return self._uri
+        return ring.owner(str(realm_id))
+
+    def _nodes(self):
+        ring = self._cluster()
+        return ring.nodes if ring else [self._uri]
+
+    def _realm(self, k):
+        return Realm(k, self._locate(k), requester=self._requester,
+                     wire_format=self.wire_format, timeout=self.timeout,
+                     locate=self._locate)
 
     @property
     def realms(self):
         if self._realms is None:
             self._realms = {}
-            realms = self.request('get', self._uri)
-            for k in realms:
-                self._realms[k] = Realm(k, self._uri, requester=self._requester)
+            for node in self._nodes():
+                for k in self.request('get', node):
+                    self._realms[k] = self._realm(k)
         return self._realms
 
+    def _split(self, items, realm_id):
+        """return [(node, [index, ...]), ...] grouping the indexes of items
+        by the node that owns realm_id(item)"""
+        ring = self._cluster()
+        groups = {}
+        for i, item in enumerate(items):
+            node = self._uri
+            if ring:
+                try:
+                    node = ring.owner(str(realm_id(item)))
+                except Exception:
+                    # leave it to the server to report
+                    pass
+            groups.setdefault(node, []).append(i)
+        return sorted(groups.items())
+
+    def bulk_add(self, jobs):
+        jobs = list(jobs)
+        if not self._cluster():
+            return BaseClient.bulk_add(self, jobs)
+        result = {'added': 0, 'errors': []}
+        for node, indexes in self._split(jobs, lambda job: job['realm_id']):
+            out = self.request('post', "%s/jobs" % node,
+                               body={'jobs': [jobs[i] for i in indexes]})
+            result['added'] += out['added']
+            for error in out['errors']:
+                error['index'] = indexes[error['index']]
+                result['errors'].append(error)
+        result['errors'].sort(key=lambda error: error['index'])
+        return result
+    bulk_add.__doc__ = BaseClient.bulk_add.__doc__
+
+    def stream_add(self, jobs):
+        if not self._cluster():
+            return BaseClient.stream_add(self, jobs)
+        # the jobs are split between the nodes a chunk at a time
+        size = config.client['pipeline_size']
+        result = {'added': 0, 'errors': []}
+        chunk = []
+        offset = 0
+        jobs = iter(jobs)
+        while True:
+            offset += len(chunk)
+            del chunk[:]
+            for job in jobs:
+                chunk.append(job)
+                if len(chunk) >= size:
+                    break
+            if not chunk:
+                break
+            for node, indexes in self._split(chunk,
+                                             lambda job: job['realm_id']):
+                body = (codec.json_dumps(chunk[i]) + b'\n' for i in indexes)
+                out = self.request('post', "%s/jobs" % node, data=body,
+                        headers={'Content-Type': 'application/x-ndjson'})
+                result['added'] += out['added']
+                for error in out['errors']:
+                    error['line'] = offset + indexes[error['line'] - 1] + 1
+                    result['errors'].append(error)
+        result['errors'].sort(key=lambda error: error['line'])
+        return result
+    stream_add.__doc__ = BaseClient.stream_add.__doc__
+
+    def bulk_remove(self, jobs):
+        if not self._cluster():
+            return BaseClient.bulk_remove(self, jobs)
+        jobs = list(jobs)
+        for node, indexes in self._split(jobs, lambda job: job[0]):
+            self.request('delete', "%s/jobs" % node,
+                         body={'jobs': [jobs[i] for i in indexes]})
+    bulk_remove.__doc__ = BaseClient.bulk_remove.__doc__
+
+    def pull(self, count=None, realms=None, wait=None):
+        if not self._cluster():
+            return BaseClient.pull(self, count, realms, wait)
+        if count is None:
+            count = config.client['count']
+        if realms is None:
+            nodes = [(node, None) for node in self._nodes()]
+        else:
+            nodes = [(node, [realms[i] for i in indexes])
+                     for node, indexes in self._split(realms, str)]
+        # each node is asked in turn, long polling each for up to a
+        # second once none of them has a job
+        deadline = time.time() + (wait or 0)
+        poll = None
+        while True:
+            jobs = {}
+            for node, rlms in nodes:
+                uri = "%s/job?count=%s" % (node, count - len(jobs))
+                if rlms is not None:
+                    uri += "&realms=%s" % ','.join(rlms)
+                if poll:
+                    uri += "&wait=%s" % poll
+                jobs.update(self.request('get', uri,
+                                         timeout=self.timeout + (poll or 0)))
+                if len(jobs) >= count:
+                    return jobs
+            remaining = deadline - time.time()
+            if jobs or remaining <= 0:
+                return jobs
+            poll = min(remaining, 1.0)
+    pull.__doc__ = BaseClient.pull.__doc__
+
     def __dir__(self):
         return list(Realms._reserved) + list(self.realms)
 
@@ -236,8 +662,274 @@ class Realms(MutableMapping, BaseClient):
             return super(Realms, self).__getattribute__(k)
         realm = self.realms.get(k, None)
         if realm is None:
-            realm = Realm(k, self._uri, requester=self._requester)
+            realm = self._realm(k)
             self.realms[k] = realm
         return realm
 
 Realms._reserved = set(dir(Realms))
+
+
+def _print_error(job_id, exc):
+    traceback.print_exc()
+
+
+class Consumer(object):
+    """Run handler(job_id, queue_id, data) over the jobs of a realm on a pool
+    of worker threads.
+
+    Jobs are pulled ahead of need into a local buffer the workers take them
+    from, and a job is acknowledged by removing it once its handler returns,
+    the removals sent in batches through bulk_remove.  In the steady state a
+    job costs a fraction of a request rather than a pull and a remove.
+
+        consumer = Consumer(realms['test'], handler, workers=8)
+        consumer.start()
+        ...
+        consumer.stop()
+
+    A job whose handler raises is passed to on_error(job_id, exc) and left
+    unacknowledged, to be handed out again once its lease runs out.
+
+    The buffer holds prefetch jobs beyond those being worked on, when
+    prefetch is not given it holds as many as the workers get through in
+    half the lease_time at the measured rate, capped at max_prefetch.
+    lease_time is that of the queues consumed.  The leases on the jobs held,
+    buffered or being worked on, are renewed in batches through bulk_renew
+    once less than a third of the lease_time is left, so lease_time can be
+    kept short for the jobs of a worker that dies to come back quickly.
+
+    executor, e.g. a concurrent.futures.ProcessPoolExecutor, runs the
+    handler when it is given, each worker thread waiting on its job.
+    """
+
+    def __init__(self, realm, handler, workers=None, prefetch=None,
+                 max_prefetch=None, lease_time=None, ack_batch_size=None,
+                 ack_interval=None, wait=None, max_queue=None, executor=None,
+                 on_error=None):
+        if workers is None:
+            workers = config.client['consumer_workers']
+        if max_prefetch is None:
+            max_prefetch = config.client['max_prefetch']
+        if lease_time is None:
+            lease_time = config.realms['default_lease_time']
+        if ack_batch_size is None:
+            ack_batch_size = config.client['ack_batch_size']
+        if ack_interval is None:
+            ack_interval = config.client['ack_interval']
+        if wait is None:
+            wait = config.client['consumer_wait']
+        self.realm = realm
+        self.handler = handler
+        self.workers = workers
+        self.prefetch = prefetch
+        self.max_prefetch = max_prefetch
+        self.lease_time = lease_time
+        self.lease_margin = lease_time / 3.0
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        self.wait = wait
+        self.max_queue = max_queue
+        self.executor = executor
+        self.on_error = on_error or _print_error
+        self.stats = dict(pulls=0, acks=0, renewals=0, releases=0, pulled=0,
+                          done=0, failed=0, expired=0, released=0)
+        self.rate = None
+        self._buffer = Queue()
+        self._cond = Condition()
+        self._held = {}     # job_id -> time its lease runs out
+        self._acks = []
+        self._ack_due = None
+        self._running = False
+        self._threads = []
+        self._pump_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        self.join()
+
+    def start(self):
+        """start pulling jobs and working on them"""
+        self._running = True
+        self._threads = [Thread(target=self._work) for _ in range(self.workers)]
+        self._pump_thread = Thread(target=self._pump)
+        for thread in self._threads + [self._pump_thread]:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """stop pulling jobs.  The jobs being worked on are finished, the
+        buffered jobs are released and the acknowledgements sent before the
+        consumer's threads exit"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """wait for the consumer to stop"""
+        if self._pump_thread is not None:
+            self._pump_thread.join(timeout)
+
+    def _target(self):
+        """the number of jobs to hold, being worked on or buffered"""
+        prefetch = self.prefetch
+        if prefetch is None:
+            prefetch = self.workers
+            if self.rate:
+                prefetch = int(self.rate * self.lease_time / 2)
+                prefetch = max(self.workers, min(self.max_prefetch, prefetch))
+        return self.workers + prefetch, self.workers + prefetch // 2
+
+    def _pump(self):
+        last, done = time.time(), 0
+        while self._running:
+            now = time.time()
+            if now - last >= 1.0:
+                # an exponentially weighted rate of jobs done per second
+                finished = self.stats['done'] + self.stats['failed']
+                rate = (finished - done) / (now - last)
+                self.rate = rate if self.rate is None else \
+                    0.7 * self.rate + 0.3 * rate
+                last, done = now, finished
+            try:
+                self._flush_acks()
+                self._renew_leases()
+                high, low = self._target()
+                if len(self._held) < low and \
+                        self._fill(high - len(self._held)):
+                    continue
+            except Exception as exc:
+                self.on_error(None, exc)
+            with self._cond:
+                if self._running:
+                    self._cond.wait(self._next_due())
+        self._release_buffered()
+        for _ in self._threads:
+            self._buffer.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._flush_acks(force=True)
+
+    def _next_due(self):
+        """seconds until acknowledgements or renewals are due to be sent"""
+        with self._cond:
+            due = time.time() + self.ack_interval
+            if self._ack_due is not None:
+                due = min(due, self._ack_due)
+            if self._held:
+                due = min(due, min(self._held.values()) - self.lease_margin)
+            return max(0.001, due - time.time())
+
+    def _fill(self, count):
+        """pull up to count jobs into the buffer, returns whether to go
+        straight on to the next pull"""
+        # long poll for jobs, but no longer than other requests can wait
+        wait = self.wait
+        if self._ack_due is not None or self._held:
+            wait = min(wait, self._next_due())
+        expires = time.time() + self.lease_time
+        jobs = self.realm.pull(count, max_queue=self.max_queue, wait=wait)
+        with self._cond:
+            self.stats['pulls'] += 1
+            self.stats['pulled'] += len(jobs)
+            for job_id in jobs:
+                self._held[job_id] = expires
+        for job_id, (queue_id, data) in jobs.items():
+            self._buffer.put((job_id, queue_id, data))
+        return bool(jobs) or bool(wait)
+
+    def _flush_acks(self, force=False):
+        with self._cond:
+            if not self._acks:
+                return
+            if not force and len(self._acks) < self.ack_batch_size and \
+                    time.time() < self._ack_due:
+                return
+            acks, self._acks, self._ack_due = self._acks, [], None
+        try:
+            self.realm.bulk_remove(acks)
+        except Exception:
+            with self._cond:
+                self._acks[:0] = acks
+                self._ack_due = time.time() + self.ack_interval
+            raise
+        with self._cond:
+            self.stats['acks'] += 1
+
+    def _renew_leases(self):
+        """renew the leases of the held jobs that are close to running out"""
+        with self._cond:
+            due = time.time() + self.lease_margin
+            job_ids = [job_id for job_id, expires in self._held.items()
+                       if expires <= due]
+        if not job_ids:
+            return
+        expires = time.time() + self.lease_time
+        result = self.realm.bulk_renew([(job_id, self.lease_time)
+                                        for job_id in job_ids])
+        lost = set(error['index'] for error in result['errors'])
+        with self._cond:
+            self.stats['renewals'] += 1
+            for i, job_id in enumerate(job_ids):
+                if job_id not in self._held:
+                    continue
+                if i in lost:
+                    # the lease ran out, the job may be handed to another
+                    del self._held[job_id]
+                else:
+                    self._held[job_id] = expires
+
+    def _release_buffered(self):
+        """release the jobs still buffered so they can be handed out again"""
+        job_ids = []
+        while not self._buffer.empty():
+            job_ids.append(self._buffer.get()[0])
+        with self._cond:
+            for job_id in job_ids:
+                self._held.pop(job_id, None)
+        if not job_ids:
+            return
+        try:
+            self.realm.bulk_release(job_ids)
+        except Exception as exc:
+            self.on_error(None, exc)
+            return
+        self.stats['releases'] += 1
+        self.stats['released'] += len(job_ids)
+
+    def _work(self):
+        while True:
+            item = self._buffer.get()
+            if item is None:
+                return
+            job_id, queue_id, data = item
+            with self._cond:
+                expires = self._held.get(job_id, None)
+            if expires is None or time.time() > expires:
+                # the lease was lost, the job may be handed to another
+                self._done(job_id, 'expired')
+                continue
+            try:
+                if self.executor is None:
+                    self.handler(job_id, queue_id, data)
+                else:
+                    self.executor.submit(self.handler, job_id, queue_id,
+                                         data).result()
+            except Exception as exc:
+                self.on_error(job_id, exc)
+                self._done(job_id, 'failed')
+            else:
+                self._done(job_id, 'done')
+
+    def _done(self, job_id, outcome):
+        with self._cond:
+            self.stats[outcome] += 1
+            self._held.pop(job_id, None)
+            if outcome == 'done':
+                if not self._acks:
+                    self._ack_due = time.time() + self.ack_interval
+                self._acks.append(job_id)
+            self._cond.notify()
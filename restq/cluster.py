@@ -0,0 +1,220 @@
+"""Spread realms across several restq nodes.
+
+Each node is started with the uris of all of the nodes in the cluster and
+its own uri (config.cluster, or 'restq web --cluster=URI,... --node=URI').
+Realms are consistently hashed onto the nodes by a HashRing, so adding a
+node only moves the realms that hash to it.  GET /cluster returns the nodes
+to clients, which send the calls on each realm straight to its owner.  A
+node answers a call on a realm it neither owns nor still holds with a 421
+naming the owner, and the client then learns the nodes again.
+
+To add a node, start it with the new list of nodes, POST the list to the
+/cluster of each of the other nodes and then POST /rebalance to them.  Each
+streams the jobs of the realms it no longer owns to their new owner and
+deletes them locally.  Jobs arrive at their new owner with their leases, due
+times and delivery counts, the leased jobs first.  A move that fails part way
+deletes the part copied, or raises MigrationError when it can't.
+"""
+import hashlib
+from bisect import bisect
+
+from restq import client
+from restq import config
+from restq import realms
+
+
+MISDIRECTED_REQUEST = 421
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """Consistent hashing of realm_ids onto nodes, each node placed at
+    replicas points around the ring to even out the share it owns"""
+
+    def __init__(self, nodes, replicas=None):
+        if replicas is None:
+            replicas = config.cluster['replicas']
+        self.nodes = []
+        for node in nodes:
+            if node not in self.nodes:
+                self.nodes.append(node)
+        self.replicas = replicas
+        points = sorted((_hash('%s#%d' % (node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, realm_id):
+        """return the node that realm_id belongs to"""
+        if not self._keys:
+            raise ValueError("There are no nodes in the ring")
+        i = bisect(self._keys, _hash(realm_id)) % len(self._keys)
+        return self._owners[i]
+
+
+def _split(uris):
+    return [uri.strip().rstrip('/') for uri in uris.split(',') if uri.strip()]
+
+
+_ring = None
+_node = None
+
+
+def configure(nodes=None, node=None):
+    """set the nodes of the cluster and the uri of this node, both default
+    to config.cluster.  With no nodes this is not part of a cluster."""
+    global _ring, _node
+    if nodes is None:
+        nodes = _split(config.cluster['nodes'])
+    if node is None:
+        node = config.cluster['node']
+    node = node.rstrip('/')
+    if nodes and node not in nodes:
+        raise ValueError("This node %s is not one of the nodes" % node)
+    _ring = HashRing(nodes) if nodes else None
+    _node = node
+
+
+def status():
+    """return the cluster as served by GET /cluster"""
+    if _ring is None:
+        return {'nodes': [], 'node': _node, 'replicas': 0}
+    return {'nodes': _ring.nodes, 'node': _node, 'replicas': _ring.replicas}
+
+
+def misdirected(realm_id):
+    """return the node to send calls on realm_id to when it isn't this one.
+    A realm still held here is served until it's rebalanced."""
+    if _ring is None:
+        return None
+    owner = _ring.owner(realm_id)
+    if owner == _node or realms.exists(realm_id):
+        return None
+    return owner
+
+
+def export_jobs(realm, job_ids=None, leased=None):
+    """yield the jobs of a realm as dicts for bulk_add, one per queue the
+    job is in.  A delayed job keeps its not_before, a job that has been
+    pulled its deliveries and a leased job the time it was leased_at.
+
+    The leased jobs are yielded first, so each is ahead of the jobs waiting
+    in its queue when they're added and its lease is kept, see
+    realms.Queue.push.  With leased True or False only the jobs that are,
+    or aren't, leased in a queue are yielded.  Only the jobs of job_ids are
+    yielded when it's given, those no longer in the realm are skipped.  The
+    realm must be held still, see migrate and iter_export."""
+    if job_ids is None:
+        job_ids = list(realm.jobs)
+    if leased is None:
+        for job in export_jobs(realm, job_ids, True):
+            yield job
+        for job in export_jobs(realm, job_ids, False):
+            yield job
+        return
+    for job_id in job_ids:
+        job = realm.jobs.get(job_id, None)
+        if job is None:
+            continue
+        tags = [realm._tag_ids[i] for i in realms.members(job.tags)]
+        for i in realms.members(job.queues):
+            queue_id = realm._queue_ids[i]
+            queue = realm.queues[queue_id]
+            leased_at = queue.leases.get(job_id, None)
+            if (leased_at is not None) != leased:
+                continue
+            out = dict(job_id=job_id, queue_id=queue_id, data=job.data,
+                       tags=tags)
+            not_before = queue.delays.get(job_id, None)
+            if not_before is not None:
+                out['not_before'] = not_before
+            if leased_at is not None:
+                out['leased_at'] = leased_at
+            deliveries = queue.deliveries.get(job_id, 0)
+            if deliveries:
+                out['deliveries'] = deliveries
+            yield out
+
+
+def iter_export(realm, size):
+    """yield the jobs of a realm as export_jobs does while it stays in use,
+    holding its lock shared for size jobs at a time.  Those removed on the
+    way are left out, those added are not included."""
+    with realm.lock.shared:
+        job_ids = list(realm.jobs)
+    for leased in (True, False):
+        for start in range(0, len(job_ids), size):
+            with realm.lock.shared:
+                jobs = list(export_jobs(realm, job_ids[start:start + size],
+                                        leased))
+            for job in jobs:
+                yield job
+
+
+def migrate(realm_id, uri):
+    """stream the jobs of realm_id to the node at uri and delete it here,
+    returns the result of adding them there.  Calls on the realm made while
+    it moves fail with RealmMoved.  If the move fails the copy on uri is
+    deleted and the realm stays here, MigrationError is raised when the
+    copy can't be deleted."""
+    realm = realms.get(realm_id)
+    target = client.Realm(realm_id, uri)
+    with realm.lock.exclusive:
+        # no call is in the realm and none will enter it from now on
+        realm.moved_to = uri
+    try:
+        if realm.durability != 'none':
+            target.set_durability(realm.durability)
+        target.set_default_lease_time(realm.default_lease_time)
+        if realm.retry_delay:
+            target.set_retry_delay(realm.retry_delay)
+        for queue_id, (max_deliveries, dead_letter_queue) in \
+                realm.queue_dead_letter.items():
+            target.set_queue_max_deliveries(queue_id, max_deliveries,
+                                            dead_letter_queue)
+        for queue_id, (retry_delay, backoff, max_retry_delay) in \
+                realm.queue_retry.items():
+            target.set_queue_retry_delay(queue_id, retry_delay, backoff,
+                                         max_retry_delay)
+        for queue_id, lease_time in realm.queue_lease_time.items():
+            target.set_queue_lease_time(queue_id, lease_time)
+        result = target.stream_add(export_jobs(realm))
+    except Exception as err:
+        realm.moved_to = None
+        if not _delete_copy(target):
+            raise MigrationError("Realm '%s' is partly copied to %s, "
+                                 "delete it there: %s" % (realm_id, uri, err))
+        raise
+    realms.delete(realm_id)
+    return result
+
+
+def _delete_copy(target):
+    """delete the realm copied to target, returns False if it can't"""
+    try:
+        target.delete()
+    except Exception:
+        return False
+    return True
+
+
+def rebalance():
+    """migrate the realms held here that another node owns to that node,
+    returns {realm_id: result, ...}"""
+    if _ring is None:
+        return {}
+    moved = {}
+    for realm in realms.current():
+        owner = _ring.owner(realm.realm_id)
+        if owner != _node:
+            moved[realm.realm_id] = migrate(realm.realm_id, owner)
+    return moved
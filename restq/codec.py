@@ -0,0 +1,122 @@
+"""Encoding of request and response bodies.
+
+JSON is encoded with the fastest of orjson, ujson and the stdlib json that is
+installed, each writes the same wire format.  msgpack, when installed, is a
+compact binary alternative, used for a request body sent with a Content-Type
+of application/msgpack and for a response when the request Accepts it.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+
+if orjson is not None:
+    _orjson_options = orjson.OPT_NON_STR_KEYS
+
+    def json_dumps(obj):
+        """return obj encoded as JSON bytes"""
+        try:
+            return orjson.dumps(obj, option=_orjson_options)
+        except TypeError:
+            # ints wider than 64 bits and the like
+            return json.dumps(obj).encode('utf-8')
+
+    def json_loads(data):
+        """return the object decoded from JSON bytes or text"""
+        return orjson.loads(data)
+
+elif ujson is not None:
+    def json_dumps(obj):
+        """return obj encoded as JSON bytes"""
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def json_loads(data):
+        """return the object decoded from JSON bytes or text"""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return ujson.loads(data)
+
+else:
+    def json_dumps(obj):
+        """return obj encoded as JSON bytes"""
+        return json.dumps(obj).encode('utf-8')
+
+    def json_loads(data):
+        """return the object decoded from JSON bytes or text"""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+def msgpack_dumps(obj):
+    """return obj encoded as msgpack bytes"""
+    if msgpack is None:
+        raise ValueError("msgpack is not installed")
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def msgpack_loads(data):
+    """return the object decoded from msgpack bytes"""
+    if msgpack is None:
+        raise ValueError("msgpack is not installed")
+    try:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except TypeError:
+            # msgpack older than 0.6.1 has no strict_map_key
+            return msgpack.unpackb(data, raw=False)
+    except ValueError:
+        raise
+    except Exception as exc:
+        raise ValueError("Bad msgpack data: %s" % exc)
+
+
+def content_type(header):
+    """return the codec to decode a body of the Content-Type header with,
+    bodies have always been read as JSON whatever their type claimed"""
+    mime = (header or '').split(';')[0].strip().lower()
+    if mime in MSGPACK_TYPES:
+        return MSGPACK
+    return JSON
+
+
+def accepted(header):
+    """return the content type to respond with given an Accept header, JSON
+    unless msgpack is installed and accepted"""
+    if msgpack is not None and header:
+        for mime in header.split(','):
+            if mime.split(';')[0].strip().lower() in MSGPACK_TYPES:
+                return MSGPACK
+    return JSON
+
+
+def dumps(obj, mime=JSON):
+    """return obj encoded as bytes of the mime content type"""
+    if mime == MSGPACK:
+        return msgpack_dumps(obj)
+    return json_dumps(obj)
+
+
+def loads(data, mime=JSON):
+    """return the object decoded from bytes of the mime content type"""
+    if mime == MSGPACK:
+        return msgpack_loads(data)
+    return json_loads(data)
@@ -15,23 +15,68 @@ values = dict(
                 host='127.0.0.1',
                 port=8586,
                 server='wsgiref',
+                max_wait=60,
+                ingest_batch_size=1000,
+                tag_page_size=1000,
+                workers=1,
                 ),
             realms=dict(
                 default_lease_time=60*10,
+                retry_delay=0,
+                max_retry_delay=3600.0,
+                dead_letter_queue='dead-letter',
+                durability='none',
+                journal_sync_interval=0.05,
+                snapshot_interval=1000000,
+                removal_batch_size=10000,
+                tag_retention=3600.0,
+                tag_retention_count=100000,
                 realms_config_root=_default_realm_config_root,
             ),
             cli=dict(
                 realm='default',
                 queue_id='0',
                 tags=[],
+                wait=0.0,
             ),
             client=dict(
                 uri='http://localhost:8586/',
                 count=5,
+                wire_format='json',
+                pool_size=10,
+                timeout=60.0,
+                pipeline_size=1000,
+                tag_page_size=1000,
+                consumer_workers=4,
+                max_prefetch=1000,
+                ack_batch_size=100,
+                ack_interval=1.0,
+                consumer_wait=10.0,
+            ),
+            cluster=dict(
+                nodes='',
+                node='',
+                replicas=64,
+            ),
+            replication=dict(
+                primary='',
+                backlog=100000,
+                batch_size=10000,
+                wait=10.0,
+                retry_interval=1.0,
+            ),
+            profiler=dict(
+                interval=0.005,
+                max_duration=300.0,
             ),
         )
 
 
+def load_yaml(f):
+    """load yaml from f, allowing the python tuples our files hold"""
+    return yaml.load(f, Loader=getattr(yaml, 'FullLoader', yaml.Loader))
+
+
 def _update_values(new):
     for interface, kwargs in new.items():
         values[interface].update(kwargs)
@@ -40,7 +85,7 @@ def _update_values(new):
 # Load the system configuration file 
 if os.path.exists('/etc/%s.yaml' % project):
     with open('/etc/%s.yaml' % project, 'r') as f:
-        _update_values(yaml.load(f))
+        _update_values(load_yaml(f))
 
 
 # Load the user configuration file, update config with its values or initialise 
@@ -48,7 +93,7 @@ if os.path.exists('/etc/%s.yaml' % project):
 _config_file_path = os.path.join(os.path.expanduser('~'), '.%s.yaml' % project)
 if os.path.exists(_config_file_path):
     with open(_config_file_path, 'r') as f:
-        _update_values(yaml.load(f))
+        _update_values(load_yaml(f))
 else:
     with open(_config_file_path, 'w') as f:
         yaml.dump(values, f, default_flow_style=False)
@@ -62,5 +107,5 @@ for interface, kwargs in values.items():
         kwargs[key] = value_type(os.environ.get(environ_key, value))
 
 
-for key, value in values.iteritems():
+for key, value in values.items():
     globals()[key] = value
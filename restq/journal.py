@@ -0,0 +1,183 @@
+"""Append-only log and snapshots of realm state.
+
+Every record in the log is a marshalled tuple prefixed by its length and
+crc32.  A torn record at the tail of the log (a crash mid write) is dropped
+on replay.  The first record of a log is ('generation', n), which ties the
+log to the snapshot it follows; a log older than the snapshot is ignored.
+
+A log is rotated when a snapshot is taken in the background, the previous
+log is kept beside it until the snapshot is on disk and is replayed first.
+"""
+import marshal
+import os
+import struct
+import zlib
+from threading import Event, Lock, Thread
+
+
+DURABILITY = ('none', 'batched', 'per-op')
+
+MARSHAL_VERSION = 2
+
+PREVIOUS = '.prev'
+
+_header = struct.Struct('<II')
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def read_snapshot(path):
+    """return the state stored at path or None if there is no snapshot"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return marshal.load(f)
+
+
+def write_snapshot(path, state):
+    """atomically replace the snapshot at path with state"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(state, f, MARSHAL_VERSION)
+        _fsync(f)
+    _replace(tmp_path, path)
+
+
+def remove(*paths):
+    """remove the files at paths, ignoring those that don't exist"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Journal(object):
+    """Append-only log of realm mutations.
+
+    durability selects when appended records are synced to disk:
+        per-op  - flush and fsync before append returns.
+        batched - a background thread flushes and fsyncs every
+                  sync_interval seconds, so all of the records appended in
+                  an interval share a single fsync (group commit).
+    """
+
+    def __init__(self, path, durability='batched', sync_interval=0.05):
+        if durability not in DURABILITY[1:]:
+            raise ValueError("Unknown journal durability '%s'" % durability)
+        self.path = path
+        self.previous_path = path + PREVIOUS
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.count = 0
+        self._file = None
+        self._dirty = False
+        self._lock = Lock()
+        self._closed = Event()
+        self._syncer = None
+
+    def replay(self):
+        """yield the records in the previous log, if it was kept, and then
+        the log, cutting any torn record at their tails"""
+        for path in (self.previous_path, self.path):
+            for record in self._replay(path):
+                yield record
+
+    def _replay(self, path):
+        if not os.path.exists(path):
+            return
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(_header.size)
+                if len(header) < _header.size:
+                    break
+                size, crc = _header.unpack(header)
+                payload = f.read(size)
+                if len(payload) < size or \
+                        zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                offset = f.tell()
+                self.count += 1
+                yield marshal.loads(payload)
+            f.seek(0, os.SEEK_END)
+            torn = f.tell() != offset
+        if torn:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+    def open(self):
+        """open the log for appending"""
+        self._file = open(self.path, 'ab')
+        if self.durability == 'batched':
+            self._syncer = Thread(target=self._sync_loop)
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def append(self, record):
+        """append record (a tuple) to the log"""
+        payload = marshal.dumps(record, MARSHAL_VERSION)
+        header = _header.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        with self._lock:
+            self._file.write(header + payload)
+            self.count += 1
+            if self.durability == 'per-op':
+                _fsync(self._file)
+            else:
+                self._dirty = True
+
+    def reset(self, generation):
+        """empty the log, it now follows the snapshot of generation"""
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self.count = 0
+        self.drop_previous()
+        self.append(('generation', generation))
+        self.sync()
+
+    def rotate(self, generation):
+        """keep the log as the previous log and start an empty one for the
+        snapshot of generation, which is yet to be written"""
+        with self._lock:
+            _fsync(self._file)
+            self._file.close()
+            _replace(self.path, self.previous_path)
+            self._file = open(self.path, 'ab')
+            self.count = 0
+        self.append(('generation', generation))
+
+    def has_previous(self):
+        """return whether a previous log is kept"""
+        return os.path.exists(self.previous_path)
+
+    def drop_previous(self):
+        """remove the previous log once its snapshot is on disk"""
+        remove(self.previous_path)
+
+    def sync(self):
+        """flush and fsync any appended records"""
+        with self._lock:
+            self._dirty = False
+            self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """sync and close the log"""
+        self._closed.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            if self._dirty:
+                self.sync()
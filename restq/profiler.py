@@ -0,0 +1,132 @@
+"""Sample the stacks of the threads serving restq while it runs.
+
+POST /profile starts a Sampler, which wakes every interval seconds to record
+where each of the other threads is, until DELETE /profile stops it or
+config.profiler['max_duration'] seconds pass.  The stacks are returned in the
+folded format flamegraph.pl and speedscope read, one stack per line with its
+frames from the outermost in, separated by ';', and the number of samples
+that caught it:
+
+    MainThread;server.py:serve_forever;webapp.py:pull_jobs 12
+
+Nothing is done between samples, so the cost is one walk of the stacks each
+interval.
+"""
+import os
+import sys
+import threading
+import time
+from threading import Event, Lock, Thread
+
+from restq import config
+
+
+class Sampler(Thread):
+    """Count the stacks the other threads are in every interval seconds for
+    up to duration seconds"""
+
+    def __init__(self, interval=None, duration=None):
+        Thread.__init__(self, name='restq-profiler')
+        self.daemon = True
+        if interval is None:
+            interval = config.profiler['interval']
+        if duration is None:
+            duration = config.profiler['max_duration']
+        if not 0 < interval <= 10:
+            raise ValueError("interval must be between 0 and 10 seconds")
+        self.interval = interval
+        self.duration = min(duration, config.profiler['max_duration'])
+        self.started = time.time()
+        self.samples = 0
+        self.stacks = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self._frames = {}
+
+    def run(self):
+        deadline = self.started + self.duration
+        while not self.stopped.wait(self.interval):
+            if time.time() >= deadline:
+                break
+            self.sample()
+        self.stopped.set()
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-%s' % ident))
+            stack.reverse()
+            stacks.append(';'.join(stack))
+        with self.lock:
+            self.samples += 1
+            for stack in stacks:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def _frame(self, code):
+        # the names of the code objects seen are kept, they're seen again
+        name = self._frames.get(code)
+        if name is None:
+            name = '%s:%s' % (os.path.basename(code.co_filename),
+                              code.co_name)
+            self._frames[code] = name
+        return name
+
+    def folded(self):
+        """return the stacks sampled so far in the folded format"""
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return ''.join('%s %d\n' % stack for stack in stacks)
+
+    def status(self):
+        return dict(running=not self.stopped.is_set(), started=self.started,
+                    interval=self.interval, duration=self.duration,
+                    samples=self.samples)
+
+
+_sampler = None
+_sampler_lock = Lock()
+
+
+def start(interval=None, duration=None):
+    """start sampling the stacks of this process, returns the status of the
+    sampler.  raises a ValueError if a sampler is already running."""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is not None and not _sampler.stopped.is_set():
+            raise ValueError("The profiler is already running")
+        _sampler = Sampler(interval, duration)
+        _sampler.start()
+        return _sampler.status()
+
+
+def stop():
+    """stop sampling, returns the folded stacks that were sampled"""
+    with _sampler_lock:
+        sampler = _sampler
+    if sampler is None:
+        return ''
+    sampler.stopped.set()
+    sampler.join()
+    return sampler.folded()
+
+
+def folded():
+    """return the folded stacks sampled by the running, or last, sampler"""
+    sampler = _sampler
+    return '' if sampler is None else sampler.folded()
+
+
+def status():
+    """return {running, started, interval, duration, samples} of the running,
+    or last, sampler, or {'running': False} if there hasn't been one"""
+    sampler = _sampler
+    if sampler is None:
+        return {'running': False}
+    return sampler.status()
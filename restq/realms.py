@@ -3,34 +3,680 @@ import pprint
 import sys
 import time
 import yaml
+import zlib
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
-from itertools import takewhile
-from threading import Lock
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop, heappush, merge
+from itertools import islice
+from threading import Condition, Lock, Thread
 
 from restq import config
+from restq import journal
+from restq import stats
 
 
 if sys.version_info[0] < 3:
     dictiter = lambda d: d.iteritems()
+    from itertools import izip as zip
+    number_types = (int, long, float)
+    integer_types = (int, long)
 else:
     dictiter = lambda d: iter(d.items())
+    number_types = (int, float)
+    integer_types = (int,)
     iternext = lambda i: i.__next__()
 
 
-# Serialise access to functions of Jobs
+class _LockSide(object):
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class RWLock(object):
+    """A lock held shared by any number of readers or exclusively by one
+    writer, use as 'with lock.shared:' or 'with lock.exclusive:'.
+
+    A waiting writer holds back new readers so it can't be starved.  Neither
+    side is reentrant.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self.shared = _LockSide(self.acquire_shared, self.release_shared)
+        self.exclusive = _LockSide(self.acquire_exclusive,
+                                   self.release_exclusive)
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class Signal(object):
+    """Wakes the threads waiting for jobs to become available.
+
+    Read version before looking for jobs and pass it to wait, a notify made
+    in between is then not missed.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._waiters = 0
+        self.version = 0
+
+    def notify(self):
+        with self._cond:
+            self.version += 1
+            if self._waiters:
+                self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """wait up to timeout seconds for a notify made after version"""
+        with self._cond:
+            if self.version != version:
+                return
+            self._waiters += 1
+            try:
+                self._cond.wait(timeout)
+            finally:
+                self._waiters -= 1
+
+
+# Notified whenever jobs are added or moved in any realm.  A lease expiring
+# is not notified, waiters time out on the next expiry instead.
+jobs_available = Signal()
+
+
+def wait_for_jobs(pull, wait, next_expiry):
+    """call pull until it returns jobs or wait seconds have passed"""
+    deadline = time.time() + wait
+    while True:
+        version = jobs_available.version
+        jobs = pull()
+        now = time.time()
+        if jobs or now >= deadline:
+            return jobs
+        timeout = deadline - now
+        expiry = next_expiry()
+        if expiry is not None:
+            timeout = max(0.001, min(timeout, expiry - now))
+        jobs_available.wait(version, timeout)
+
+
+class RealmMoved(Exception):
+    """raised by a call on a realm that has been migrated to another node"""
+
+
+class ReadOnlyRealm(Exception):
+    """raised by a call that would change a realm replicated from another
+    node, see restq.replication"""
+
+
+TAG_FIELDS = ('ids', 'status', 'data')
+
+# the most tags whose sorted job_ids are kept for get_tagged_page
+TAG_PAGE_SNAPSHOTS = 16
+
+
+def _check_fields(fields):
+    if fields not in TAG_FIELDS:
+        raise ValueError("fields must be one of %s" % ', '.join(TAG_FIELDS))
+
+
+# Serialise access to functions that modify the jobs, tags or queues of a
+# Realm.  The realm is checkpointed while it's still held exclusively.  Each
+# call is timed in realm.stats under the function's name.
 def serialise(func):
+    op = func.__name__.lstrip('_')
     @wraps(func)
     def with_serialisation(self, *a, **k):
-        with self.lock:
-            return func(self, *a, **k)
+        start = stats.clock()
+        with self.lock.exclusive:
+            acquired = stats.clock()
+            try:
+                if self.moved_to is not None:
+                    raise RealmMoved("Realm '%s' moved to %s" %
+                                     (self.realm_id, self.moved_to))
+                if self.replica_of is not None:
+                    raise ReadOnlyRealm("Realm '%s' is a replica of %s" %
+                                        (self.realm_id, self.replica_of))
+                result = func(self, *a, **k)
+                self._checkpoint()
+                return result
+            finally:
+                done = stats.clock()
+                realm_stats = self.stats
+                realm_stats.lock_wait.observe(acquired - start)
+                realm_stats.lock_hold.observe(done - acquired)
+                realm_stats.op(op).observe(done - start)
     return with_serialisation
 
 
-JOB_DATA = 0
-JOB_TAGS = 1
-JOB_QUEUES = 2
+# Share access to functions that only read the jobs, tags and queues of a
+# Realm.  They must take a Queue's lock to read or update its leases.
+def shared(func):
+    op = func.__name__.lstrip('_')
+    @wraps(func)
+    def with_shared_access(self, *a, **k):
+        start = stats.clock()
+        try:
+            with self.lock.shared:
+                if self.moved_to is not None:
+                    raise RealmMoved("Realm '%s' moved to %s" %
+                                     (self.realm_id, self.moved_to))
+                return func(self, *a, **k)
+        finally:
+            self.stats.op(op).observe(stats.clock() - start)
+    return with_shared_access
+
+
+def queue_key(queue_id):
+    """return the key queue ids are sorted on to prioritise pulls, numbers
+    sort before any other type of id as they did under python 2"""
+    if isinstance(queue_id, number_types):
+        return (0, queue_id)
+    return (1, queue_id)
+
+
+def _bisect_key(ids, key):
+    """return the index in ids, sorted by queue_key, of the first id with a
+    queue_key above key"""
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < queue_key(ids[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class Job(object):
+    """A job's data and the tags and queues it is in.
+
+    Tag and queue ids are interned by the realm as small ints.  Membership is
+    held as a single interned id, by far the common case, or as a tuple of
+    them, so a job costs one small object rather than a tuple and two sets.
+    Use members, with_member and without_member to work with it.
+    """
+    __slots__ = ('data', 'tags', 'queues')
+
+    def __init__(self, data, tags=(), queues=()):
+        self.data = data
+        self.tags = tags
+        self.queues = queues
+
+
+def members(ids):
+    """return a tuple of the ids held in a membership field of a Job"""
+    if type(ids) is tuple:
+        return ids
+    return (ids,)
+
+def with_member(ids, i):
+    """return membership ids with i added"""
+    if type(ids) is not tuple:
+        return ids if ids == i else (ids, i)
+    if not ids:
+        return i
+    return ids if i in ids else ids + (i,)
+
+def without_member(ids, i):
+    """return membership ids with i removed"""
+    if type(ids) is not tuple:
+        return () if ids == i else ids
+    ids = tuple([x for x in ids if x != i])
+    return ids[0] if len(ids) == 1 else ids
+
+
+class Queue(object):
+    """The jobs of a single queue, indexed so a pull does not have to scan.
+
+    Each job is given a sequence number as it enters the queue, its index in
+    order.  Jobs that have never been handed out sit in the fresh region
+    [head, len(order)) of order.  Checked out jobs are held in the leased
+    min-heap on their dequeue time, and once a lease expires the job's seq is
+    pushed onto the returned min-heap so it is handed out again in its
+    original queue order.  As every returned seq is below head, returned jobs
+    always go out before fresh ones.
+
+    Removed jobs leave a None in order, and heap entries are never removed in
+    place; an entry is stale (and skipped) once it no longer agrees with order
+    and leases.  The queue is renumbered once the holes and stale entries
+    outweigh the jobs in it.
+
+    The time jobs entered the queue is marked at most once a second, as the
+    seq of the first job pushed in that second, to tell the age of the
+    oldest job waiting in it.
+
+    A job that can't be handed out before a time is held out of order, with
+    no seq, in the delayed min-heap on that time.  A pull first appends the
+    delayed jobs that are due to order, so it never looks at the rest.
+
+    The times each job has been handed out are counted in deliveries, which
+    only holds the jobs pulled at least once.
+    """
+    __slots__ = ('jobs', 'order', 'head',
+                 'leases', 'expired', 'leased', 'returned', 'lock',
+                 'delays', 'delayed', 'tickets', 'retrying', 'deliveries',
+                 'mark_seqs', 'mark_times', 'stats')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats = stats.QueueStats()
+        self.clear()
+
+    def clear(self):
+        """remove all jobs, recreating the indexes to release their mem"""
+        self.jobs = {}      # job_id -> seq, None while delayed
+        self.order = []     # seq -> job_id
+        self.head = 0
+        self.leases = {}    # job_id -> dequeue time of a current lease
+        self.expired = {}   # job_id -> dequeue time of an expired lease
+        self.leased = []    # heap of (dequeue time, seq)
+        self.returned = []  # heap of seq
+        self.delays = {}    # job_id -> time a delayed job is due
+        self.delayed = []   # heap of (due time, ticket, job_id)
+        self.tickets = 0    # orders the delayed jobs due at the same time
+        self.retrying = 0   # the expired jobs that are delayed
+        self.deliveries = {}  # job_id -> times it was pulled
+        self.mark_seqs = []
+        self.mark_times = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def dump(self):
+        """return the state of the queue for a snapshot"""
+        order = self.order
+        checked_out = len(self.jobs) - len(self.delays) - \
+            len([j for j in order[self.head:] if j is not None])
+        return [j for j in order if j is not None], checked_out, \
+            self.leases, self.expired, self.delays, self.deliveries
+
+    def load(self, job_ids, checked_out, leases, expired, delays=None,
+             deliveries=None):
+        """restore the state of the queue from a snapshot"""
+        self.clear()
+        if deliveries:
+            self.deliveries = deliveries
+        self.order = list(job_ids)
+        self.jobs = dict((job_id, seq) for seq, job_id in enumerate(job_ids))
+        if delays:
+            self.delays = delays
+            for job_id, due in dictiter(delays):
+                self.jobs[job_id] = None
+                self.tickets += 1
+                self.delayed.append((due, self.tickets, job_id))
+                if job_id in expired:
+                    self.retrying += 1
+            heapify(self.delayed)
+        if job_ids:
+            # the jobs are taken to have entered the queue now
+            self.mark_seqs.append(0)
+            self.mark_times.append(time.time())
+        self.head = checked_out
+        self.leases = leases
+        self.expired = expired
+        jobs = self.jobs
+        self.leased = [(t, jobs[job_id]) for job_id, t in dictiter(leases)]
+        heapify(self.leased)
+        self.returned = [seq for seq in range(checked_out)
+                         if job_ids[seq] not in leases]
+
+    def counts(self, lease_time, ctime):
+        """return (total, available, leased, expired, delayed) job counts at
+        ctime.  Each job is available, leased or delayed, and the expired
+        jobs are those available to pull again since their leases ran out.
+        An expired job waiting out a retry delay is counted as delayed.
+
+        Each is kept as the size of the queue's indexes, only the leases that
+        have run out since the queue was last pulled are counted, by walking
+        the top of the leased heap.  It is safe to call without the lock,
+        the counts may then be off by the jobs that change as they're taken.
+        """
+        leased = self.leased
+        leases = self.leases
+        order = self.order
+        cutoff = ctime - lease_time
+        overdue = 0
+        stack = [0]
+        try:
+            while stack:
+                i = stack.pop()
+                if i >= len(leased) or leased[i][0] >= cutoff:
+                    continue
+                dequeue_time, seq = leased[i]
+                if leases.get(order[seq], None) == dequeue_time:
+                    overdue += 1
+                stack.append(2 * i + 1)
+                stack.append(2 * i + 2)
+        except IndexError:
+            # the heap or order was rebuilt under us
+            pass
+        total = len(self.jobs)
+        leased = max(0, len(leases) - overdue)
+        delayed = len(self.delays)
+        return total, max(0, total - leased - delayed), leased, \
+            max(0, len(self.expired) - self.retrying) + overdue, delayed
+
+    def __contains__(self, job_id):
+        return job_id in self.jobs
+
+    def __iter__(self):
+        return iter(self.jobs)
+
+    def checkout_time(self, job_id):
+        """return the time job_id was last dequeued, 0 if never"""
+        checkout_time = self.leases.get(job_id, None)
+        if checkout_time is None:
+            checkout_time = self.expired.get(job_id, 0)
+        return checkout_time
+
+    def push(self, job_id, not_before=None, leased_at=None, deliveries=0):
+        """append job_id to the end of the queue if it isn't already in it,
+        or once it's pulled at or after not_before when that's given.
+
+        A job moved from another queue keeps the times it was delivered
+        and its lease, taken at leased_at.  The lease is kept only while no
+        job waits to be handed out ahead of it, otherwise the job waits its
+        turn like the rest."""
+        if job_id in self.jobs:
+            return
+        self.stats.enqueued += 1
+        if deliveries:
+            self.deliveries[job_id] = deliveries
+        if not_before is not None:
+            self.jobs[job_id] = None
+            self._delay(job_id, not_before)
+            return
+        self._append(job_id)
+        seq = self.jobs[job_id]
+        if leased_at is not None and self.head == seq:
+            self.head += 1
+            self.leases[job_id] = leased_at
+            heappush(self.leased, (leased_at, seq))
+
+    def _delay(self, job_id, not_before):
+        self.delays[job_id] = not_before
+        self.tickets += 1
+        heappush(self.delayed, (not_before, self.tickets, job_id))
+
+    def _append(self, job_id):
+        seq = len(self.order)
+        self.jobs[job_id] = seq
+        self.order.append(job_id)
+        now = time.time()
+        if not self.mark_times or now - self.mark_times[-1] >= 1:
+            self.mark_seqs.append(seq)
+            self.mark_times.append(now)
+
+    def remove(self, job_id):
+        """remove job_id from the queue, a leased job counts as acked"""
+        self.remove_many((job_id,))
+
+    def remove_many(self, job_ids):
+        """remove the job_ids from the queue, renumbering it at most once"""
+        jobs = self.jobs
+        order = self.order
+        leases = self.leases
+        expired = self.expired
+        deliveries = self.deliveries
+        observe = self.stats.deliveries.observe
+        acked = 0
+        for job_id in job_ids:
+            seq = jobs.pop(job_id)
+            if seq is None:
+                del self.delays[job_id]
+                if job_id in expired:
+                    self.retrying -= 1
+            else:
+                order[seq] = None
+            if leases.pop(job_id, None) is not None:
+                acked += 1
+            expired.pop(job_id, None)
+            delivered = deliveries.pop(job_id, None)
+            if delivered is not None:
+                observe(delivered)
+        self.stats.acked += acked
+        if not jobs:
+            self.clear()
+        else:
+            self._maybe_compact()
+
+    def available(self, lease_time, ctime):
+        """return True if a pull at ctime may find a job.  It is safe to call
+        without the lock, it is then only a hint."""
+        leased = self.leased
+        delayed = self.delayed
+        try:
+            return bool(self.returned) or self.head < len(self.order) or \
+                (bool(leased) and ctime - leased[0][0] > lease_time) or \
+                (bool(delayed) and delayed[0][0] <= ctime)
+        except IndexError:
+            # leased was emptied under us
+            return False
+
+    def expire(self, lease_time, ctime, expired_ids=None, retry_delay=0,
+               max_deliveries=0, exhausted_ids=None, backoff=None):
+        """return jobs with leases older than lease_time to the queue,
+        appending their job_ids to expired_ids.  With a retry_delay they
+        are delayed until retry_delay seconds after their lease ran out, with
+        a backoff=(factor, max_retry_delay) multiplied by factor for each
+        time the job was handed out before, up to max_retry_delay.  Jobs
+        handed out max_deliveries times are taken out of the queue and
+        appended to exhausted_ids instead.  returns the number of heap
+        entries scanned"""
+        leased = self.leased
+        queue_stats = self.stats
+        scanned = expired = 0
+        while leased and ctime - leased[0][0] > lease_time:
+            dequeue_time, seq = heappop(leased)
+            scanned += 1
+            job_id = self.order[seq]
+            if job_id is None or self.leases.get(job_id, None) != dequeue_time:
+                continue
+            del self.leases[job_id]
+            expired += 1
+            delivered = self.deliveries.get(job_id, 1)
+            if max_deliveries and delivered >= max_deliveries:
+                self.order[seq] = None
+                del self.jobs[job_id]
+                self.deliveries.pop(job_id, None)
+                self.expired.pop(job_id, None)
+                queue_stats.dead_lettered += 1
+                queue_stats.deliveries.observe(delivered)
+                if exhausted_ids is not None:
+                    exhausted_ids.append(job_id)
+                continue
+            self.expired[job_id] = dequeue_time
+            if retry_delay:
+                self.order[seq] = None
+                self.jobs[job_id] = None
+                self.retrying += 1
+                delay = retry_delay
+                if backoff and delivered > 1:
+                    factor, max_retry_delay = backoff
+                    try:
+                        delay = min(retry_delay * factor ** (delivered - 1),
+                                    max_retry_delay)
+                    except OverflowError:
+                        delay = max_retry_delay
+                self._delay(job_id, dequeue_time + lease_time + delay)
+            else:
+                heappush(self.returned, seq)
+            if expired_ids is not None:
+                expired_ids.append(job_id)
+        queue_stats.expired += expired
+        return scanned
+
+    def promote(self, ctime, promoted_ids=None):
+        """append the delayed jobs due by ctime to the queue, and to
+        promoted_ids.  returns the number of heap entries scanned"""
+        delayed = self.delayed
+        delays = self.delays
+        scanned = 0
+        while delayed and delayed[0][0] <= ctime:
+            due, _, job_id = heappop(delayed)
+            scanned += 1
+            if delays.get(job_id, None) != due:
+                continue
+            del delays[job_id]
+            if job_id in self.expired:
+                self.retrying -= 1
+            self._append(job_id)
+            if promoted_ids is not None:
+                promoted_ids.append(job_id)
+        return scanned
+
+    def pull(self, count, lease_time, ctime, expired_ids=None,
+             retry_delay=0, promoted_ids=None, max_deliveries=0,
+             exhausted_ids=None, backoff=None):
+        """check out a max of count jobs, returns a list of job_ids.  The
+        jobs whose leases ran out are appended to expired_ids, or to
+        exhausted_ids once handed out max_deliveries times, see expire, and
+        the delayed jobs that came due to promoted_ids."""
+        scanned = self.expire(lease_time, ctime, expired_ids, retry_delay,
+                              max_deliveries, exhausted_ids, backoff)
+        scanned += self.promote(ctime, promoted_ids)
+        job_ids = []
+        order = self.order
+        returned = self.returned
+        while returned and len(job_ids) < count:
+            seq = heappop(returned)
+            scanned += 1
+            job_id = order[seq]
+            if job_id is not None:
+                self._checkout(job_id, seq, ctime)
+                job_ids.append(job_id)
+        tail = len(order)
+        head = self.head
+        while head < tail and len(job_ids) < count:
+            seq = head
+            head += 1
+            job_id = order[seq]
+            if job_id is not None:
+                self._checkout(job_id, seq, ctime)
+                job_ids.append(job_id)
+        scanned += head - self.head
+        self.head = head
+        queue_stats = self.stats
+        queue_stats.dequeued += len(job_ids)
+        queue_stats.scanned.observe(scanned)
+        return job_ids
+
+    def oldest_age(self, ctime):
+        """return the seconds the oldest job waiting to be pulled has been in
+        the queue, to within a second.  It is safe to call without the
+        lock."""
+        try:
+            if self.returned:
+                seq = self.returned[0]
+            elif self.head < len(self.order):
+                seq = self.head
+            else:
+                return 0
+            i = bisect_right(self.mark_seqs, seq) - 1
+            return ctime - self.mark_times[i] if i >= 0 else 0
+        except IndexError:
+            # emptied under us
+            return 0
+
+    def renew(self, job_id, dequeue_time, lease_time, ctime):
+        """move the lease held on job_id at ctime to dequeue_time, returns
+        False if it isn't leased"""
+        current = self.leases.get(job_id, None)
+        if current is None or ctime - current > lease_time:
+            return False
+        self.leases[job_id] = dequeue_time
+        heappush(self.leased, (dequeue_time, self.jobs[job_id]))
+        self._maybe_compact()
+        return True
+
+    def release(self, job_id, lease_time, ctime, delivered=True):
+        """end the lease held on job_id at ctime, handing the job out again
+        in its queue order.  delivered=False takes back the delivery and
+        dequeue the pull counted, for a job that never reached a worker.
+        returns False if it isn't leased"""
+        current = self.leases.get(job_id, None)
+        if current is None or ctime - current > lease_time:
+            return False
+        del self.leases[job_id]
+        heappush(self.returned, self.jobs[job_id])
+        if not delivered:
+            count = self.deliveries.pop(job_id, 0) - 1
+            if count > 0:
+                self.deliveries[job_id] = count
+            self.stats.dequeued -= 1
+        return True
+
+    def _checkout(self, job_id, seq, ctime):
+        self.expired.pop(job_id, None)
+        self.deliveries[job_id] = self.deliveries.get(job_id, 0) + 1
+        self.leases[job_id] = ctime
+        heappush(self.leased, (ctime, seq))
+
+    def _maybe_compact(self):
+        """renumber the queue if it is mostly holes or stale heap entries"""
+        live = len(self.jobs)
+        if len(self.order) > 2 * live + 64 or \
+                len(self.leased) + len(self.returned) + len(self.delayed) > \
+                2 * live + 64:
+            marks = self._renumbered_marks()
+            self.load(*self.dump())
+            self.mark_seqs, self.mark_times = marks
+
+    def _renumbered_marks(self):
+        """return the marks as they'll be once the holes are dropped, each
+        mark moves to the first job left after it"""
+        seqs, times = [], []
+        mark_seqs, mark_times = self.mark_seqs, self.mark_times
+        live = i = 0
+        for seq, job_id in enumerate(self.order):
+            while i < len(mark_seqs) and mark_seqs[i] <= seq:
+                if seqs and seqs[-1] == live:
+                    # only the latest mark is kept for a job
+                    times[-1] = mark_times[i]
+                else:
+                    seqs.append(live)
+                    times.append(mark_times[i])
+                i += 1
+            if job_id is not None:
+                live += 1
+        return seqs, times
 
 
 class Realm:
@@ -38,58 +684,244 @@ class Realm:
         self.realm_id = realm_id
         self.queues = {}
         self.queue_lease_time = {}
+        # queue_id -> (max_deliveries, dead-letter queue_id)
+        self.queue_dead_letter = {}
+        # the dead-letter queues, pulled by their queue_id alone
+        self._dead_queues = frozenset()
+        # queue_id -> (retry_delay, backoff, max_retry_delay)
+        self.queue_retry = {}
+        self._dead_lettered = {}    # queue_id -> jobs dead-lettered from it
         self.default_lease_time = config.realms['default_lease_time']
+        self.retry_delay = config.realms['retry_delay']
         self.tags = {}
         self.jobs = {}
-        self.lock = Lock()
-        p = os.path.join(config.realms['realms_config_root'],
-                            realm_id + ".realm")
-        self.realm_config_path = p
+        # interned tag and queue ids, see Job
+        self._tag_index = {}
+        self._tag_ids = []
+        self._free_tag_ints = []
+        # the counts of each tag's jobs, see get_tag_status
+        self._tag_queues = []       # tag int -> {queue_id: [total, leased,
+        #                                         delayed]}
+        self._tag_completed = {}    # tag_id -> jobs removed
+        self._done_tags = OrderedDict()  # tag_id -> (removed, emptied time)
+        self._tag_pages = OrderedDict()  # tag_id -> sorted job_ids
+        self._tag_lock = Lock()
+        self._queue_index = {}
+        self._queue_ids = []
+        # queue_key of each queue with jobs in it, sorted in pull order
+        self._ready = []
+        self.lock = RWLock()
+        self.stats = stats.RealmStats()
+        # the node the realm was migrated to, see restq.cluster
+        self.moved_to = None
+        # the primary the realm is replicated from and the log of changes
+        # kept for its own replicas, see restq.replication
+        self.replica_of = None
+        self._changes = None
+        self._config_held = False
+        self._config_dirty = False
+        self.durability = config.realms['durability']
+        self._journal = None
+        self._generation = 0
+        self._snapshotter = None    # the thread writing a snapshot out
+        p = os.path.join(config.realms['realms_config_root'], realm_id)
+        self.realm_config_path = p + ".realm"
+        self.journal_path = p + ".journal"
+        self.snapshot_path = p + ".snapshot"
         self._load_config()
+        if self.durability != 'none':
+            self._open_journal()
 
-    def _remove_from_tags(self, job_id):
-        """Remove jobs from tags"""
-        job = self.jobs.get(job_id, None)
-        if job is not None:
-            for tag_id in job[JOB_TAGS]:
-                tag = self.tags[tag_id]
-                tag.remove(job_id)
-                if not tag:
-                    self.tags.pop(tag_id)
-
-    def _remove_from_queues(self, job_id):
-        """Remove job from queues"""
-        job = self.jobs.get(job_id, None)
-        if job is not None:
-            for queue_id in job[JOB_QUEUES]:
-                queue = self.queues[queue_id]
-                queue.pop(job_id)
-            # recreate dict to release mem from large allocations
-            if not len(queue):
-                self.queues[queue_id] = OrderedDict()
+    def _intern_tag(self, tag_id):
+        """return the interned int of tag_id, creating the tag if needed"""
+        i = self._tag_index.get(tag_id, None)
+        if i is None:
+            if self._free_tag_ints:
+                i = self._free_tag_ints.pop()
+            else:
+                i = len(self._tag_ids)
+                self._tag_ids.append(None)
+                self._tag_queues.append(None)
+            self._tag_ids[i] = tag_id
+            self._tag_queues[i] = {}
+            self._tag_index[tag_id] = i
+            self.tags[tag_id] = set()
+            done = self._done_tags.pop(tag_id, None)
+            if done is not None:
+                # a batch that was finished is carried on
+                self._tag_completed[tag_id] = done[0]
+        return i
+
+    def _release_tag(self, tag_id):
+        """remove an empty tag and free its interned int, its count of
+        removed jobs is kept for config.realms['tag_retention'] seconds"""
+        self.tags.pop(tag_id)
+        with self._tag_lock:
+            # the snapshots are kept by pages outside of the realm lock
+            self._tag_pages.pop(tag_id, None)
+        i = self._tag_index.pop(tag_id)
+        self._tag_ids[i] = None
+        self._tag_queues[i] = None
+        self._free_tag_ints.append(i)
+        completed = self._tag_completed.pop(tag_id, 0)
+        done = self._done_tags
+        now = time.time()
+        done[tag_id] = (completed, now)
+        cutoff = now - config.realms['tag_retention']
+        while done and (len(done) > config.realms['tag_retention_count'] or
+                        next(iter(done.values()))[1] < cutoff):
+            done.popitem(last=False)
+
+    def _count_tags(self, job, queue_id, total, leased, delayed=0):
+        """add total, leased and delayed to the counts of queue_id of each of
+        job's tags"""
+        for i in members(job.tags):
+            self._count_tag(i, queue_id, total, leased, delayed)
+    def _count_tag(self, i, queue_id, total, leased, delayed=0):
+        queues = self._tag_queues[i]
+        counts = queues.get(queue_id, None)
+        if counts is None:
+            counts = queues[queue_id] = [0, 0, 0]
+        counts[0] += total
+        counts[1] += leased
+        counts[2] += delayed
+        if not counts[0]:
+            del queues[queue_id]
+
+    def _index_queue(self, queue_id):
+        """add or drop queue_id from the ready index as it fills or empties"""
+        key = queue_key(queue_id)
+        ready = self._ready
+        i = bisect_left(ready, key)
+        indexed = i < len(ready) and ready[i] == key
+        if len(self.queues[queue_id]):
+            if not indexed:
+                ready.insert(i, key)
+        elif indexed:
+            del ready[i]
 
     @serialise
     def remove_job(self, job_id):
         """remove job_id from the system"""
         self._remove_job(job_id)
+        self._log('remove_job', job_id)
     def _remove_job(self, job_id):
-        # remove from queues
-        self._remove_from_queues(job_id)
-        # remove from tags
-        self._remove_from_tags(job_id)
-        # remove the job
-        self.jobs.pop(job_id)
+        if not self._remove_jobs((job_id,)):
+            raise KeyError(job_id)
 
-    @serialise
     def remove_tagged_jobs(self, tag_id):
         """remove all jobs related to this tag_id"""
-        tag = self.tags[tag_id]
-        for job_id in [i for i in tag]:
-            self._remove_job(job_id)
+        for _ in self.iter_remove_tagged_jobs(tag_id):
+            pass
+
+    def iter_remove_tagged_jobs(self, tag_id, size=None):
+        """return an iterator that removes the jobs tagged by tag_id size at
+        a time (default: config.realms['removal_batch_size']), taking the
+        realm for each slice alone, and yields (removed, remaining) after
+        each.  Jobs tagged while it runs are removed with the rest."""
+        if size is None:
+            size = config.realms['removal_batch_size']
+        before = len(self.jobs)
+        self._tag_size(tag_id)
+        return self._iter_slices(
+            lambda: self._remove_tag_slice(tag_id, size, before))
+    @shared
+    def _tag_size(self, tag_id):
+        return len(self.tags[tag_id])
+    @serialise
+    def _remove_tag_slice(self, tag_id, size, before):
+        tag = self.tags.get(tag_id, None)
+        if tag is None:
+            return 0, 0
+        job_ids = list(islice(tag, size))
+        self._remove_jobs(job_ids)
+        self._log('remove_many', job_ids)
+        remaining = len(self.tags.get(tag_id, ()))
+        if not remaining:
+            self._shrink(before)
+        return len(job_ids), remaining
+
+    def _iter_slices(self, remove_slice):
+        """yield (removed, remaining) after each call of remove_slice, until
+        it returns (count, remaining) with none remaining"""
+        removed = 0
+        while True:
+            count, remaining = remove_slice()
+            removed += count
+            yield removed, remaining
+            if not remaining or not count:
+                break
+
+    def _shrink(self, before):
+        """copy the jobs to a dict sized for them if the realm has fallen
+        well below the before jobs it had, returning the memory now"""
+        if len(self.jobs) * 4 < before:
+            self.jobs = dict(self.jobs)
+    @serialise
+    def remove_many(self, job_ids):
+        """remove many jobs from the system in a single operation on the
+        realm.  returns the job_ids that did not exist"""
+        missing = [job_id for job_id in job_ids if job_id not in self.jobs]
+        self._remove_many(job_ids)
+        if len(missing) < len(job_ids):
+            self._log('remove_many', job_ids)
+        return missing
+    def _remove_many(self, job_ids):
+        self._remove_jobs(job_ids)
+
+    def _remove_tagged_jobs(self, tag_id):
+        # journaled by older versions, which removed a tag in one go
+        self._remove_jobs(list(self.tags[tag_id]))
+
+    def _remove_jobs(self, job_ids):
+        """remove the job_ids that exist, each of their queues and tags
+        taking its jobs in one go.  returns the count removed"""
+        jobs = self.jobs
+        removed = []
+        for job_id in job_ids:
+            job = jobs.pop(job_id, None)
+            if job is not None:
+                removed.append((job_id, job))
+        by_queue = {}
+        by_tag = {}
+        data_bytes = 0
+        for job_id, job in removed:
+            data_bytes += stats.data_size(job.data)
+            for q in members(job.queues):
+                by_queue.setdefault(q, []).append((job_id, job))
+            for i in members(job.tags):
+                by_tag.setdefault(i, []).append(job_id)
+        self.stats.data_bytes -= data_bytes
+
+        for q, queued in dictiter(by_queue):
+            queue_id = self._queue_ids[q]
+            queue = self.queues[queue_id]
+            leases = queue.leases
+            delays = queue.delays
+            for job_id, job in queued:
+                self._count_tags(job, queue_id, -1, -(job_id in leases),
+                                 -(job_id in delays))
+            queue.remove_many([job_id for job_id, _ in queued])
+            self._index_queue(queue_id)
+
+        completed = self._tag_completed
+        for i, tagged in dictiter(by_tag):
+            tag_id = self._tag_ids[i]
+            tag = self.tags[tag_id]
+            tag.difference_update(tagged)
+            completed[tag_id] = completed.get(tag_id, 0) + len(tagged)
+            if not tag:
+                self._release_tag(tag_id)
+        return len(removed)
 
     @serialise
     def move_job(self, job_id, from_q, to_q):
         """move the job from a queue to another queue"""
+        now = time.time()
+        self._move_job(job_id, from_q, to_q, now)
+        self._log('move_job', job_id, from_q, to_q, now)
+        jobs_available.notify()
+    def _move_job(self, job_id, from_q, to_q, now):
         job = self.jobs.get(job_id, None)
         if job is None:
             raise ValueError("Job '%s' does not exist" % job_id)
@@ -104,19 +936,24 @@ class Realm:
                              (job_id, from_q))
 
         # check if job is checked out
-        now = time.time()
-        checkout_time = self.queues[from_q][job_id]
+        checkout_time = self.queues[from_q].checkout_time(job_id)
         if checkout_time != 0 and \
             now - checkout_time < self.queue_lease_time[from_q]:
             # already checked out, can't do anything
             raise ValueError("Job '%s' queue '%s' is already checked out" % \
                              (job_id, from_q))
 
-        # OK, we can remove from the old queue now
-        self.queues[from_q].pop(job_id)
-        job[JOB_QUEUES].discard(from_q)
+        # OK, we can remove from the old queue now, a delayed job stays
+        # delayed in the new one
+        queue = self.queues[from_q]
+        not_before = queue.delays.get(job_id, None)
+        self._count_tags(job, from_q, -1, -(job_id in queue.leases),
+                         -(not_before is not None))
+        queue.remove(job_id)
+        self._index_queue(from_q)
+        job.queues = without_member(job.queues, self._queue_index[from_q])
 
-        if to_q in job[JOB_QUEUES]:
+        if self._queue_index.get(to_q, None) in members(job.queues):
             # job is already in to_q, nothing more to do
             return
 
@@ -125,56 +962,302 @@ class Realm:
         if queue is None:
             # create a new queue
             queue = self._create_queue(to_q, self.default_lease_time)
-            self._save_config
+            self._save_config()
 
         # Now we can add to the new queue
-        job[JOB_QUEUES].add(to_q)
-        if job_id not in queue:
-            queue[job_id] = 0
+        job.queues = with_member(job.queues, self._queue_index[to_q])
+        queue.push(job_id, not_before)
+        self._count_tags(job, to_q, 1, 0, not_before is not None)
+        self._index_queue(to_q)
+
+    @serialise
+    def move_many(self, moves):
+        """move many jobs, each a (job_id, from_q, to_q) tuple, in a single
+        operation on the realm.  returns [(index, exception), ...] for the
+        moves that failed"""
+        now = time.time()
+        errors = []
+        moved = []
+        with self._coalesced_config():
+            for i, (job_id, from_q, to_q) in enumerate(moves):
+                try:
+                    self._move_job(job_id, from_q, to_q, now)
+                except (ValueError, TypeError) as exc:
+                    errors.append((i, exc))
+                    continue
+                moved.append((job_id, from_q, to_q))
+        if moved:
+            self._log('move_many', moved, now)
+            jobs_available.notify()
+        return errors
+    def _move_many(self, moves, now):
+        with self._coalesced_config():
+            for job_id, from_q, to_q in moves:
+                self._move_job(job_id, from_q, to_q, now)
+
+    @serialise
+    def renew(self, job_id, extra):
+        """extend the lease on job_id so it runs out extra seconds from now"""
+        now = time.time()
+        self._renew(job_id, extra, now)
+        self._log('renew', job_id, extra, now)
+    def _renew(self, job_id, extra, now):
+        if not isinstance(extra, number_types) or extra < 0:
+            raise TypeError("extra must be a number of seconds")
+        renewed = False
+        for queue_id, queue in self._job_queues(job_id):
+            lease_time = self.queue_lease_time[queue_id]
+            if queue.renew(job_id, now + extra - lease_time, lease_time, now):
+                renewed = True
+        if not renewed:
+            raise ValueError("Job '%s' is not checked out" % job_id)
+
+    @serialise
+    def release(self, job_id):
+        """end the lease on job_id so it can be handed out again now"""
+        now = time.time()
+        self._release(job_id, now)
+        self._log('release', job_id, now)
+        jobs_available.notify()
+    def _release(self, job_id, now, delivered=True):
+        released = False
+        for queue_id, queue in self._job_queues(job_id):
+            if queue.release(job_id, self.queue_lease_time[queue_id], now,
+                             delivered):
+                self._count_tags(self.jobs[job_id], queue_id, 0, -1)
+                released = True
+        if not released:
+            raise ValueError("Job '%s' is not checked out" % job_id)
+
+    def _job_queues(self, job_id):
+        """return [(queue_id, queue), ...] for the queues job_id is in"""
+        job = self.jobs.get(job_id, None)
+        if job is None:
+            raise ValueError("Job '%s' does not exist" % job_id)
+        queue_ids = [self._queue_ids[i] for i in members(job.queues)]
+        return [(queue_id, self.queues[queue_id]) for queue_id in queue_ids]
+
+    @serialise
+    def renew_many(self, renewals):
+        """renew many leases, each a (job_id, extra) tuple, in a single
+        operation on the realm.  returns [(index, exception), ...] for the
+        renewals that failed"""
+        now = time.time()
+        errors = []
+        renewed = []
+        for i, (job_id, extra) in enumerate(renewals):
+            try:
+                self._renew(job_id, extra, now)
+            except (ValueError, TypeError) as exc:
+                errors.append((i, exc))
+                continue
+            renewed.append((job_id, extra))
+        if renewed:
+            self._log('renew_many', renewed, now)
+        return errors
+    def _renew_many(self, renewals, now):
+        for job_id, extra in renewals:
+            self._renew(job_id, extra, now)
 
     @serialise
+    def release_many(self, job_ids, delivered=True):
+        """release the leases on many jobs in a single operation on the
+        realm, delivered=False hands back jobs pulled for no worker as in
+        Queue.release.  returns [(index, exception), ...] for the releases
+        that failed"""
+        now = time.time()
+        errors = []
+        released = []
+        for i, job_id in enumerate(job_ids):
+            try:
+                self._release(job_id, now, delivered)
+            except (ValueError, TypeError) as exc:
+                errors.append((i, exc))
+                continue
+            released.append(job_id)
+        if released:
+            self._log('release_many', released, now, delivered)
+            jobs_available.notify()
+        return errors
+    def _release_many(self, job_ids, now, delivered=True):
+        for job_id in job_ids:
+            self._release(job_id, now, delivered)
+
+    @shared
     def get_job(self, job_id):
         """return the status of a job"""
         return self._get_job(job_id)
-    def _get_job(self, job_id):
+    def _get_job(self, job_id, fields='data'):
         job = self.jobs[job_id]
-        status = {'tags': list(job[JOB_TAGS]),
-                  'data': job[JOB_DATA],
-                  'queues': []}
+        if fields == 'ids':
+            return {}
+        status = {'tags': [self._tag_ids[i] for i in members(job.tags)],
+                  'queues': [], 'deliveries': []}
+        if fields == 'data':
+            status['data'] = job.data
         now = time.time()
-        for queue_id in job[JOB_QUEUES]:
-            checkout_time = self.queues[queue_id][job_id]
+        for i in members(job.queues):
+            queue_id = self._queue_ids[i]
+            queue = self.queues[queue_id]
+            with queue.lock:
+                checkout_time = queue.checkout_time(job_id)
+                delivered = queue.deliveries.get(job_id, 0)
             if checkout_time != 0:
                 checkout_time = now - checkout_time
             status['queues'].append((queue_id, checkout_time))
+            status['deliveries'].append((queue_id, delivered))
         return status
 
-    @serialise
-    def get_tagged_jobs(self, tag_id):
-        """return a dict of all jobs tagged by tag_id"""
-        jobs = {}
+    def get_tagged_jobs(self, tag_id, fields='data'):
+        """return a dict of all jobs tagged by tag_id, with the fields of
+        each job's status that iter_tagged_jobs takes"""
+        return dict(self.iter_tagged_jobs(tag_id, fields))
+
+    def iter_tagged_jobs(self, tag_id, fields='data', page_size=None):
+        """return an iterator of (job_id, status) for the jobs tagged by
+        tag_id in job_id order.  The realm is only held to take the job_ids
+        and then for each page_size of jobs looked up, so jobs added to the
+        tag after the call are missed and those removed are skipped.
+
+        fields - 'data' for the status get_job returns, 'status' for its
+                 tags and queues alone or 'ids' for an empty status
+        """
+        _check_fields(fields)
+        if page_size is None:
+            page_size = config.webapp['tag_page_size']
+        job_ids = self._tagged_job_ids(tag_id)
+        job_ids.sort(key=queue_key)
+        return self._iter_jobs(tag_id, job_ids, fields, page_size)
+    @shared
+    def _tagged_job_ids(self, tag_id):
+        return list(self.tags[tag_id])
+    def _iter_jobs(self, tag_id, job_ids, fields, page_size):
+        for i in range(0, len(job_ids), page_size):
+            for job in self._get_tagged(tag_id, job_ids[i:i + page_size],
+                                        fields):
+                yield job
+    @shared
+    def _get_tagged(self, tag_id, job_ids, fields):
+        tag = self.tags.get(tag_id, ())
+        return [(job_id, self._get_job(job_id, fields))
+                for job_id in job_ids if job_id in tag]
+
+    def get_tagged_page(self, tag_id, after=None, count=None, fields='data'):
+        """return a page of up to count jobs tagged by tag_id, those that
+        follow job_id after in job_id order, as {'jobs': {job_id: status,
+        ...}, 'next': the after of the next page or None if this is the last
+        one}.  See iter_tagged_jobs for fields.
+
+        The tag's job_ids are taken and sorted for the first page, outside
+        of the realm lock as iter_tagged_jobs does, and the pages after it
+        are found in that snapshot.  So the jobs added to the tag since the
+        first page are missed and those removed are skipped.  The snapshots
+        of the last TAG_PAGE_SNAPSHOTS tags paged are kept, a page after one
+        that was dropped takes and sorts them again.
+        """
+        _check_fields(fields)
+        if count is None:
+            count = config.webapp['tag_page_size']
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        job_ids = self._tag_snapshot(tag_id, after is None)
+        return self._get_tagged_page(tag_id, job_ids, after, count, fields)
+    @shared
+    def _get_tagged_page(self, tag_id, job_ids, after, count, fields):
         tag = self.tags[tag_id]
-        for job_id in tag:
-            jobs[job_id] = self._get_job(job_id)
-        return jobs
+        i = 0 if after is None else _bisect_key(job_ids, queue_key(after))
+        page = []
+        while i < len(job_ids) and len(page) <= count:
+            if job_ids[i] in tag:
+                page.append(job_ids[i])
+            i += 1
+        more = len(page) > count
+        del page[count:]
+        jobs = dict((job_id, self._get_job(job_id, fields))
+                    for job_id in page)
+        return {'jobs': jobs, 'next': page[-1] if more else None}
+    def _tag_snapshot(self, tag_id, fresh):
+        """return the job_ids of tag_id sorted by queue_key, the snapshot
+        kept of them unless fresh or there is none"""
+        snapshots = self._tag_pages
+        with self._tag_lock:
+            job_ids = None if fresh else snapshots.pop(tag_id, None)
+        if job_ids is None:
+            job_ids = self._tagged_job_ids(tag_id)
+            job_ids.sort(key=queue_key)
+        with self._tag_lock:
+            snapshots.pop(tag_id, None)
+            snapshots[tag_id] = job_ids
+            while len(snapshots) > TAG_PAGE_SNAPSHOTS:
+                snapshots.popitem(last=False)
+        return job_ids
 
     @serialise
-    def add(self, job_id, queue_id, data=None, tags=[]):
-        """store a job into a queue"""
+    def add(self, job_id, queue_id, data=None, tags=[], not_before=None,
+            delay=None):
+        """store a job into a queue.  It isn't pulled before the time
+        not_before, or delay seconds from now, when one is given."""
+        if delay is not None:
+            not_before = time.time() + delay
+        self._add(job_id, queue_id, data, tags, not_before)
+        self._log('add', job_id, queue_id, data, tags, not_before)
+        jobs_available.notify()
+
+    @serialise
+    def add_many(self, jobs):
+        """store many jobs, each a (job_id, queue_id, data, tags) tuple, or
+        (job_id, queue_id, data, tags, not_before) for a delayed job, in a
+        single operation on the realm.  A job moved from another realm may
+        follow not_before with the time it was leased at, or None, and the
+        times it was delivered, see Queue.push.  returns [(index,
+        exception), ...] for the jobs that could not be added"""
+        errors = []
+        added = []
+        with self._coalesced_config():
+            for i, job in enumerate(jobs):
+                try:
+                    job_id, queue_id, data, tags = job[:4]
+                    extra = tuple(job[4:7])
+                    not_before, leased_at, deliveries = \
+                        extra + (None, None, 0)[len(extra):]
+                    for name, value in (('not_before', not_before),
+                                        ('leased_at', leased_at)):
+                        if value is not None and \
+                                not isinstance(value, number_types):
+                            raise ValueError("%s must be a number" % name)
+                    if not isinstance(deliveries, integer_types) or \
+                            deliveries < 0:
+                        raise ValueError("deliveries must be a count")
+                    # fail on an unhashable id before the realm is touched
+                    hash((job_id, queue_id, tuple(tags)))
+                    self._add(job_id, queue_id, data, tags, not_before,
+                              leased_at, deliveries)
+                except (ValueError, TypeError) as exc:
+                    errors.append((i, exc))
+                    continue
+                added.append(job)
+        if added:
+            self._log('add_many', added)
+            jobs_available.notify()
+        return errors
+    def _add_many(self, jobs):
+        with self._coalesced_config():
+            for job in jobs:
+                self._add(*job)
+    def _add(self, job_id, queue_id, data, tags, not_before=None,
+             leased_at=None, deliveries=0):
         # store our job
         job = self.jobs.get(job_id, None)
         if job is None:
-            job = (data, set(), set())
+            job = Job(data)
             self.jobs[job_id] = job
+            self.stats.data_bytes += stats.data_size(data)
         else:
-            if data != job[JOB_DATA]:
+            if data != job.data:
                 msg = "add of existing job '%s' with data != old data" % \
                         (job_id)
                 raise ValueError(msg)
 
-        # update the job's queue record
-        job[JOB_QUEUES].add(queue_id)
-
         # add this job to the queue
         queue = self.queues.get(queue_id, None)
         if queue is None:
@@ -182,96 +1265,662 @@ class Realm:
             queue = self._create_queue(queue_id, self.default_lease_time)
             self._save_config()
 
-        # if the job is not in the queue, add it and init the checkout time
+        # update the job's queue record
+        job.queues = with_member(job.queues, self._queue_index[queue_id])
+
+        # if the job is not in the queue, add it to the end
         if job_id not in queue:
-            queue[job_id] = 0
+            queue.push(job_id, not_before, leased_at, deliveries)
+            self._count_tags(job, queue_id, 1, job_id in queue.leases,
+                             not_before is not None)
+        self._index_queue(queue_id)
 
         # add tags to jobs and job to tags
         for tag_id in tags:
-            job[JOB_TAGS].add(tag_id)
-            tag = self.tags.get(tag_id, None)
-            if tag is None:
-                tag = set()
-                self.tags[tag_id] = tag
-            tag.add(job_id)
+            i = self._intern_tag(tag_id)
+            if i in members(job.tags):
+                continue
+            job.tags = with_member(job.tags, i)
+            self.tags[tag_id].add(job_id)
+            # the new tag counts the job in each of its queues
+            for queue_id in [self._queue_ids[q] for q in members(job.queues)]:
+                queue = self.queues[queue_id]
+                self._count_tag(i, queue_id, 1, job_id in queue.leases,
+                                job_id in queue.delays)
 
-    @serialise
-    def pull(self, count, max_queue=None):
-        """pull out a max of count jobs"""
-        queues_ids = [k for k in self.queues]
-        queues_ids.sort()
+    def pull(self, count, max_queue=None, wait=None, queue_id=None):
+        """pull out a max of count jobs, waiting up to wait seconds for a job
+        to become available if there are none.  A dead-letter queue is only
+        pulled from when given as queue_id, which pulls from it alone."""
+        self._check_writable()
+        if queue_id is not None:
+            max_queue = queue_id
+            pull = lambda: self._pull_from(queue_id, count)
+        else:
+            pull = lambda: self._pull(count, max_queue)
+        if wait:
+            jobs = wait_for_jobs(pull, wait,
+                                 lambda: self.next_expiry(max_queue))
+        else:
+            jobs = pull()
+        self._checkpoint_pulled()
+        return jobs
+    @shared
+    def _pull(self, count, max_queue):
         jobs = {}
         ctime = time.time()
-        pred = lambda x: max_queue is None or x <= max_queue
-        for queue_id in takewhile(pred, queues_ids):
-            # add this job to the jobs result dict and update its lease time
-            for job_id, dequeue_time in dictiter(self.queues[queue_id]):
-
-                # skip any non expired leases
-                if ctime - dequeue_time > self.queue_lease_time[queue_id]:
-                    self.queues[queue_id][job_id] = ctime
-                    jobs[job_id] = (queue_id, self.jobs[job_id][JOB_DATA])
-                    if len(jobs) >= count:
-                        return jobs
+        ready = self._ready
+        if max_queue is not None:
+            ready = ready[:bisect_right(ready, queue_key(max_queue))]
+        dead_queues = self._dead_queues
+        for key in ready:
+            queue_id = key[1]
+            if queue_id in dead_queues or \
+                    not self.queues[queue_id].available(
+                        self.queue_lease_time[queue_id], ctime):
+                continue
+            self._pull_into(jobs, queue_id, count - len(jobs), ctime)
+            if len(jobs) >= count:
+                break
         return jobs
 
-    @serialise
+    def pull_from(self, queue_id, count):
+        """pull out a max of count jobs from queue_id alone"""
+        self._check_writable()
+        jobs = self._pull_from(queue_id, count)
+        self._checkpoint_pulled()
+        return jobs
+    @shared
+    def _pull_from(self, queue_id, count):
+        jobs = {}
+        if queue_id in self.queues:
+            self._pull_into(jobs, queue_id, count, time.time())
+        return jobs
+
+    def _check_writable(self):
+        # pulls hold the realm shared, see serialise for the rest
+        if self.replica_of is not None:
+            raise ReadOnlyRealm("Realm '%s' is a replica of %s" %
+                                (self.realm_id, self.replica_of))
+
+    def _pull_into(self, jobs, queue_id, count, ctime):
+        """add up to count jobs pulled from queue_id to the jobs result dict,
+        their lease starts at ctime"""
+        lease_time = self.queue_lease_time[queue_id]
+        retry_delay = self.retry_delay
+        backoff = None
+        retry = self.queue_retry.get(queue_id, None)
+        if retry is not None:
+            retry_delay, factor, max_retry_delay = retry
+            if factor != 1:
+                backoff = (factor, max_retry_delay)
+        dead_letter = self.queue_dead_letter.get(queue_id, None)
+        with self.queues[queue_id].lock:
+            job_ids, exhausted = self._pull_queue(
+                queue_id, count, lease_time, ctime, retry_delay, dead_letter,
+                backoff)
+            if job_ids or exhausted:
+                self._log('pull_queue', queue_id, len(job_ids),
+                          lease_time, ctime, retry_delay, dead_letter,
+                          backoff)
+            if exhausted:
+                # journaled with the push, a pull of the dead-letter queue
+                # can't be journaled ahead of the jobs that fed it
+                dead_queue_id = dead_letter[1]
+                with self.queues[dead_queue_id].lock:
+                    self._dead_letter(queue_id, exhausted, dead_queue_id)
+                    self._log('dead_letter', queue_id, exhausted,
+                              dead_queue_id)
+        for job_id in job_ids:
+            jobs[job_id] = (queue_id, self.jobs[job_id].data)
+        if exhausted:
+            jobs_available.notify()
+    def _pull_queue(self, queue_id, count, lease_time, ctime, retry_delay=0,
+                    dead_letter=None, backoff=None):
+        """pull count jobs from queue_id, returns them and the jobs taken out
+        for the dead_letter=(max_deliveries, queue_id) queue, which are moved
+        there by _dead_letter.  backoff is as in Queue.expire"""
+        expired = []
+        promoted = []
+        exhausted = []
+        max_deliveries = dead_letter[0] if dead_letter else 0
+        job_ids = self.queues[queue_id].pull(count, lease_time, ctime,
+                                             expired, retry_delay, promoted,
+                                             max_deliveries, exhausted,
+                                             backoff)
+        if job_ids or expired or promoted or exhausted:
+            # pulls of other queues count the same tags
+            jobs = self.jobs
+            with self._tag_lock:
+                for job_id in expired:
+                    self._count_tags(jobs[job_id], queue_id, 0, -1,
+                                     bool(retry_delay))
+                for job_id in promoted:
+                    self._count_tags(jobs[job_id], queue_id, 0, 0, -1)
+                for job_id in job_ids:
+                    self._count_tags(jobs[job_id], queue_id, 0, 1)
+        return job_ids, exhausted
+
+    def _dead_letter(self, queue_id, job_ids, dead_queue_id):
+        """move the job_ids, already taken out of queue_id for being handed
+        out too many times, to the end of dead_queue_id.
+
+        Pulls of other queues run alongside this, the caller holds the locks
+        of queue_id and dead_queue_id, taken in that order before the tag
+        lock, which holds as a dead-letter queue doesn't dead-letter jobs
+        itself.
+        """
+        jobs = self.jobs
+        i = self._queue_index[queue_id]
+        d = self._queue_index[dead_queue_id]
+        dead_queue = self.queues[dead_queue_id]
+        with self._tag_lock:
+            for job_id in job_ids:
+                job = jobs[job_id]
+                self._count_tags(job, queue_id, -1, -1)
+                job.queues = without_member(job.queues, i)
+                if d not in members(job.queues):
+                    job.queues = with_member(job.queues, d)
+                    dead_queue.push(job_id)
+                    self._count_tags(job, dead_queue_id, 1, 0)
+            self._dead_lettered[queue_id] = \
+                self._dead_lettered.get(queue_id, 0) + len(job_ids)
+            # the ready index is read by the other pulls, it's replaced whole
+            self._ready = sorted([queue_key(q) for q, queue
+                                  in dictiter(self.queues) if len(queue)])
+
+    def ready_queues(self, ctime):
+        """return the queue_key of each queue with jobs available at ctime,
+        in pull order, leaving out the dead-letter queues.  This is read
+        without the realm lock as a hint."""
+        queues = self.queues
+        lease_time = self.queue_lease_time
+        dead_queues = self._dead_queues
+        return [key for key in list(self._ready)
+                if key[1] not in dead_queues and
+                queues[key[1]].available(lease_time[key[1]], ctime)]
+
+    @shared
+    def next_expiry(self, max_queue=None):
+        """return the earliest time a lease may expire or a delayed job fall
+        due, or None"""
+        expiry = None
+        for queue_id, queue in list(dictiter(self.queues)):
+            if max_queue is not None and \
+                    queue_key(queue_id) > queue_key(max_queue):
+                continue
+            # the heads may be stale, which only wakes us early
+            with queue.lock:
+                times = []
+                if queue.leased:
+                    times.append(queue.leased[0][0] +
+                                 self.queue_lease_time[queue_id])
+                if queue.delayed:
+                    times.append(queue.delayed[0][0])
+            for t in times:
+                if expiry is None or t < expiry:
+                    expiry = t
+        return expiry
+
     def clear_queue(self, queue_id):
         """remove all jobs from the given queue"""
+        for _ in self.iter_clear_queue(queue_id):
+            pass
+
+    def iter_clear_queue(self, queue_id, size=None):
+        """return an iterator that takes the jobs out of queue_id size at a
+        time, as iter_remove_tagged_jobs does, yielding (removed,
+        remaining).  The jobs left in no queue are removed."""
+        if size is None:
+            size = config.realms['removal_batch_size']
+        before = len(self.jobs)
+        if queue_id not in self.queues:
+            raise ValueError("Queue '%s' does not exist" % queue_id)
+        return self._iter_slices(
+            lambda: self._clear_queue_slice(queue_id, size, before))
+    @serialise
+    def _clear_queue_slice(self, queue_id, size, before):
+        queue = self.queues[queue_id]
+        job_ids = list(islice(queue, size))
+        self._remove_from_queue(queue_id, job_ids)
+        self._log('remove_from_queue', queue_id, job_ids)
+        if not len(queue):
+            self._shrink(before)
+        return len(job_ids), len(queue)
+    def _clear_queue(self, queue_id):
+        # journaled by older versions, which cleared a queue in one go
         queue = self.queues.get(queue_id, None)
         if queue is None:
             raise ValueError("Queue '%s' does not exist" % queue_id)
+        self._remove_from_queue(queue_id, list(queue))
 
-        # get a list of all jobs in this queue so we can remove the queue
-        # references from them afterwards. We do this first so we can clear the
-        # queue in one go and prevent dequeueing during iteration
-        job_ids = [job_id for job_id in queue]
-
-        # clear the queue, then remove the queue references from all jobs
-        queue.clear()
+    def _remove_from_queue(self, queue_id, job_ids):
+        """take the job_ids out of queue_id, removing the jobs left in no
+        queue"""
+        queue = self.queues[queue_id]
+        leases = queue.leases
+        delays = queue.delays
+        i = self._queue_index[queue_id]
+        jobs = self.jobs
+        unqueued = []
         for job_id in job_ids:
-            job = self.jobs.get(job_id, None)
-            if job is None:
-                # Job doesn't exist any more, skip
-                continue
-            queues_job_in = job[JOB_QUEUES]
-            queues_job_in.discard(queue_id)
-            if len(queues_job_in) == 0:
-                # job no longer in any queues, lets remove it completely
-                self._remove_from_tags(job_id)
-                self.jobs.pop(job_id)
+            job = jobs[job_id]
+            self._count_tags(job, queue_id, -1, -(job_id in leases),
+                             -(job_id in delays))
+            job.queues = without_member(job.queues, i)
+            if job.queues == ():
+                unqueued.append(job_id)
+        queue.remove_many(job_ids)
+        self._index_queue(queue_id)
+        self._remove_jobs(unqueued)
 
+    @shared
     def queue_names(self):
         """list of current queue names"""
-        return self.queues.keys()
+        return list(self.queues)
 
     @property
     def status(self):
-        """return the status of the indexes"""
+        """return the status of the indexes, the job counts of each queue
+        are {total, available, leased, expired, delayed, dead_lettered}
+        under queue_status, dead_lettered counting the jobs moved out of the
+        queue to its dead-letter queue.  It is read without the realm
+        lock."""
+        if self.moved_to is not None:
+            raise RealmMoved("Realm '%s' moved to %s" %
+                             (self.realm_id, self.moved_to))
+        ctime = time.time()
+        queues = {}
         queue_status = {}
-        for key in self.queues:
-            queue_status[key] = len(self.queues[key])
+        sums = [0, 0, 0, 0]
+        for queue_id, queue in list(self.queues.items()):
+            lease_time = self.queue_lease_time.get(queue_id,
+                                                   self.default_lease_time)
+            counts = queue.counts(lease_time, ctime)
+            queues[queue_id] = counts[0]
+            queue_status[queue_id] = dict(zip(
+                ('total', 'available', 'leased', 'expired', 'delayed'),
+                counts))
+            queue_status[queue_id]['dead_lettered'] = \
+                self._dead_lettered.get(queue_id, 0)
+            for i in range(4):
+                sums[i] += counts[i + 1]
         return dict(total_jobs=len(self.jobs),
                     total_tags=len(self.tags),
-                    queues=queue_status)
+                    available_jobs=sums[0],
+                    leased_jobs=sums[1],
+                    expired_jobs=sums[2],
+                    delayed_jobs=sums[3],
+                    dead_lettered_jobs=sum(self._dead_lettered.values()),
+                    queues=queues,
+                    queue_status=queue_status)
 
+    @shared
     def get_tag_status(self, tag_id):
-        """return the count of jobs tagged by tag_id"""
-        tag = self.tags[tag_id]
-        return {'count': len(tag)}
+        """return the progress of the jobs tagged by tag_id, kept as they're
+        added, pulled and removed.
+
+        return: {'count': jobs, 'completed': jobs removed,
+                 'queued': queue entries,
+                 'available': those neither leased nor delayed,
+                 'leased': those leased, 'delayed': those not yet due,
+                 'queues': {queue_id: {total, available, leased, delayed},
+                            ...}}
+
+        A job in several queues is queued in each of them.  A lease that ran
+        out is counted as leased until its queue is next pulled.  A tag
+        whose jobs were all removed keeps its completed count for
+        config.realms['tag_retention'] seconds.
+        """
+        tag = self.tags.get(tag_id, None)
+        if tag is None:
+            done = self._done_tags.get(tag_id, None)
+            if done is None or \
+                    time.time() - done[1] > config.realms['tag_retention']:
+                raise KeyError(tag_id)
+            return {'count': 0, 'completed': done[0], 'queued': 0,
+                    'available': 0, 'leased': 0, 'delayed': 0, 'queues': {}}
+        with self._tag_lock:
+            counts = [(queue_id, tuple(c)) for queue_id, c
+                      in dictiter(self._tag_queues[self._tag_index[tag_id]])]
+        queues = dict((queue_id, {'total': total, 'leased': leased,
+                                  'delayed': delayed,
+                                  'available': total - leased - delayed})
+                      for queue_id, (total, leased, delayed) in counts)
+        queued, leased, delayed = [sum(c[i] for _, c in counts)
+                                   for i in range(3)]
+        return {'count': len(tag),
+                'completed': self._tag_completed.get(tag_id, 0),
+                'queued': queued, 'available': queued - leased - delayed,
+                'leased': leased, 'delayed': delayed, 'queues': queues}
 
     @serialise
     def set_queue_lease_time(self, queue_id, lease_time):
         """set the lease time for the given queue_id"""
         self._set_queue_lease_time(queue_id, lease_time)
+        self._log('set_queue_lease_time', queue_id, lease_time)
+
+    @serialise
+    def set_queue_max_deliveries(self, queue_id, max_deliveries,
+                                 dead_letter_queue=None):
+        """move a job of queue_id whose lease runs out for the
+        max_deliveries time to the end of dead_letter_queue (default:
+        config.realms['dead_letter_queue']), 0 hands it out for ever.  A
+        dead-letter queue can't itself have a max_deliveries, and is only
+        pulled from by its queue_id, see pull."""
+        if dead_letter_queue is None:
+            dead_letter_queue = config.realms['dead_letter_queue']
+        self._set_queue_max_deliveries(queue_id, max_deliveries,
+                                       dead_letter_queue)
+        self._log('set_queue_max_deliveries', queue_id, max_deliveries,
+                  dead_letter_queue)
+    def _set_queue_max_deliveries(self, queue_id, max_deliveries,
+                                  dead_letter_queue):
+        if max_deliveries < 0:
+            raise ValueError("max_deliveries must not be negative")
+        dead_letter = self.queue_dead_letter
+        if max_deliveries:
+            if queue_id == dead_letter_queue or \
+                    dead_letter_queue in dead_letter:
+                raise ValueError("Queue '%s' can't be a dead-letter queue" %
+                                 dead_letter_queue)
+            if queue_id in [q for _, q in dead_letter.values()]:
+                raise ValueError("Queue '%s' is a dead-letter queue" %
+                                 queue_id)
+            for q in (queue_id, dead_letter_queue):
+                if q not in self.queues:
+                    self._create_queue(q, self.default_lease_time)
+            dead_letter[queue_id] = (max_deliveries, dead_letter_queue)
+        else:
+            dead_letter.pop(queue_id, None)
+        self._dead_queues = frozenset(q for _, q in dead_letter.values())
+        self._save_config()
+
+    @serialise
+    def set_queue_retry_delay(self, queue_id, retry_delay, backoff=1,
+                              max_retry_delay=None):
+        """hold a job of queue_id whose lease ran out back for retry_delay
+        seconds in place of the realm's retry delay, multiplied by backoff
+        for each time the job was handed out before, up to max_retry_delay
+        (default: config.realms['max_retry_delay']).  A retry_delay of None
+        goes back to the realm's."""
+        if max_retry_delay is None:
+            max_retry_delay = config.realms['max_retry_delay']
+        self._set_queue_retry_delay(queue_id, retry_delay, backoff,
+                                    max_retry_delay)
+        self._log('set_queue_retry_delay', queue_id, retry_delay, backoff,
+                  max_retry_delay)
+    def _set_queue_retry_delay(self, queue_id, retry_delay, backoff,
+                               max_retry_delay):
+        if retry_delay is None:
+            self.queue_retry.pop(queue_id, None)
+        else:
+            if retry_delay < 0:
+                raise ValueError("retry_delay must not be negative")
+            if backoff < 1:
+                raise ValueError("backoff must be at least 1")
+            if max_retry_delay < retry_delay:
+                raise ValueError("max_retry_delay must not be less than "
+                                 "retry_delay")
+            if queue_id not in self.queues:
+                self._create_queue(queue_id, self.default_lease_time)
+            self.queue_retry[queue_id] = (retry_delay, backoff,
+                                          max_retry_delay)
+        self._save_config()
 
     @serialise
     def set_default_lease_time(self, lease_time):
         """The number of seconds a job can be leased for before a job can be
         handed out to a new requester"""
+        self._set_default_lease_time(lease_time)
+        self._log('set_default_lease_time', lease_time)
+    def _set_default_lease_time(self, lease_time):
         self.default_lease_time = lease_time
         self._save_config()
 
+    @serialise
+    def set_retry_delay(self, retry_delay):
+        """The number of seconds a job whose lease ran out waits before it
+        can be handed out again, 0 hands it out at once"""
+        self._set_retry_delay(retry_delay)
+        self._log('set_retry_delay', retry_delay)
+    def _set_retry_delay(self, retry_delay):
+        if retry_delay < 0:
+            raise ValueError("retry_delay must not be negative")
+        self.retry_delay = retry_delay
+        self._save_config()
+
+    @serialise
+    def set_durability(self, durability):
+        """Set how the jobs of the realm are persisted, one of:
+            none    - jobs are only held in memory.
+            batched - mutations are logged and synced to disk in batches.
+            per-op  - mutations are logged and synced before returning."""
+        self._set_durability(durability)
+    def _set_durability(self, durability):
+        if durability not in journal.DURABILITY:
+            raise ValueError("Unknown durability '%s'" % durability)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.durability = durability
+        self._save_config()
+        if durability == 'none':
+            self._join_snapshot()
+            journal.remove(self.journal_path,
+                           self.journal_path + journal.PREVIOUS,
+                           self.snapshot_path)
+        else:
+            self._journal = journal.Journal(self.journal_path, durability,
+                    config.realms['journal_sync_interval'])
+            self._journal.open()
+            self._snapshot()
+
+    def close(self):
+        """sync and close the realm's journal"""
+        self._join_snapshot()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _log(self, *record):
+        """append a mutation to the journal and the log of changes"""
+        if self._journal is not None:
+            self._journal.append(record)
+        if self._changes is not None:
+            self._changes.append(record)
+
+    def _checkpoint_due(self):
+        journal = self._journal
+        snapshotter = self._snapshotter
+        return journal is not None and \
+            journal.count >= config.realms['snapshot_interval'] and \
+            (snapshotter is None or not snapshotter.is_alive())
+
+    def _checkpoint_pulled(self):
+        """checkpoint after a pull, which only holds the realm shared"""
+        if self._checkpoint_due():
+            with self.lock.exclusive:
+                self._checkpoint()
+
+    def _checkpoint(self):
+        """snapshot once the journal grows long, needs the exclusive lock"""
+        if self._checkpoint_due():
+            self._snapshot_behind()
+
+    def _apply(self, record):
+        """replay a mutation read back from the journal"""
+        getattr(self, '_' + record[0])(*record[1:])
+
+    def _snapshot(self):
+        """write the jobs out to the snapshot and start a new journal"""
+        self._join_snapshot()
+        self._generation += 1
+        journal.write_snapshot(self.snapshot_path, self._state())
+        self._journal.reset(self._generation)
+
+    def _snapshot_behind(self):
+        """snapshot without holding up the realm, the state is copied under
+        the lock and written out by a thread while the old journal is kept
+        for a restart"""
+        if self._journal.has_previous():
+            # the last snapshot wasn't written, the old journal can't go
+            self._snapshot()
+            return
+        self._generation += 1
+        state = self._state(copy=True)
+        log = self._journal
+        log.rotate(self._generation)
+        def write():
+            journal.write_snapshot(self.snapshot_path, state)
+            log.drop_previous()
+        self._snapshotter = Thread(target=write)
+        self._snapshotter.daemon = True
+        self._snapshotter.start()
+
+    def _join_snapshot(self):
+        """wait for a snapshot being written out"""
+        snapshotter = self._snapshotter
+        if snapshotter is not None:
+            snapshotter.join()
+            self._snapshotter = None
+
+    def _state(self, copy=False):
+        """return the jobs, tags and queues of the realm for a snapshot.  It
+        shares the realm's own lists and dicts, hold the lock until it's
+        written out, or copy them."""
+        share = (lambda x: x.copy()) if copy else (lambda x: x)
+        queues = {}
+        for queue_id, queue in dictiter(self.queues):
+            state = queue.dump()
+            queues[queue_id] = state[:2] + tuple(share(d) for d in state[2:])
+        jobs = self.jobs.values()
+        return dict(generation=self._generation,
+                    job_ids=list(self.jobs),
+                    data=[job.data for job in jobs],
+                    tags=[job.tags for job in jobs],
+                    queues=[job.queues for job in jobs],
+                    tag_ids=list(self._tag_ids),
+                    queue_ids=list(self._queue_ids),
+                    queue_state=queues,
+                    tag_completed=share(self._tag_completed),
+                    dead_lettered=share(self._dead_lettered),
+                    done_tags=[(tag_id, completed, t) for tag_id,
+                               (completed, t) in dictiter(self._done_tags)])
+
+    def _resync(self, settings, state):
+        """replace the jobs, queues and settings of the realm with those of
+        another realm, given as its _settings and _state"""
+        self.queues = {}
+        self.queue_lease_time = {}
+        self.queue_dead_letter = {}
+        self.queue_retry = {}
+        self._queue_index = {}
+        self._queue_ids = []
+        self._changes = None
+        self.default_lease_time = settings['default_lease_time']
+        self.retry_delay = settings.get('retry_delay',
+                                        config.realms['retry_delay'])
+        for queue_id, lease_time in settings['queues']:
+            self._create_queue(queue_id, lease_time)
+        self._load_dead_letter(settings)
+        self._load_queue_retry(settings)
+        self._load_state(state)
+        if settings['durability'] != self.durability:
+            self._set_durability(settings['durability'])
+        else:
+            self._save_config()
+            if self._journal is not None:
+                self._snapshot()
+
+    def _open_journal(self):
+        """recover the jobs from the snapshot and journal"""
+        self._journal = journal.Journal(self.journal_path, self.durability,
+                config.realms['journal_sync_interval'])
+        state = journal.read_snapshot(self.snapshot_path)
+        if state is not None:
+            self._load_state(state)
+        current = False
+        for record in self._journal.replay():
+            if record[0] == 'generation':
+                if current and record[1] == self._generation + 1:
+                    # the previous journal ran up to a snapshot that
+                    # wasn't written, the journal carries on from it
+                    self._generation = record[1]
+                else:
+                    current = record[1] == self._generation
+            elif current:
+                self._apply(record)
+        self._journal.open()
+        if not current:
+            # the journal is missing or older than the snapshot
+            self._journal.reset(self._generation)
+        elif self._journal.has_previous():
+            # a snapshot was cut short, it's written again
+            self._snapshot()
+
+    def _load_state(self, state):
+        self._generation = state['generation']
+
+        # the tags are rebuilt with the ints they were interned as
+        tag_ids = state['tag_ids']
+        self._tag_ids = tag_ids
+        self._tag_index = {}
+        self._free_tag_ints = []
+        self.tags = {}
+        for i, tag_id in enumerate(tag_ids):
+            if tag_id is None:
+                self._free_tag_ints.append(i)
+            else:
+                self._tag_index[tag_id] = i
+                self.tags[tag_id] = set()
+
+        # queues may already be interned differently from the config
+        queue_ints = []
+        for queue_id in state['queue_ids']:
+            if queue_id not in self.queues:
+                self._create_queue(queue_id, self.default_lease_time)
+            queue_ints.append(self._queue_index[queue_id])
+        def remap(ids):
+            if type(ids) is tuple:
+                return tuple([queue_ints[i] for i in ids])
+            return queue_ints[ids]
+
+        self.jobs = {}
+        tags = self.tags
+        data_bytes = 0
+        for job_id, data, job_tags, job_queues in zip(state['job_ids'],
+                state['data'], state['tags'], state['queues']):
+            self.jobs[job_id] = Job(data, job_tags, remap(job_queues))
+            data_bytes += stats.data_size(data)
+            for i in members(job_tags):
+                tags[tag_ids[i]].add(job_id)
+        self.stats.data_bytes = data_bytes
+
+        for queue_id, queue_state in dictiter(state['queue_state']):
+            self.queues[queue_id].load(*queue_state)
+        self._ready = sorted([queue_key(queue_id)
+                              for queue_id, queue in dictiter(self.queues)
+                              if len(queue)])
+
+        # the counts of the tags are taken again from the jobs
+        self._tag_queues = [None if tag_id is None else {}
+                            for tag_id in tag_ids]
+        queue_ids = self._queue_ids
+        for job_id, job in dictiter(self.jobs):
+            for q in members(job.queues):
+                queue_id = queue_ids[q]
+                queue = self.queues[queue_id]
+                leased = job_id in queue.leases
+                delayed = job_id in queue.delays
+                for i in members(job.tags):
+                    self._count_tag(i, queue_id, 1, leased, delayed)
+        self._tag_completed = dict(state.get('tag_completed', {}))
+        self._dead_lettered = dict(state.get('dead_lettered', {}))
+        self._done_tags = OrderedDict(
+            (tag_id, (completed, t))
+            for tag_id, completed, t in state.get('done_tags', []))
+
     def _set_queue_lease_time(self, queue_id, lease_time):
         queue = self.queues.get(queue_id, None)
         if queue is None:
@@ -285,63 +1934,160 @@ class Realm:
             self._save_config()
             return
         with open(self.realm_config_path, 'r') as f:
-            realm_config = yaml.load(f)
+            realm_config = config.load_yaml(f)
         self.default_lease_time = realm_config.get('default_lease_time',
                 config.realms['default_lease_time'])
+        self.retry_delay = realm_config.get('retry_delay',
+                config.realms['retry_delay'])
+        self.durability = realm_config.get('durability', 'none')
         for queue_id, lease_time in realm_config['queues']:
             self._create_queue(queue_id, lease_time)
+        self._load_dead_letter(realm_config)
+        self._load_queue_retry(realm_config)
+
+    def _load_dead_letter(self, settings):
+        self.queue_dead_letter = dict(
+            (queue_id, (max_deliveries, dead_letter_queue))
+            for queue_id, max_deliveries, dead_letter_queue
+            in settings.get('dead_letter', []))
+        self._dead_queues = frozenset(
+            q for _, q in self.queue_dead_letter.values())
+
+    def _load_queue_retry(self, settings):
+        self.queue_retry = dict(
+            (queue_id, (retry_delay, backoff, max_retry_delay))
+            for queue_id, retry_delay, backoff, max_retry_delay
+            in settings.get('retry', []))
+
+    @contextmanager
+    def _coalesced_config(self):
+        """hold back config saves made in the block to a single save"""
+        self._config_held = True
+        try:
+            yield
+        finally:
+            self._config_held = False
+            if self._config_dirty:
+                self._save_config()
 
     def _save_config(self):
-        realm_config = dict(queues=[],
-                      default_lease_time=self.default_lease_time)
-        for queue_id in self.queues:
-            realm_config['queues'].append(
-                    (queue_id, self.queue_lease_time[queue_id]))
+        if self._config_held:
+            self._config_dirty = True
+            return
+        self._config_dirty = False
         with open(self.realm_config_path, 'w') as f:
-            yaml.dump(realm_config, f, default_flow_style=False)
+            yaml.dump(self._settings(), f, default_flow_style=False)
+
+    def _settings(self):
+        """return the config of the realm as it's saved"""
+        return dict(queues=[(queue_id, self.queue_lease_time[queue_id])
+                            for queue_id in self.queues],
+                    default_lease_time=self.default_lease_time,
+                    retry_delay=self.retry_delay,
+                    dead_letter=[(queue_id, max_deliveries, dead_letter_queue)
+                                 for queue_id, (max_deliveries,
+                                                dead_letter_queue)
+                                 in dictiter(self.queue_dead_letter)],
+                    retry=[(queue_id, retry_delay, backoff, max_retry_delay)
+                           for queue_id, (retry_delay, backoff,
+                                          max_retry_delay)
+                           in dictiter(self.queue_retry)],
+                    durability=self.durability)
 
     def _create_queue(self, queue_id, lease_time):
-        queue = OrderedDict()
+        queue = Queue()
         self.queues[queue_id] = queue
+        self._queue_index[queue_id] = len(self._queue_ids)
+        self._queue_ids.append(queue_id)
         self.queue_lease_time[queue_id] = lease_time
         return queue
 
 
 _realms = dict()
+_realms_lock = Lock()
+# whether the realms saved under the config root have been loaded
+_loaded = False
+# (index, count) of the partition of realms this process serves, or None
+_partition = None
 def get(realm_id):
     """return a realm for the given realm_id"""
     realm = _realms.get(realm_id, None)
     if realm is None:
-        realm = Realm(realm_id)
-        _realms[realm_id] = realm
+        with _realms_lock:
+            realm = _realms.get(realm_id, None)
+            if realm is None:
+                realm = Realm(realm_id)
+                _realms[realm_id] = realm
     return realm
 
 def current():
-    return _realms.values()
+    _load_realms()
+    return list(_realms.values())
+
+def exists(realm_id):
+    """return True if realm_id is held by this process"""
+    _load_realms()
+    return realm_id in _realms
 
 def delete(realm_id):
     """delete the realm at realm_id and remove the associated config file"""
-    realm = _realms.pop(realm_id, None)
+    with _realms_lock:
+        realm = _realms.pop(realm_id, None)
     if realm is not None:
-        try:
-            os.remove(realm.realm_config_path)
-        except OSError:
-            pass
+        realm.close()
+    # the files are removed whether or not the realm was loaded
+    p = os.path.join(config.realms['realms_config_root'], realm_id)
+    journal.remove(p + ".realm", p + ".journal", p + ".journal" +
+                   journal.PREVIOUS, p + ".snapshot")
+
+
+def owner(realm_id, count):
+    """return which of count partitions realm_id belongs to"""
+    if not isinstance(realm_id, bytes):
+        realm_id = realm_id.encode('utf-8')
+    return (zlib.crc32(realm_id) & 0xffffffff) % count
+
+
+def owns(realm_id):
+    """return True if realm_id is in the partition this process serves"""
+    return _partition is None or \
+        owner(realm_id, _partition[1]) == _partition[0]
+
+
+def set_partition(index, count):
+    """serve only the realms of partition index of count, see restq.router.
+    Realms inherited from a parent process are forgotten rather than closed,
+    their files are the parent's."""
+    global _realms, _loaded, _partition
+    _partition = (index, count)
+    _realms = {}
+    _loaded = False
 
 
 def set_realms_config_root(config_root):
-    global _realms
+    global _realms, _loaded
+    for realm in _realms.values():
+        realm.close()
     _realms = {}
+    _loaded = False
 
     config.realms['realms_config_root'] = config_root
     if not os.path.exists(config_root):
         os.makedirs(config_root)
+set_realms_config_root(config.realms['realms_config_root'])
+
 
-    for filename in os.listdir(config_root):
+def _load_realms():
+    """load the realms saved under the config root, on first use so that
+    importing the client doesn't open every realm's journal"""
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    for filename in os.listdir(config.realms['realms_config_root']):
         realm_id, ext = os.path.splitext(filename)
-        if ext == '.realm':
+        if ext == '.realm' and owns(realm_id):
             get(realm_id)
-set_realms_config_root(config.realms['realms_config_root'])
 
 
 def get_status():
@@ -349,27 +2095,57 @@ def get_status():
 
         returns {'realm_id':realm.status}
     """
+    _load_realms()
     status = {}
-    for realm_id, realm in dictiter(_realms):
-        status[realm_id] = realm.status
+    for realm_id, realm in list(_realms.items()):
+        try:
+            status[realm_id] = realm.status
+        except RealmMoved:
+            # on its way to another node, which answers for it
+            continue
     return status
 
-def pull(count, realms=None):
-    """pull next priority jobs across multiple realms"""
+def pull(count, realms=None, wait=None):
+    """pull next priority jobs across multiple realms, waiting up to wait
+    seconds for a job to become available if there are none"""
     if realms is None:
-        realms = current()
+        # listed on each try, a realm may be created while we wait
+        listed = lambda: sorted(current(), key=lambda r: r.realm_id)
     else:
         realms = [get(r) for r in realms]
-    queues = list(set(sum([r.queue_names() for r in realms], [])))
-    queues.sort()
+        listed = lambda: realms
+    if wait:
+        def next_expiry():
+            expiries = []
+            for r in listed():
+                try:
+                    expiries.append(r.next_expiry())
+                except RealmMoved:
+                    continue
+            expiries = [t for t in expiries if t is not None]
+            return min(expiries) if expiries else None
+        return wait_for_jobs(lambda: _pull(count, listed()), wait,
+                             next_expiry)
+    return _pull(count, listed())
+
+def _pull(count, realms):
+    # merge the queues with jobs across the realms in priority order, realms
+    # earlier in the list go first for queues of the same name
+    ctime = time.time()
+    ready = [[(key, i) for key in realm.ready_queues(ctime)]
+             for i, realm in enumerate(realms)]
     jobs = {}
-    for q in queues:
-        for r in realms:
-            for job_id, val in \
-                r.pull(max_queue=q, count=count-len(jobs)).iteritems():
-                # assumes job_id will be globally unique
-                # job_id -> realm, priority, data
-                jobs[job_id] = r.realm_id, val[0], val[1]
-            if len(jobs) >= count:
-                return jobs
+    for key, i in merge(*ready):
+        realm = realms[i]
+        try:
+            pulled = realm.pull_from(key[1], count - len(jobs))
+        except RealmMoved:
+            # the other realms are still pulled from while it moves
+            continue
+        for job_id, (queue_id, data) in dictiter(pulled):
+            # assumes job_id will be globally unique
+            # job_id -> realm, priority, data
+            jobs[job_id] = realm.realm_id, queue_id, data
+        if len(jobs) >= count:
+            break
     return jobs
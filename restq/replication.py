@@ -0,0 +1,331 @@
+"""Ship the changes made to realms on a primary to read-only replicas.
+
+A replica follows every realm of its primary (config.replication, or
+'restq web --replica-of=URI').  It long polls GET /<realm_id>/replicate on
+the primary for the mutations logged to the realm, the same records that are
+written to its journal, and applies them to its own copy of the realm.  A
+replica starts from, or falls back to, a copy of the whole realm.
+
+The read endpoints of a replica serve its copies, while the calls that would
+change a realm fail with ReadOnlyRealm.  POST /promote stops following the
+primary and makes the replica's realms writable.
+
+A primary keeps the log of changes to a realm from the first time a replica
+asks for it, holding the last config.replication['backlog'] of them.  A
+replica that falls further behind, or finds that the primary restarted, is
+sent the whole realm again.
+"""
+import marshal
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from threading import Event, Lock, Thread
+
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+from restq import client
+from restq import config
+from restq import journal
+from restq import realms
+
+
+MARSHAL = 'application/x-marshal'
+
+
+class ChangeLog(object):
+    """The recent changes to a realm, numbered from 1, kept for replicas.
+
+    Each change is (seq, time, record), the time it was made on the primary
+    and the record the realm journals.  epoch names the log, a replica that
+    was following another log must be sent the whole realm.
+    """
+
+    def __init__(self, backlog=None):
+        if backlog is None:
+            backlog = config.replication['backlog']
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.changes = deque(maxlen=backlog)
+        self.lock = Lock()
+        self.signal = realms.Signal()
+
+    def append(self, record):
+        with self.lock:
+            self.seq += 1
+            self.changes.append((self.seq, time.time(), record))
+        self.signal.notify()
+
+    def since(self, seq, count):
+        """return up to count changes made after seq and the time of the
+        first change left out, or None if those after seq are gone"""
+        with self.lock:
+            changes = self.changes
+            first = self.seq - len(changes) + 1
+            if not first - 1 <= seq <= self.seq:
+                return None
+            start = seq - first + 1
+            out = list(islice(changes, start, start + count))
+            rest = start + len(out)
+            pending = changes[rest][1] if rest < len(changes) else None
+        return out, pending
+
+
+def changes(realm, epoch=None, since=None, wait=None):
+    """return the marshalled changes made to realm after change since of log
+    epoch, waiting up to wait seconds for one if there are none.  Without a
+    since, or once those changes are gone, the whole realm is returned.
+
+    returns {'epoch': log, 'seq': last change returned, 'head': last change,
+             'time': now, 'pending': time of the first change left out,
+             'records': [(seq, time, record), ...]}
+    with 'settings' and 'state' holding the whole realm when it's sent.
+    """
+    log = realm._changes
+    if log is None:
+        with realm.lock.exclusive:
+            if realm._changes is None:
+                realm._changes = ChangeLog()
+            log = realm._changes
+    if epoch == log.epoch and since is not None:
+        version = log.signal.version
+        if wait and since == log.seq:
+            log.signal.wait(version, wait)
+        batch = log.since(since, config.replication['batch_size'])
+        if batch is not None:
+            records, pending = batch
+            seq = records[-1][0] if records else since
+            return marshal.dumps(dict(epoch=log.epoch, seq=seq, head=log.seq,
+                                      time=time.time(), pending=pending,
+                                      records=records),
+                                 journal.MARSHAL_VERSION)
+    with realm.lock.exclusive:
+        # the state is only still while the realm is held
+        return marshal.dumps(dict(epoch=log.epoch, seq=log.seq, head=log.seq,
+                                  time=time.time(), pending=None, records=[],
+                                  settings=realm._settings(),
+                                  state=realm._state()),
+                             journal.MARSHAL_VERSION)
+
+
+class Follower(Thread):
+    """Apply the changes made to a realm on the primary to the copy held
+    here.  lag is the age of the oldest change not yet applied.
+
+    The copy is known to be current as of synced, in time here.  A copy that
+    is caught up has no lag while the primary answers, the long poll brings
+    each change as it's made.  Otherwise the lag is all of the time since
+    synced, so it grows while the primary can't be reached."""
+
+    def __init__(self, realm_id, primary, requester):
+        Thread.__init__(self, name='restq-replica-%s' % realm_id)
+        self.daemon = True
+        self.realm_id = realm_id
+        self.uri = '%s/%s/replicate' % (primary, realm_id)
+        self.requester = requester
+        self.realm = realms.get(realm_id)
+        self.realm.replica_of = primary
+        self.epoch = None
+        self.seq = None
+        self.synced = time.time()
+        self.caught_up = False
+        self.behind = 0
+        self.error = None
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.apply(self.fetch())
+                self.error = None
+            except Exception as exc:
+                self.error = '%s: %s' % (exc.__class__.__name__, exc)
+                self.stopped.wait(config.replication['retry_interval'])
+
+    def fetch(self):
+        wait = config.replication['wait']
+        params = {'wait': wait}
+        if self.epoch is not None:
+            params.update(epoch=self.epoch, since=self.seq)
+        r = self.requester.get(self.uri, params=params,
+                               timeout=config.client['timeout'] + wait)
+        if r.headers.get('content-type') != MARSHAL:
+            # raises the error the primary returned
+            client.decode_response(r.status_code,
+                                   r.headers.get('content-type'),
+                                   r.content, self.uri)
+        return marshal.loads(r.content)
+
+    def apply(self, changes):
+        realm = self.realm
+        with realm.lock.exclusive:
+            if self.stopped.is_set():
+                # promoted while the changes were fetched
+                return
+            try:
+                if 'state' in changes:
+                    realm._resync(changes['settings'], changes['state'])
+                for seq, _, record in changes['records']:
+                    realm._apply(record)
+                    realm._log(*record)
+            except Exception:
+                # the copy can't be trusted, start over from the whole realm
+                self.epoch = None
+                raise
+            realm._checkpoint()
+        self.epoch = changes['epoch']
+        self.seq = changes['seq']
+        self.behind = changes['head'] - changes['seq']
+        pending = changes['pending']
+        self.caught_up = pending is None
+        self.synced = time.time()
+        if pending is not None:
+            self.synced -= changes['time'] - pending
+
+    @property
+    def lag(self):
+        if self.caught_up and self.error is None:
+            return 0.0
+        return max(0.0, time.time() - self.synced)
+
+    def status(self):
+        return dict(epoch=self.epoch, seq=self.seq, behind=self.behind,
+                    lag=self.lag, error=self.error)
+
+
+class Replica(Thread):
+    """Follow each of the realms of the primary at uri, looking for new and
+    deleted realms every config.replication['wait'] seconds"""
+
+    def __init__(self, uri, requester=None):
+        Thread.__init__(self, name='restq-replica')
+        self.daemon = True
+        self.uri = uri.rstrip('/')
+        if requester is None:
+            requester = client.shared_session()
+        self.requester = requester
+        self.followers = {}
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def run(self):
+        primary = client.Realms(self.uri, requester=self.requester)
+        while not self.stopped.is_set():
+            try:
+                self.sync(primary.request('get', self.uri))
+            except Exception:
+                pass
+            self.stopped.wait(config.replication['wait'])
+
+    def sync(self, realm_ids):
+        """follow the realm_ids of the primary and drop the rest"""
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            for realm_id in realm_ids:
+                if realm_id not in self.followers:
+                    follower = Follower(realm_id, self.uri, self.requester)
+                    self.followers[realm_id] = follower
+                    follower.start()
+            for realm_id in list(self.followers):
+                if realm_id not in realm_ids:
+                    self.followers.pop(realm_id).stopped.set()
+                    realms.delete(realm_id)
+
+    def stop(self):
+        """stop following the primary, the realms held here are writable
+        once this returns"""
+        with self.lock:
+            self.stopped.set()
+            followers = list(self.followers.values())
+        for follower in followers:
+            with follower.realm.lock.exclusive:
+                follower.stopped.set()
+                follower.realm.replica_of = None
+
+    def status(self):
+        with self.lock:
+            followers = list(self.followers.values())
+        return dict((f.realm_id, f.status()) for f in followers)
+
+
+_replica = None
+_replica_lock = Lock()
+
+
+def follow(uri):
+    """replicate the realms of the primary at uri"""
+    global _replica
+    with _replica_lock:
+        if _replica is not None:
+            raise ValueError("Already a replica of %s" % _replica.uri)
+        _replica = Replica(uri)
+        _replica.start()
+
+
+def following():
+    """return True if this is a replica"""
+    return _replica is not None
+
+
+def promote():
+    """stop following the primary, serving its realms read-write from now on,
+    returns the status the replica was left in"""
+    global _replica
+    with _replica_lock:
+        if _replica is None:
+            raise ValueError("This is not a replica")
+        replica, _replica = _replica, None
+    replica.stop()
+    return replica.status()
+
+
+def status():
+    """return the role of this node and the state of each replicated realm
+
+    return: {'primary': uri or None,
+             'realms': {realm_id: {epoch, seq, behind, lag, error}, ...}}
+    """
+    replica = _replica
+    if replica is None:
+        return {'primary': None, 'realms': {}}
+    return {'primary': replica.uri, 'realms': replica.status()}
+
+
+def configure():
+    """follow config.replication['primary'] when it's set"""
+    if config.replication['primary'] and not following():
+        follow(config.replication['primary'])
+
+
+class ReplicationCollector(object):
+    """Report how far behind the primary each realm followed here is"""
+
+    def describe(self):
+        return self._families()
+
+    def _families(self):
+        lag = GaugeMetricFamily(
+            'restq_replication_lag_seconds',
+            'Age of the oldest change to a realm not yet applied on this '
+            'replica',
+            labels=['realm'])
+        behind = GaugeMetricFamily(
+            'restq_replication_behind_changes',
+            'Number of changes to a realm not yet applied on this replica',
+            labels=['realm'])
+        return lag, behind
+
+    def collect(self):
+        lag, behind = self._families()
+        replica = _replica
+        if replica is not None:
+            with replica.lock:
+                followers = list(replica.followers.values())
+            for follower in followers:
+                lag.add_metric([follower.realm_id], follower.lag)
+                behind.add_metric([follower.realm_id], follower.behind)
+        return [lag, behind]
+
+
+REGISTRY.register(ReplicationCollector())
@@ -0,0 +1,509 @@
+"""Serve the restq web app from several worker processes.
+
+One process holds every realm behind the GIL, so a busy server saturates a
+single core.  With 'restq web --workers=N' the realms are partitioned over N
+worker processes by a hash of their realm_id (see realms.owner), each running
+the web app on its own port (the front port + 1 + its index) and loading only
+the realms it owns.  The front process runs the router app defined here:
+
+    /<realm_id>/...     is forwarded to the worker that owns realm_id
+    GET /               asks every worker and merges the realms
+    GET /job            pulls from every worker, keeping the count of jobs
+                        first in queue order and releasing the rest
+    POST, DELETE /jobs  splits the jobs by owner and merges the results
+    GET /metrics        joins the workers' metrics, labelled by worker
+    /profile            profiles every worker, their stacks under worker-N
+
+A realm is served by a single worker, the jobs of one realm are not split.
+
+Forwarding blocks the thread making the request until the worker answers,
+so the router is served a thread per request: the asyncio server runs each
+on its thread pool and with wsgiref a ThreadingWSGIServer is used.  Bodies
+larger than BUFSIZE are streamed through rather than read into memory.
+"""
+from __future__ import print_function
+import multiprocessing
+import sys
+import time
+import socket
+from threading import Condition, Thread
+from wsgiref.simple_server import WSGIServer
+if sys.version_info[0] < 3:
+    import httplib as client
+    from urllib import quote
+    from SocketServer import ThreadingMixIn
+else:
+    from http import client
+    from urllib.parse import quote
+    from socketserver import ThreadingMixIn
+
+import bottle
+from bottle import request, response
+
+from restq import codec
+from restq import config
+from restq import realms
+from restq import webapp
+from restq.client import session
+from restq.webapp import JSONError, wrap_json_error
+
+
+# bodies up to this size are read whole, larger ones are streamed
+BUFSIZE = 65536
+
+# the connections kept alive to each worker, at least one for each request
+# the router is likely to be forwarding at once
+POOL_SIZE = 64
+
+# the base uri of each worker, a realm is served by
+# _workers[realms.owner(realm_id, len(_workers))]
+_workers = []
+_session = None
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """the wsgiref server, serving each request on its own thread"""
+    daemon_threads = True
+
+
+def set_workers(uris):
+    """route requests to the workers at uris"""
+    global _session
+    _workers[:] = [uri.rstrip('/') for uri in uris]
+    _session = session(pool_size=max(POOL_SIZE, config.client['pool_size']))
+
+
+def _owner(realm_id):
+    return realms.owner(realm_id, len(_workers))
+
+
+def _forward(worker, method, path, query='', body=b'', headers=None,
+             stream=False):
+    """make a request of a worker, returns the requests.Response.  body may
+    be an iterable of chunks, which are sent with chunked encoding."""
+    url = _workers[worker] + quote(path.encode('utf-8'), safe='/')
+    if query:
+        url += '?' + query
+    return _session.request(method, url, data=body, headers=headers,
+                            stream=stream)
+
+
+def _body():
+    """return the request body, or an iterator over its chunks when it's
+    chunked or larger than BUFSIZE"""
+    if webapp._is_chunked() or request.content_length > BUFSIZE:
+        return webapp._iter_body()
+    return request.body.read()
+
+
+def _relay(r):
+    """return a worker's response to the client, streamed through when it's
+    chunked or larger than BUFSIZE, r is made with stream=True"""
+    response.status = r.status_code
+    response.content_type = r.headers.get('content-type', codec.JSON)
+    length = r.headers.get('content-length')
+    if length is not None and int(length) <= BUFSIZE:
+        return r.content
+    if length is not None:
+        response.content_length = length
+    return _iter_content(r)
+
+
+def _iter_content(r):
+    try:
+        for chunk in r.iter_content(BUFSIZE):
+            yield chunk
+    finally:
+        r.close()
+
+
+def _decode(r):
+    """return the decoded body of a worker's response, or raise it as the
+    response to the client if it failed"""
+    mime = codec.content_type(r.headers.get('content-type'))
+    if r.status_code >= 400:
+        try:
+            out = codec.loads(r.content, mime)
+        except Exception:
+            out = {}
+        raise JSONError(r.status_code, message=out.get('message', ''),
+                        exception=out.get('exception', 'Exception'))
+    return codec.loads(r.content, mime)
+
+
+def _each(func, items):
+    """return [func(item), ...] with each call made on its own thread"""
+    results = [None] * len(items)
+    failed = []
+    def call(i, item):
+        try:
+            results[i] = func(item)
+        except BaseException:
+            failed.append(sys.exc_info())
+    threads = [Thread(target=call, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failed:
+        exc_type, exc, tb = failed[0]
+        raise exc
+    return results
+
+
+def _headers():
+    headers = {'Accept': codec.accepted(request.headers.get('Accept'))}
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+    return headers
+
+
+def _mime():
+    return codec.content_type(request.content_type)
+
+
+app = bottle.Bottle()
+app.uninstall('json')
+app.install(webapp.CodecPlugin())
+
+
+@app.route('/<realm_id>/', method='DELETE')
+@app.route('/<realm_id>/<path:path>', method=['GET', 'PUT', 'POST', 'DELETE'])
+@wrap_json_error
+def forward(realm_id, path=''):
+    """forward a request on a realm to the worker that owns it"""
+    r = _forward(_owner(realm_id), request.method, request.path,
+                 request.query_string, _body(), _headers(), stream=True)
+    return _relay(r)
+
+
+@app.get('/')
+@wrap_json_error
+def realms_status():
+    """return all of the realms and their statuses"""
+    status = {}
+    headers = _headers()
+    for r in _each(lambda worker: _forward(worker, 'GET', '/',
+                                           headers=headers),
+                   range(len(_workers))):
+        status.update(_decode(r))
+    return status
+
+
+@app.get('/job')
+@wrap_json_error
+def pull_jobs():
+    """pull next priority jobs across all/subset of realms, see
+    webapp.pull_jobs"""
+    rlms = [r for r in request.GET.get('realms', '').split(',') if r]
+    count = request.GET.get('count', default=1, type=int)
+    wait = webapp._get_wait()
+    headers = _headers()
+    if rlms:
+        asked = {}
+        for realm_id in rlms:
+            asked.setdefault(_owner(realm_id), []).append(realm_id)
+    else:
+        asked = dict((worker, None) for worker in range(len(_workers)))
+
+    def pull(worker, wait=0):
+        query = [('count', count)]
+        if asked[worker] is not None:
+            query.append(('realms', ','.join(asked[worker])))
+        if wait:
+            query.append(('wait', wait))
+        query = '&'.join('%s=%s' % (k, quote(str(v), safe=','))
+                         for k, v in query)
+        return _decode(_forward(worker, 'GET', '/job', query,
+                                headers=headers))
+
+    jobs = {}
+    for pulled in _each(pull, sorted(asked)):
+        jobs.update(pulled)
+    if not jobs and wait:
+        jobs = _wait_for_jobs(pull, sorted(asked), wait)
+    return _keep_first(jobs, count, rlms)
+
+
+def _wait_for_jobs(pull, workers, wait):
+    """long poll each worker, returning the jobs of the first to answer with
+    any.  Jobs the others answer with later are released."""
+    cond = Condition()
+    answers = []
+    state = {'done': False, 'pending': len(workers)}
+
+    def wait_on(worker):
+        try:
+            pulled = pull(worker, wait)
+        except Exception:
+            pulled = {}
+        with cond:
+            state['pending'] -= 1
+            if not state['done']:
+                if pulled:
+                    state['done'] = True
+                    answers.append(pulled)
+                cond.notify()
+                return
+        _release(pulled)
+
+    for worker in workers:
+        thread = Thread(target=wait_on, args=(worker,))
+        thread.daemon = True
+        thread.start()
+    with cond:
+        while not answers and state['pending']:
+            cond.wait()
+        state['done'] = True
+    return answers[0] if answers else {}
+
+
+def _keep_first(jobs, count, rlms):
+    """return the count jobs first in queue order, then realm order,
+    releasing the rest"""
+    realm_order = dict((realm_id, i) for i, realm_id in enumerate(rlms))
+    def key(item):
+        job_id, (realm_id, queue_id, data) = item
+        return realms.queue_key(queue_id), \
+            realm_order.get(realm_id, len(rlms)), realm_id
+    ordered = sorted(jobs.items(), key=key)
+    _release(dict(ordered[count:]))
+    return dict(ordered[:count])
+
+
+def _release(jobs):
+    """release the leases of jobs={job_id: [realm_id, ...], ...}, which were
+    pulled for no client, so their deliveries aren't counted"""
+    by_realm = {}
+    for job_id, job in jobs.items():
+        by_realm.setdefault(job[0], []).append(job_id)
+    for realm_id, job_ids in by_realm.items():
+        body = codec.json_dumps({'jobs': job_ids, 'delivered': False})
+        _forward(_owner(realm_id), 'POST', '/%s/jobs/release' % realm_id,
+                 body=body, headers={'Content-Type': codec.JSON})
+
+
+@app.post('/jobs')
+@wrap_json_error
+def bulk_add_jobs():
+    """add jobs across realms, see webapp.bulk_add_jobs"""
+    if webapp._is_ndjson():
+        return _stream_add_jobs()
+    try:
+        jobs = codec.loads(request.body.read(), _mime())['jobs']
+        parts = {}
+        for i, job in enumerate(jobs):
+            parts.setdefault(_owner(job['realm_id']), []).append((i, job))
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='KeyError',
+                        message='Require jobs with a realm_id')
+    headers = {'Content-Type': codec.JSON, 'Accept': codec.JSON}
+    def add(worker):
+        body = codec.json_dumps({'jobs': [job for _, job in parts[worker]]})
+        return _decode(_forward(worker, 'POST', '/jobs', body=body,
+                                headers=headers))
+    workers = sorted(parts)
+    result = {'added': 0, 'errors': []}
+    for worker, out in zip(workers, _each(add, workers)):
+        result['added'] += out['added']
+        for error in out['errors']:
+            error['index'] = parts[worker][error['index']][0]
+            result['errors'].append(error)
+    result['errors'].sort(key=lambda error: error['index'])
+    return result
+
+
+def _stream_add_jobs():
+    """split the NDJSON lines of the request body by owner as they arrive,
+    forwarding them to the workers a batch at a time"""
+    batch_size = config.webapp['ingest_batch_size']
+    headers = {'Content-Type': 'application/x-ndjson', 'Accept': codec.JSON}
+    result = {'added': 0, 'errors': []}
+    batches = {}
+
+    def send(worker):
+        lines = batches.pop(worker)
+        body = b'\n'.join(line for _, line in lines)
+        out = _decode(_forward(worker, 'POST', '/jobs', body=body,
+                               headers=headers))
+        result['added'] += out['added']
+        for error in out['errors']:
+            error['line'] = lines[error['line'] - 1][0]
+            result['errors'].append(error)
+
+    for lineno, line in enumerate(webapp._iter_body_lines(), 1):
+        if not line.strip():
+            continue
+        try:
+            realm_id, _ = webapp._parse_job(line, None)
+        except ValueError as exc:
+            result['errors'].append(dict(line=lineno, job_id=None,
+                                         exception='ValueError',
+                                         message=str(exc)))
+            continue
+        worker = _owner(realm_id)
+        batches.setdefault(worker, []).append((lineno, line))
+        if len(batches[worker]) >= batch_size:
+            send(worker)
+    for worker in sorted(batches):
+        send(worker)
+    result['errors'].sort(key=lambda error: error['line'])
+    return result
+
+
+@app.delete('/jobs')
+@wrap_json_error
+def bulk_del_jobs():
+    """remove jobs across realms, body contains jobs=[(realm_id, job_id), ...]
+    """
+    try:
+        jobs = codec.loads(request.body.read(), _mime())['jobs']
+        parts = {}
+        for realm_id, job_id in jobs:
+            parts.setdefault(_owner(realm_id), []).append((realm_id, job_id))
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object in request body')
+    headers = {'Content-Type': codec.JSON, 'Accept': codec.JSON}
+    _each(lambda worker: _decode(_forward(
+              worker, 'DELETE', '/jobs',
+              body=codec.json_dumps({'jobs': parts[worker]}),
+              headers=headers)),
+          sorted(parts))
+    return {}
+
+
+@app.get('/performance')
+@wrap_json_error
+def performance():
+    """return the performance of each worker's web app by worker index"""
+    results = _each(lambda worker: _decode(_forward(worker, 'GET',
+                                                    '/performance')),
+                    range(len(_workers)))
+    return dict((str(worker), result) for worker, result in
+                enumerate(results))
+
+
+@app.post('/profile')
+@wrap_json_error
+def start_profile():
+    """start the profiler of each worker, returns their status by index"""
+    query = request.query_string
+    results = _each(lambda worker: _decode(_forward(worker, 'POST',
+                                                    '/profile', query)),
+                    range(len(_workers)))
+    return dict((str(worker), result) for worker, result in
+                enumerate(results))
+
+
+@app.route('/profile', method=['GET', 'DELETE'])
+@wrap_json_error
+def profile():
+    """the folded stacks the workers sampled, each under worker-N"""
+    method = request.method
+    texts = _each(lambda worker: _forward(worker, method, '/profile').text,
+                  range(len(_workers)))
+    lines = []
+    for worker, text in enumerate(texts):
+        lines.extend('worker-%d;%s' % (worker, line)
+                     for line in text.splitlines() if line)
+    response.content_type = 'text/plain'
+    return ''.join(line + '\n' for line in lines)
+
+
+@app.get('/metrics')
+def metrics():
+    """the workers' prometheus metrics, each sample labelled by worker"""
+    texts = _each(lambda worker: _forward(worker, 'GET', '/metrics').text,
+                  range(len(_workers)))
+    seen = set()
+    lines = []
+    for worker, text in enumerate(texts):
+        for line in text.splitlines():
+            if line.startswith('#'):
+                # keep the HELP and TYPE of each metric once
+                if line not in seen:
+                    seen.add(line)
+                    lines.append(line)
+            elif line:
+                lines.append(_label(line, 'worker="%d"' % worker))
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return '\n'.join(lines) + '\n'
+
+
+def _label(sample, label):
+    """add label to a sample line of the prometheus text format"""
+    name, sep, rest = sample.partition('{')
+    if sep:
+        if rest.startswith('}'):
+            return '%s{%s%s' % (name, label, rest)
+        return '%s{%s,%s' % (name, label, rest)
+    name, _, value = sample.partition(' ')
+    return '%s{%s} %s' % (name, label, value)
+
+
+def serve_worker(values, index, count, port):
+    """run the web app as worker index of count on port, values are the
+    config values of the front process"""
+    for interface, kwargs in values.items():
+        config.values[interface].update(kwargs)
+    realms.set_partition(index, count)
+    config.webapp['host'] = '127.0.0.1'
+    config.webapp['port'] = port
+    webapp.run()
+
+
+def start_workers(count, port):
+    """start count worker processes on the ports after port, returns the
+    processes once they are accepting connections"""
+    procs = []
+    for index in range(count):
+        proc = multiprocessing.Process(
+            target=serve_worker,
+            args=(config.values, index, count, port + 1 + index))
+        proc.daemon = True
+        proc.start()
+        procs.append(proc)
+    for index in range(count):
+        _wait_for_port(port + 1 + index, procs[index])
+    return procs
+
+
+def _wait_for_port(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not proc.is_alive():
+            raise RuntimeError("worker on port %d exited" % port)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("worker on port %d did not start" % port)
+
+
+def run():
+    """serve the router on the configured host and port, in front of
+    config.webapp['workers'] worker processes"""
+    count = config.webapp['workers']
+    port = config.webapp['port']
+    procs = start_workers(count, port)
+    set_workers(['http://127.0.0.1:%d' % (port + 1 + index)
+                 for index in range(count)])
+    bottle_kwargs = dict(debug=config.webapp['debug'],
+                         quiet=config.webapp['quiet'],
+                         host=config.webapp['host'],
+                         port=port,
+                         server=config.webapp['server'])
+    if bottle_kwargs['server'] == 'asyncio':
+        from restq import aioserver
+    elif bottle_kwargs['server'] == 'wsgiref':
+        bottle_kwargs['server_class'] = ThreadingWSGIServer
+    try:
+        bottle.run(app=app, **bottle_kwargs)
+    finally:
+        for proc in procs:
+            proc.terminate()
@@ -0,0 +1,162 @@
+"""Counters and histograms kept by the realms for the /metrics collector.
+
+They are updated on the hot path, so most are plain ints and lists with no
+lock of their own.  Each is only changed by the holder of the lock that
+guards the realm or queue it belongs to; readers take a copy without it.
+A Timing is updated by calls that run at the same time and so has a lock.
+"""
+import marshal
+import sys
+import time
+from bisect import bisect_left
+from threading import Lock
+
+
+if sys.version_info[0] < 3:
+    string_types = (str, unicode)
+else:
+    string_types = (bytes, str)
+
+
+# a clock for measuring short intervals
+clock = getattr(time, 'perf_counter', time.time)
+
+
+LOCK_BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5,
+                1, 5)
+SCAN_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+DELIVERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+# 1-2-5 steps from 10us to a minute, percentiles are read to within a step
+LATENCY_BUCKETS = tuple(m * 10 ** e for e in range(-5, 2) for m in (1, 2, 5)
+                        ) + (60,)
+
+
+class Histogram(object):
+    """Counts of observations in fixed buckets, the bucket bounds are
+    inclusive upper bounds as prometheus has them"""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def buckets(self):
+        """return [(bound, cumulative count), ...] ending with '+Inf'"""
+        counts = list(self.counts)
+        out = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), counts):
+            total += count
+            out.append((str(bound), total))
+        return out
+
+    def quantile(self, q, low=0, high=None):
+        """return an estimate of the q quantile, interpolated within the
+        bucket it falls in, low and high bound the first and last bucket"""
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        if not rank:
+            return None
+        total = 0
+        bounds = (low,) + self.bounds + (self.bounds[-1] if high is None else high,)
+        for i, count in enumerate(counts):
+            if count and total + count >= rank:
+                return bounds[i] + \
+                    (bounds[i + 1] - bounds[i]) * (rank - total) / count
+            total += count
+        return bounds[-1]
+
+
+class Timing(object):
+    """The calls made to something and the seconds they took, kept under a
+    lock as the calls are timed from many threads at once"""
+    __slots__ = ('lock', 'count', 'total', 'min', 'max', 'histogram')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.histogram = Histogram(LATENCY_BUCKETS)
+
+    def observe(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+            self.histogram.observe(seconds)
+
+    def summary(self):
+        """return {'call_count', 'total_time', 'min_time', 'max_time',
+        'mean_time', 'p50', 'p90', 'p99'}, the times are None until a call
+        is made"""
+        with self.lock:
+            out = dict(call_count=self.count, total_time=self.total,
+                       min_time=self.min, max_time=self.max,
+                       mean_time=self.total / self.count if self.count
+                                 else None)
+            for name, q in (('p50', .5), ('p90', .9), ('p99', .99)):
+                value = self.histogram.quantile(q, self.min, self.max)
+                # the estimate can't fall outside the times seen
+                if value is not None:
+                    value = min(max(value, self.min), self.max)
+                out[name] = value
+        return out
+
+
+class QueueStats(object):
+    """The jobs that went through a queue, the times they were handed out
+    before they left it and the jobs its pulls scanned"""
+    __slots__ = ('enqueued', 'dequeued', 'acked', 'expired', 'dead_lettered',
+                 'deliveries', 'scanned')
+
+    def __init__(self):
+        self.enqueued = 0
+        self.dequeued = 0
+        self.acked = 0
+        self.expired = 0
+        self.dead_lettered = 0
+        self.deliveries = Histogram(DELIVERY_BUCKETS)
+        self.scanned = Histogram(SCAN_BUCKETS)
+
+
+class RealmStats(object):
+    """The seconds spent waiting for and holding a realm's exclusive lock,
+    the time taken by each of its operations and the bytes of job data it
+    holds"""
+    __slots__ = ('lock_wait', 'lock_hold', 'data_bytes', 'ops')
+
+    def __init__(self):
+        self.lock_wait = Histogram(LOCK_BUCKETS)
+        self.lock_hold = Histogram(LOCK_BUCKETS)
+        self.data_bytes = 0
+        self.ops = {}
+
+    def op(self, name):
+        """return the Timing of the realm's operation name"""
+        timing = self.ops.get(name)
+        if timing is None:
+            timing = self.ops.setdefault(name, Timing())
+        return timing
+
+
+def data_size(data):
+    """return the bytes of job data, strings count their length and the rest
+    what they take journaled"""
+    if data is None:
+        return 0
+    if isinstance(data, string_types):
+        return len(data)
+    try:
+        return len(marshal.dumps(data))
+    except ValueError:
+        return sys.getsizeof(data)
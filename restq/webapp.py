@@ -6,8 +6,13 @@ import inspect
 import functools
 if sys.version_info[0] < 3:
     import httplib as client
+    string_types = (str, unicode)
+    integer_types = (int, long)
 else:
     from http import client
+    string_types = (str,)
+    integer_types = (int,)
+number_types = integer_types + (float,)
 import time
 import sys
 from getopt import getopt
@@ -17,10 +22,17 @@ from bottle import request, response
 bottle.BaseRequest.MEMFILE_MAX = 1600000000
 
 import prometheus_client
-from prometheus_client import Gauge, Summary
+from prometheus_client import Summary
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, \
+        HistogramMetricFamily
 
 from restq import realms 
 from restq import config
+from restq import codec
+from restq import cluster
+from restq import replication
+from restq import profiler
+from restq import stats
 
 # prometheus metrics state
 request_summary = Summary(
@@ -30,29 +42,111 @@ request_summary = Summary(
 )
 request_timer = lambda *x: request_summary.labels(*x).time()
 
-job_gauge = Gauge(
-    'restq_queued_jobs',
-    'Number of jobs in restq realms/queues',
-    ['realm', 'queue']
-)
-job_gauge._samples = lambda: _get_job_stats()
-
-tag_gauge = Gauge(
-    'restq_queued_tags',
-    'Number of tags in restq realms',
-    ['realm']
-)
-tag_gauge._samples = lambda: _get_tag_stats()
-
-def _get_job_stats():
-    d = realms.get_status()
-    return  [('', {'realm': name, 'queue': str(q)}, v) \
-        for name, detail in d.items() for q, v in detail['queues'].items()]
-
-def _get_tag_stats():
-    d = realms.get_status()
-    return  [('', {'realm': name}, detail['total_tags']) \
-        for name, detail in d.items()]
+class RealmCollector(object):
+    """Report the jobs, throughput, lock contention and pull scans of each
+    realm and queue, from the counts and stats the realms keep"""
+
+    def describe(self):
+        # the realms are only loaded once they're collected
+        return list(self._families().values())
+
+    def _families(self):
+        gauge = lambda name, doc, *labels: \
+                GaugeMetricFamily(name, doc, labels=list(labels))
+        counter = lambda name, doc, *labels: \
+                CounterMetricFamily(name, doc, labels=list(labels))
+        histogram = lambda name, doc, *labels: \
+                HistogramMetricFamily(name, doc, labels=list(labels))
+        families = dict(
+            (state, gauge('restq_%s_jobs' % state,
+                          'Number of %s jobs in restq realms/queues' % state,
+                          'realm', 'queue'))
+            for state in ('queued', 'available', 'leased', 'expired',
+                          'delayed'))
+        families.update(
+            tags=gauge('restq_queued_tags',
+                       'Number of tags in restq realms', 'realm'),
+            data_bytes=gauge('restq_job_data_bytes',
+                             'Bytes of job data held in a realm', 'realm'),
+            oldest_age=gauge('restq_oldest_job_age_seconds',
+                             'Seconds the oldest job waiting to be pulled '
+                             'has been in the queue', 'realm', 'queue'),
+            enqueued=counter('restq_enqueued_jobs',
+                             'Jobs added to a queue', 'realm', 'queue'),
+            dequeued=counter('restq_dequeued_jobs',
+                             'Jobs pulled from a queue', 'realm', 'queue'),
+            acked=counter('restq_acked_jobs',
+                          'Leased jobs removed from a queue', 'realm',
+                          'queue'),
+            expiries=counter('restq_expired_leases',
+                             'Leases that ran out before the job was '
+                             'removed', 'realm', 'queue'),
+            dead_lettered=counter('restq_dead_lettered_jobs',
+                                  'Jobs moved to the dead-letter queue of a '
+                                  'queue', 'realm', 'queue'),
+            deliveries=histogram('restq_job_deliveries',
+                                 'Times a job was handed out before it left '
+                                 'a queue', 'realm', 'queue'),
+            scanned=histogram('restq_pull_scanned_jobs',
+                              'Heap entries and queue slots a pull of a '
+                              'queue went through', 'realm', 'queue'),
+            lock_wait=histogram('restq_lock_wait_seconds',
+                                'Seconds waited for the exclusive lock of '
+                                'a realm', 'realm'),
+            lock_hold=histogram('restq_lock_hold_seconds',
+                                'Seconds the exclusive lock of a realm was '
+                                'held', 'realm'),
+            ops=histogram('restq_realm_operation_seconds',
+                          'Seconds an operation on a realm took, waiting '
+                          'for the realm included', 'realm', 'operation'))
+        return families
+
+    def collect(self):
+        families = self._families()
+        ctime = time.time()
+        for realm in sorted(realms.current(), key=lambda r: r.realm_id):
+            name = realm.realm_id
+            try:
+                status = realm.status
+            except realms.RealmMoved:
+                continue
+            for q, counts in status['queue_status'].items():
+                labels = [name, str(q)]
+                families['queued'].add_metric(labels, counts['total'])
+                for state in ('available', 'leased', 'expired', 'delayed'):
+                    families[state].add_metric(labels, counts[state])
+            families['tags'].add_metric([name], status['total_tags'])
+            families['data_bytes'].add_metric([name],
+                                              realm.stats.data_bytes)
+            for q, queue in list(realm.queues.items()):
+                labels = [name, str(q)]
+                queue_stats = queue.stats
+                families['oldest_age'].add_metric(labels,
+                                                  queue.oldest_age(ctime))
+                for key in ('enqueued', 'dequeued', 'acked'):
+                    families[key].add_metric(labels,
+                                             getattr(queue_stats, key))
+                families['expiries'].add_metric(labels, queue_stats.expired)
+                families['dead_lettered'].add_metric(
+                    labels, queue_stats.dead_lettered)
+                self._histogram(families['deliveries'], labels,
+                                queue_stats.deliveries)
+                self._histogram(families['scanned'], labels,
+                                queue_stats.scanned)
+            self._histogram(families['lock_wait'], [name],
+                            realm.stats.lock_wait)
+            self._histogram(families['lock_hold'], [name],
+                            realm.stats.lock_hold)
+            for op, timing in sorted(list(realm.stats.ops.items())):
+                with timing.lock:
+                    self._histogram(families['ops'], [name, op],
+                                    timing.histogram)
+        return [families[key] for key in sorted(families)]
+
+    def _histogram(self, family, labels, histogram):
+        family.add_metric(labels, histogram.buckets(), histogram.sum)
+
+prometheus_client.REGISTRY.register(RealmCollector())
 
 
 class JSONError(bottle.HTTPResponse):
@@ -61,7 +155,7 @@ class JSONError(bottle.HTTPResponse):
             exception = exception.__name__
         elif isinstance(exception, Exception):
             exception = exception.__class__.__name__
-        elif not type(exception) in [str, unicode]:
+        elif not type(exception) in string_types:
             raise Exception("unknown exception type %s" % type(exception))
         body = json.dumps({'error': status,
                             'exception': exception,
@@ -80,6 +174,14 @@ def wrap_json_error(f):
             return f(*a, **k)
         except JSONError:
             raise
+        except realms.RealmMoved as exc:
+            raise JSONError(cluster.MISDIRECTED_REQUEST,
+                    exception=exc,
+                    message=str(exc))
+        except realms.ReadOnlyRealm as exc:
+            raise JSONError(client.FORBIDDEN,
+                    exception=exc,
+                    message=str(exc))
         except Exception as exc:
             raise JSONError(client.INTERNAL_SERVER_ERROR,
                     exception=exc,
@@ -88,27 +190,49 @@ def wrap_json_error(f):
 
 
 def profile_function(profile_dict):
+    """time each call to the route in profile_dict under its name"""
     def decorator(f):
-        p = dict(call_count=0, max_time=-1, min_time=9999, total_time=0)
-        profile_dict[f.func_name] = p
+        timing = profile_dict.setdefault(f.__name__, stats.Timing())
         @functools.wraps(f)
         def wrapper(*a, **k):
+            s = stats.clock()
             try:
-                s = time.time()
                 return f(*a, **k)
             finally:
-                t = time.time() - s
-                p['call_count'] += 1
-                p['max_time'] = max(p['max_time'], t)
-                p['min_time'] = max(p['min_time'], t)
-                p['total_time'] += t
+                timing.observe(stats.clock() - s)
         return wrapper
     return decorator
 
 
+# the stats.Timing of each route by the name of its function
 profile = dict()
 
 
+class CodecPlugin(object):
+    """Encode the dicts returned by routes as JSON, or as msgpack when the
+    request Accepts it, in place of bottle's JSONPlugin"""
+    name = 'json'
+    api = 2
+
+    def apply(self, callback, route):
+        @functools.wraps(callback)
+        def wrapper(*a, **k):
+            result = callback(*a, **k)
+            if isinstance(result, dict):
+                mime = codec.accepted(request.headers.get('Accept'))
+                response.content_type = mime
+                return codec.dumps(result, mime)
+            return result
+        return wrapper
+
+
+def _read_body(size=None):
+    """return the request body decoded with the codec of its Content-Type,
+    raises a ValueError if it can't be decoded"""
+    data = request.body.read() if size is None else request.body.read(size)
+    return codec.loads(data, codec.content_type(request.content_type))
+
+
 def _del_job(realm_id, job_id):
     realm = realms.get(realm_id)
     try:
@@ -132,17 +256,41 @@ def delete_job(realm_id, job_id):
 @request_timer('/realm/tag', 'delete')
 @profile_function(profile)
 def delete_tagged_jobs(realm_id, tag_id):
-    """Remove a tag and all of its jobs from a realm"""
+    """Remove a tag and all of its jobs from a realm, a slice of them at a
+    time.  Given progress=1 a line of NDJSON is streamed after each slice,
+    {"removed": count so far, "remaining": count}."""
     realm = realms.get(realm_id)
-    realm.remove_tagged_jobs(tag_id)
-    return {}
+    return _removal(realm.iter_remove_tagged_jobs(tag_id))
+
+def _removal(slices):
+    """run the removal slices, streaming their progress when asked to"""
+    if not request.GET.get('progress', default=0, type=int):
+        for _ in slices:
+            pass
+        return {}
+    response.content_type = NDJSON_TYPES[0]
+    return (codec.json_dumps({'removed': removed, 'remaining': remaining})
+            + b'\n' for removed, remaining in slices)
+
+
+def _not_before(job):
+    """return the time the job may first be pulled, given as not_before or as
+    delay seconds from now, or None to pull it at once"""
+    for key in ('not_before', 'delay'):
+        value = job.get(key, None)
+        if value is not None and (type(value) not in number_types):
+            raise ValueError("%s must be a number of seconds" % key)
+    if job.get('delay', None) is not None:
+        return time.time() + job['delay']
+    return job.get('not_before', None)
 
 
 def _add_job(realm_id, job_id, queue_id, job):
     data = job.get('data', None)
     tags = job.get('tags', [])
+    not_before = _not_before(job)
     realm = realms.get(realm_id)
-    realm.add(job_id, queue_id, data, tags=tags)
+    realm.add(job_id, queue_id, data, tags=tags, not_before=not_before)
 
 
 @bottle.put('/<realm_id>/job/<job_id>')
@@ -156,10 +304,12 @@ def add_job(realm_id, job_id):
     Optional fields:
         data - input type='file' - data returned on GET job request
              - Max size data is JOB_DATA_MAX_SIZE
+        not_before - the unix time the job may first be pulled at
+        delay - or the seconds from now it may first be pulled after
     """
     #validate input
     try:
-        body = json.loads(request.body.read())
+        body = _read_body()
     except ValueError:
         raise JSONError(client.BAD_REQUEST,
                         exception='ValueError',
@@ -170,9 +320,186 @@ def add_job(realm_id, job_id):
         raise JSONError(client.BAD_REQUEST,
                         exception='KeyError',
                         message='Require queue_id & data')
+    except ValueError as exc:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message=str(exc))
     return {}
 
 
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonlines',
+                'application/x-jsonlines')
+
+
+def _is_ndjson():
+    content_type = request.content_type.split(';')[0].strip().lower()
+    return content_type in NDJSON_TYPES
+
+
+def _iter_chunked(stream):
+    """yield the chunks of a chunked transfer encoded body"""
+    while True:
+        header = stream.readline()
+        try:
+            size = int(header.split(b';')[0], 16)
+        except ValueError:
+            raise JSONError(client.BAD_REQUEST,
+                            exception='ValueError',
+                            message='Bad chunk size in request body')
+        if size == 0:
+            # skip any trailers
+            while stream.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            return
+        yield stream.read(size)
+        stream.read(2)
+
+
+def _iter_sized(stream, length, bufsize=65536):
+    """yield the body of length bytes in chunks of up to bufsize"""
+    while length > 0:
+        chunk = stream.read(min(bufsize, length))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+def _is_chunked():
+    encoding = request.environ.get('HTTP_TRANSFER_ENCODING', '')
+    return 'chunked' in encoding.lower()
+
+
+def _iter_body():
+    """yield the request body in chunks as they are read from the client,
+    rather than buffering the whole body like request.body does"""
+    stream = request.environ['wsgi.input']
+    if _is_chunked():
+        return _iter_chunked(stream)
+    return _iter_sized(stream, request.content_length)
+
+
+def _iter_body_lines():
+    """yield the lines of the request body as they are read from the
+    client"""
+    pending = b''
+    for chunk in _iter_body():
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _job_tuple(job):
+    """return the tuple Realm.add_many takes for a job dict, which carries
+    the lease and deliveries of a job moved from another realm"""
+    job_tuple = (job['job_id'], job['queue_id'], job.get('data', None),
+                 job.get('tags', []))
+    not_before = _not_before(job)
+    leased_at = job.get('leased_at', None)
+    deliveries = job.get('deliveries', 0)
+    if leased_at is not None or deliveries:
+        return job_tuple + (not_before, leased_at, deliveries)
+    if not_before is not None:
+        job_tuple += (not_before,)
+    return job_tuple
+
+
+def _parse_job(line, realm_id):
+    """return realm_id and the tuple Realm.add_many takes from a line of
+    NDJSON"""
+    job = codec.json_loads(line)
+    if not isinstance(job, dict):
+        raise ValueError("Require a json object per line")
+    if realm_id is None:
+        realm_id = job.get('realm_id', None)
+        if not isinstance(realm_id, string_types):
+            raise ValueError("Require a realm_id string")
+    for key in ('job_id', 'queue_id'):
+        if not isinstance(job.get(key, None), string_types + integer_types):
+            raise ValueError("Require a %s string or int" % key)
+    tags = job.get('tags', [])
+    if not isinstance(tags, list) or \
+            not all(isinstance(tag, string_types) for tag in tags):
+        raise ValueError("Require tags as a list of strings")
+    return realm_id, _job_tuple(job)
+
+
+def _stream_add_jobs(realm_id=None):
+    """add the NDJSON jobs of the request body as they arrive, a batch at a
+    time, returns the count added and a list of the lines that failed"""
+    batch_size = config.webapp['ingest_batch_size']
+    batch = {}
+    pending = 0
+    result = {'added': 0, 'errors': []}
+    for lineno, line in enumerate(_iter_body_lines(), 1):
+        if not line.strip():
+            continue
+        try:
+            job_realm_id, job = _parse_job(line, realm_id)
+        except ValueError as exc:
+            result['errors'].append(dict(line=lineno, job_id=None,
+                                         exception='ValueError',
+                                         message=str(exc)))
+            continue
+        batch.setdefault(job_realm_id, []).append((lineno, job))
+        pending += 1
+        if pending >= batch_size:
+            _add_batch(batch, result)
+            batch = {}
+            pending = 0
+    _add_batch(batch, result)
+    result['errors'].sort(key=lambda error: error['line'])
+    return result
+
+
+def _add_batch(batch, result, where='line'):
+    """add batch={realm_id: [(where, job), ...]} with a Realm.add_many per
+    realm, counting the jobs added and the errors into result"""
+    for realm_id, jobs in batch.items():
+        realm = realms.get(realm_id)
+        failed = realm.add_many([job for _, job in jobs])
+        for i, exc in failed:
+            position, job = jobs[i]
+            error = dict(job_id=job[0], exception=exc.__class__.__name__,
+                         message=str(exc))
+            error[where] = position
+            result['errors'].append(error)
+        result['added'] += len(jobs) - len(failed)
+
+
+def _bulk_add_jobs(realm_id=None):
+    """add the jobs of a {"jobs": [...]} body, a Realm.add_many per realm"""
+    try:
+        body = _read_body()
+    except ValueError:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object in request body')
+    batch = {}
+    result = {'added': 0, 'errors': []}
+    try:
+        for i, job in enumerate(body['jobs']):
+            job_realm_id = job['realm_id'] if realm_id is None else realm_id
+            try:
+                job_tuple = _job_tuple(job)
+            except ValueError as exc:
+                result['errors'].append(dict(index=i, job_id=job['job_id'],
+                                             exception='ValueError',
+                                             message=str(exc)))
+                continue
+            batch.setdefault(job_realm_id, []).append((i, job_tuple))
+    except KeyError:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='KeyError',
+                        message='Require queue_id & data')
+    _add_batch(batch, result, where='index')
+    result['errors'].sort(key=lambda error: error['index'])
+    return result
+
+
 @bottle.post('/<realm_id>/jobs')
 @wrap_json_error
 @request_timer('/realm/jobs', 'post')
@@ -181,24 +508,19 @@ def realm_bulk_add_jobs(realm_id):
     """Multiple job post
 
     body contains jobs=[job, job, job, ...]
-            where job={job_id, queue_id, data=None, tags=[]}
-
+            where job={job_id, queue_id, data=None, tags=[],
+                       not_before=None, delay=None}
+    A job exported from another realm also has the time it was leased_at
+    and the count of its deliveries, see cluster.export_jobs.
+    returns {'added': count, 'errors': [{index, job_id, exception, message}]}
+
+    Or with a Content-Type of application/x-ndjson the body is one job per
+    line, which is added as it streams in.  This returns:
+        {'added': count, 'errors': [{line, job_id, exception, message}, ...]}
     """
-    try:
-        body = json.loads(request.body.read())
-        try:
-            jobs = body['jobs']
-            for job in jobs:
-                _add_job(realm_id, job['job_id'], job['queue_id'], job)
-        except KeyError:
-            raise JSONError(client.BAD_REQUEST,
-                            exception='KeyError',
-                            message='Require queue_id & data')
-    except ValueError:
-        raise JSONError(client.BAD_REQUEST,
-                        exception='ValueError',
-                        message='Require json object in request body')
-    return {}
+    if _is_ndjson():
+        return _stream_add_jobs(realm_id)
+    return _bulk_add_jobs(realm_id)
 
 
 @bottle.post('/jobs')
@@ -209,22 +531,13 @@ def realms_bulk_add_jobs():
     """Multiple job post across multiple realms
 
     body contains jobs=[{realm_id, job_id, queue_id, data, tags)}, ...]
+
+    Or with a Content-Type of application/x-ndjson the body is one job per
+    line, streamed in as for POST /<realm_id>/jobs.
     """
-    try:
-        body = json.loads(request.body.read())
-        try:
-            jobs = body['jobs']
-            for job in jobs:
-                _add_job(job['realm_id'], job['job_id'], job['queue_id'], job)
-        except KeyError:
-            raise JSONError(client.BAD_REQUEST,
-                            exception='KeyError',
-                            message='Require queue_id & data')
-    except ValueError:
-        raise JSONError(client.BAD_REQUEST,
-                        exception='ValueError',
-                        message='Require json object in request body')
-    return {}
+    if _is_ndjson():
+        return _stream_add_jobs()
+    return _bulk_add_jobs()
 
 @bottle.delete('/<realm_id>/jobs')
 @wrap_json_error
@@ -233,18 +546,16 @@ def realms_bulk_add_jobs():
 def realm_bulk_del_jobs(realm_id):
     """Multiple job post
 
-    body contains jobs=[job, job, job, ...]
-            where job={job_id, queue_id, data=None, tags=[]}
+    body contains jobs=[job_id, job_id, ...]
     """
     try:
-        body = json.loads(request.body.read())
+        body = _read_body()
         jobs = body['jobs']
-        for job_id in jobs:
-            _del_job(realm_id, job_id)
     except ValueError:
         raise JSONError(client.BAD_REQUEST,
                         exception='ValueError',
                         message='Require json object in request body')
+    realms.get(realm_id).remove_many(jobs)
     return {}
 
 
@@ -258,14 +569,17 @@ def realms_bulk_del_jobs():
     body contains jobs=[(realm_id, job_id), ...]
     """
     try:
-        body = json.loads(request.body.read())
+        body = _read_body()
         jobs = body['jobs']
-        for realm_id, job_id in jobs:
-            _del_job(realm_id, job_id)
     except ValueError:
         raise JSONError(client.BAD_REQUEST,
                         exception='ValueError',
                         message='Require json object in request body')
+    batch = {}
+    for realm_id, job_id in jobs:
+        batch.setdefault(realm_id, []).append(job_id)
+    for realm_id, job_ids in batch.items():
+        realms.get(realm_id).remove_many(job_ids)
     return {}
 
 
@@ -279,6 +593,113 @@ def move_job(realm_id, job_id, from_q, to_q):
     return {}
 
 
+@bottle.post('/<realm_id>/jobs/move')
+@wrap_json_error
+@request_timer('/realm/jobs/move', 'post')
+@profile_function(profile)
+def realm_bulk_move_jobs(realm_id):
+    """Move multiple jobs between queues
+
+    body contains moves=[(job_id, from_q, to_q), ...]
+    returns {'errors': [{index, job_id, exception, message}, ...]}
+    """
+    try:
+        body = _read_body()
+        moves = [tuple(move) for move in body['moves']]
+        if any(len(move) != 3 for move in moves):
+            raise ValueError("moves are (job_id, from_q, to_q)")
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object of moves in request body')
+    realm = realms.get(realm_id)
+    failed = realm.move_many(moves)
+    return {'errors': [dict(index=i, job_id=moves[i][0],
+                            exception=exc.__class__.__name__,
+                            message=str(exc)) for i, exc in failed]}
+
+
+@bottle.post('/<realm_id>/job/<job_id>/renew')
+@wrap_json_error
+@request_timer('/realm/job/renew', 'post')
+@profile_function(profile)
+def renew_job(realm_id, job_id):
+    """Extend the lease on a checked out job
+
+    body contains extra=seconds, the lease then runs out that many seconds
+    from now
+    """
+    try:
+        body = _read_body()
+        extra = body['extra']
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object of extra in request body')
+    realms.get(realm_id).renew(job_id, extra)
+    return {}
+
+
+@bottle.post('/<realm_id>/job/<job_id>/release')
+@wrap_json_error
+@request_timer('/realm/job/release', 'post')
+@profile_function(profile)
+def release_job(realm_id, job_id):
+    """End the lease on a checked out job, handing it out again"""
+    realms.get(realm_id).release(job_id)
+    return {}
+
+
+@bottle.post('/<realm_id>/jobs/renew')
+@wrap_json_error
+@request_timer('/realm/jobs/renew', 'post')
+@profile_function(profile)
+def realm_bulk_renew_jobs(realm_id):
+    """Extend the leases on multiple checked out jobs
+
+    body contains renewals=[(job_id, extra), ...]
+    returns {'errors': [{index, job_id, exception, message}, ...]}
+    """
+    try:
+        body = _read_body()
+        renewals = [tuple(renewal) for renewal in body['renewals']]
+        if any(len(renewal) != 2 for renewal in renewals):
+            raise ValueError("renewals are (job_id, extra)")
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json renewals in request body')
+    failed = realms.get(realm_id).renew_many(renewals)
+    return {'errors': [dict(index=i, job_id=renewals[i][0],
+                            exception=exc.__class__.__name__,
+                            message=str(exc)) for i, exc in failed]}
+
+
+@bottle.post('/<realm_id>/jobs/release')
+@wrap_json_error
+@request_timer('/realm/jobs/release', 'post')
+@profile_function(profile)
+def realm_bulk_release_jobs(realm_id):
+    """End the leases on multiple checked out jobs
+
+    body contains jobs=[job_id, job_id, ...] and optionally delivered=false
+    for jobs pulled for no worker, see Realm.release_many
+    returns {'errors': [{index, job_id, exception, message}, ...]}
+    """
+    try:
+        body = _read_body()
+        jobs = list(body['jobs'])
+        delivered = bool(body.get('delivered', True))
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object of jobs in request body')
+    failed = realms.get(realm_id).release_many(jobs, delivered)
+    return {'errors': [dict(index=i, job_id=jobs[i],
+                            exception=exc.__class__.__name__,
+                            message=str(exc)) for i, exc in failed]}
+
+
 @bottle.get('/<realm_id>/job/<job_id>')
 @wrap_json_error
 @request_timer('/realm/job', 'get')
@@ -290,15 +711,70 @@ def get_job(realm_id, job_id):
     return job
 
 
+def _page_cursor(after):
+    """return the job_id a page of a tag follows from the after param"""
+    try:
+        after = codec.json_loads(after)
+    except ValueError:
+        return after
+    if not isinstance(after, string_types + integer_types):
+        raise ValueError("after must be a JSON encoded string or int")
+    return after
+
+
 @bottle.get('/<realm_id>/tag/<tag_id>')
 @wrap_json_error
 @request_timer('/realm/tag', 'get')
 @profile_function(profile)
 def get_tagged_jobs(realm_id, tag_id):
-    """return a dict of all jobs tagged by tag_id"""
+    """return a dict of all jobs tagged by tag_id, streamed a page at a time
+    when JSON is accepted.  Given a count or after, a page of them.
+
+    Optional query params:
+    fields - 'data' (the default), 'status' or 'ids', the parts of each job's
+             status returned, see Realm.iter_tagged_jobs
+    count - number of jobs in a page (default: config.webapp['tag_page_size'])
+    after - the job_id the page follows, the next of the page before, JSON
+            encoded so an int job_id stays an int.  A job_id that isn't
+            valid JSON is taken as the string given.
+
+    return: {job_id: status, ...}
+        or for a page {'jobs': {job_id: status, ...}, 'next': after or None}
+    """
     realm = realms.get(realm_id)
-    jobs = realm.get_tagged_jobs(tag_id)
-    return jobs
+    fields = request.GET.get('fields', default='data')
+    count = request.GET.get('count', default=None, type=int)
+    after = request.GET.get('after', default=None)
+    try:
+        if after is not None:
+            after = _page_cursor(after)
+        if count is not None or after is not None:
+            return realm.get_tagged_page(tag_id, after, count, fields)
+        jobs = realm.iter_tagged_jobs(tag_id, fields)
+    except ValueError as err:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message=str(err))
+    if codec.accepted(request.headers.get('Accept')) != codec.JSON:
+        return dict(jobs)
+    response.content_type = codec.JSON
+    return _iter_json_object(jobs, config.webapp['tag_page_size'])
+
+def _iter_json_object(items, size):
+    """yield the JSON of a dict of the (key, value) items, size items to a
+    chunk, without holding them all"""
+    yield b'{'
+    sep = b''
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) >= size:
+            yield sep + codec.json_dumps(dict(page))[1:-1]
+            sep = b','
+            page = []
+    if page:
+        yield sep + codec.json_dumps(dict(page))[1:-1]
+    yield b'}'
 
 
 @bottle.get('/<realm_id>/tag/<tag_id>/status')
@@ -306,7 +782,9 @@ def get_tagged_jobs(realm_id, tag_id):
 @request_timer('/realm/tag/status', 'get')
 @profile_function(profile)
 def get_tag_status(realm_id, tag_id):
-    """return an int of the number of jobs related to tag_id"""
+    """return the progress of the jobs tagged by tag_id, their count and
+    those queued, available, leased and completed, see
+    Realm.get_tag_status"""
     realm = realms.get(realm_id)
     status = realm.get_tag_status(tag_id)
     return status
@@ -321,7 +799,9 @@ def pull_realm_jobs(realm_id):
     realm = realms.get(realm_id)
     count = request.GET.get('count', default=1, type=int)
     max_queue = request.GET.get('max-queue')
-    job = realm.pull(count=count, max_queue=max_queue)
+    queue_id = request.GET.get('queue')
+    job = realm.pull(count=count, max_queue=max_queue, wait=_get_wait(),
+                     queue_id=queue_id)
     return job
 
 @bottle.get('/job')
@@ -335,11 +815,13 @@ def pull_jobs():
     sortable/comparable and any job_id's used are unique across realms.
 
     No effort is made to pull based on insert order across realms/queues
-    it is only guaranteed to prioritise based on queue names within realms.
+    it is only guaranteed to prioritise based on queue names.  Realms are
+    taken in name order (or the order given) for queues of the same name.
 
     Optional query params:
     count - number of jobs to pull (default: 1)
     realms - comma-separated list of realm names to pull from (default: all)
+    wait - seconds to wait for a job if there are none (default: 0)
 
     return: {
         'job_id1': ['realm_id', 'queue', 'data'],
@@ -350,19 +832,24 @@ def pull_jobs():
     rlms = [r for r in request.GET.get('realms', '').split(',') if r]
     count = request.GET.get('count', default=1, type=int)
     if not rlms:
-        rlms = [r.realm_id for r in realms.current()]
+        rlms = None
+
+    return realms.pull(realms=rlms, count=count, wait=_get_wait())
 
-    return realms.pull(realms=rlms, count=count)
+def _get_wait():
+    """return the wait query param, capped to config.webapp['max_wait']"""
+    wait = request.GET.get('wait', default=0, type=float)
+    return max(0, min(wait, config.webapp['max_wait']))
 
 @bottle.get('/<realm_id>/queues/<queue_id>/clear')
 @wrap_json_error
 @request_timer('/realm/status', 'get')
 @profile_function(profile)
 def clear_queue(realm_id, queue_id):
-    """remove all jobs from the given queue"""
+    """remove all jobs from the given queue, streaming the progress of each
+    slice given progress=1 as DELETE /<realm_id>/tag/<tag_id> does"""
     realm = realms.get(realm_id)
-    realm.clear_queue(queue_id)
-    return {}
+    return _removal(realm.iter_clear_queue(queue_id))
 
 
 # Get the status of the realm
@@ -384,7 +871,7 @@ def update_realm_config(realm_id):
     """update the configuration of a realm"""
     realm = realms.get(realm_id)
     try:
-        body = json.loads(request.body.read(4096))
+        body = _read_body(4096)
     except Exception as exc:
         raise JSONError(client.BAD_REQUEST,
                         exception=exc,
@@ -392,7 +879,7 @@ def update_realm_config(realm_id):
 
     lease_time = body.get('default_lease_time', None)
     if lease_time is not None:
-        if type(lease_time) not in (long, int):
+        if type(lease_time) not in integer_types:
             raise JSONError(client.BAD_REQUEST,
                     exception='TypeError',
                     message="default_lease_time not int")
@@ -406,11 +893,57 @@ def update_realm_config(realm_id):
             raise JSONError(client.BAD_REQUEST,
                     exception='ValueError',
                     message='queue_lease_time err - %s' % err)
-        if type(lease_time) not in (long, int):
+        if type(lease_time) not in integer_types:
             raise JSONError(client.BAD_REQUEST,
                     exception='TypeError',
                     message="default_lease_time not int")
         realm.set_queue_lease_time(queue_id, lease_time)
+
+    retry_delay = body.get('retry_delay', None)
+    if retry_delay is not None:
+        if type(retry_delay) not in number_types or retry_delay < 0:
+            raise JSONError(client.BAD_REQUEST,
+                    exception='TypeError',
+                    message="retry_delay not a number of seconds")
+        realm.set_retry_delay(retry_delay)
+
+    max_deliveries = body.get('queue_max_deliveries', None)
+    if max_deliveries is not None:
+        try:
+            if not 2 <= len(max_deliveries) <= 3 or \
+                    type(max_deliveries[1]) not in integer_types:
+                raise ValueError("require [queue_id, max_deliveries int, "
+                                 "dead-letter queue_id]")
+            realm.set_queue_max_deliveries(*max_deliveries)
+        except (ValueError, TypeError) as err:
+            raise JSONError(client.BAD_REQUEST,
+                    exception='ValueError',
+                    message='queue_max_deliveries err - %s' % err)
+
+    queue_retry = body.get('queue_retry_delay', None)
+    if queue_retry is not None:
+        try:
+            if not 2 <= len(queue_retry) <= 4 or \
+                    (queue_retry[1] is not None and
+                     type(queue_retry[1]) not in number_types) or \
+                    any(type(v) not in number_types
+                        for v in queue_retry[2:]):
+                raise ValueError("require [queue_id, retry_delay number or "
+                                 "null, backoff, max_retry_delay]")
+            realm.set_queue_retry_delay(*queue_retry)
+        except (ValueError, TypeError) as err:
+            raise JSONError(client.BAD_REQUEST,
+                    exception='ValueError',
+                    message='queue_retry_delay err - %s' % err)
+
+    durability = body.get('durability', None)
+    if durability is not None:
+        try:
+            realm.set_durability(durability)
+        except ValueError as err:
+            raise JSONError(client.BAD_REQUEST,
+                    exception='ValueError',
+                    message=str(err))
     return {}
 
 
@@ -428,8 +961,67 @@ def delete_realm(realm_id):
 @request_timer('/performance', 'get')
 @profile_function(profile)
 def webapp_performance():
-    """return the performance of the webapp"""
-    return profile
+    """return the performance of the webapp, the calls made to each route and
+    the seconds they took
+
+    return: {route: {'call_count', 'total_time', 'min_time', 'max_time',
+                     'mean_time', 'p50', 'p90', 'p99'}, ...}
+    """
+    return dict((name, timing.summary()) for name, timing in
+                list(profile.items()))
+
+
+@bottle.get('/<realm_id>/performance')
+@wrap_json_error
+@request_timer('/realm/performance', 'get')
+@profile_function(profile)
+def realm_performance(realm_id):
+    """return the calls made to each operation of the realm and the seconds
+    they took, waiting for the realm included, as /performance has them"""
+    realm = realms.get(realm_id)
+    return dict((op, timing.summary()) for op, timing in
+                list(realm.stats.ops.items()))
+
+
+@bottle.post('/profile')
+@wrap_json_error
+@request_timer('/profile', 'post')
+def start_profile():
+    """start sampling the stacks of the webapp's threads, see restq.profiler
+
+    interval - seconds between samples (default: config.profiler['interval'])
+    duration - seconds to sample for, at most
+               config.profiler['max_duration'] (the default)
+
+    return: {'running', 'started', 'interval', 'duration', 'samples'}
+    """
+    try:
+        interval = request.GET.get('interval', default=None, type=float)
+        duration = request.GET.get('duration', default=None, type=float)
+        return profiler.start(interval, duration)
+    except ValueError as err:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message=str(err))
+
+
+@bottle.get('/profile')
+@wrap_json_error
+@request_timer('/profile', 'get')
+def get_profile():
+    """return the stacks sampled so far as folded text, one stack and its
+    count of samples per line"""
+    response.content_type = 'text/plain'
+    return profiler.folded()
+
+
+@bottle.delete('/profile')
+@wrap_json_error
+@request_timer('/profile', 'delete')
+def stop_profile():
+    """stop sampling and return the stacks sampled, as GET /profile does"""
+    response.content_type = 'text/plain'
+    return profiler.stop()
 
 
 @bottle.get('/')
@@ -448,12 +1040,170 @@ def prometheus_metrics():
     return prometheus_client.generate_latest()
 
 
+@bottle.get('/cluster')
+@wrap_json_error
+@request_timer('/cluster', 'get')
+@profile_function(profile)
+def get_cluster():
+    """return the nodes of the cluster, empty if this isn't part of one
+
+    return: {'nodes': [uri, ...], 'node': uri, 'replicas': count}
+    """
+    return cluster.status()
+
+
+@bottle.post('/cluster')
+@wrap_json_error
+@request_timer('/cluster', 'post')
+@profile_function(profile)
+def set_cluster():
+    """set the nodes of the cluster, body contains nodes=[uri, ...]
+
+    The realms held here that another node now owns are served until they
+    are moved by POST /rebalance.
+    """
+    try:
+        body = _read_body(65536)
+        nodes = [str(node).rstrip('/') for node in body['nodes']]
+        cluster.configure(nodes)
+    except (ValueError, KeyError, TypeError) as exc:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message=str(exc))
+    return cluster.status()
+
+
+@bottle.post('/rebalance')
+@wrap_json_error
+@request_timer('/rebalance', 'post')
+@profile_function(profile)
+def rebalance():
+    """move the realms held here that another node owns to that node
+
+    return: {realm_id: {'added': count, 'errors': [...]}, ...}
+    """
+    return cluster.rebalance()
+
+
+@bottle.get('/<realm_id>/export')
+@wrap_json_error
+@request_timer('/realm/export', 'get')
+@profile_function(profile)
+def export_realm(realm_id):
+    """stream the jobs of the realm as NDJSON, one line per queue a job is
+    in, that POST /<realm_id>/jobs takes"""
+    realm = realms.get(realm_id)
+    response.content_type = NDJSON_TYPES[0]
+    return (codec.json_dumps(job) + b'\n'
+            for job in cluster.iter_export(
+                realm, config.webapp['ingest_batch_size']))
+
+
+@bottle.post('/<realm_id>/migrate')
+@wrap_json_error
+@request_timer('/realm/migrate', 'post')
+@profile_function(profile)
+def migrate_realm(realm_id):
+    """stream the jobs of the realm to another node and delete it here,
+    body contains to=uri
+
+    return: {'added': count, 'errors': [...]} from the other node
+    """
+    try:
+        body = _read_body(4096)
+        uri = str(body['to']).rstrip('/')
+    except (ValueError, KeyError, TypeError):
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message='Require json object of to in request body')
+    return cluster.migrate(realm_id, uri)
+
+
+@bottle.get('/<realm_id>/replicate')
+@wrap_json_error
+@request_timer('/realm/replicate', 'get')
+@profile_function(profile)
+def replicate_realm(realm_id):
+    """return the changes made to the realm for a replica, marshalled, see
+    restq.replication.changes
+
+    epoch - the log of changes the replica follows
+    since - the last change the replica applied
+    wait - seconds to wait for a change if there are none (default: 0)
+    """
+    if not realms.exists(realm_id):
+        raise KeyError("Realm '%s' does not exist" % realm_id)
+    since = request.GET.get('since', default=None, type=int)
+    epoch = request.GET.get('epoch', default=None)
+    changes = replication.changes(realms.get(realm_id), epoch, since,
+                                  _get_wait())
+    response.content_type = replication.MARSHAL
+    return changes
+
+
+@bottle.get('/replication')
+@wrap_json_error
+@request_timer('/replication', 'get')
+@profile_function(profile)
+def get_replication():
+    """return the primary this node replicates and how far behind each of
+    its realms is, see restq.replication.status"""
+    return replication.status()
+
+
+@bottle.post('/promote')
+@wrap_json_error
+@request_timer('/promote', 'post')
+@profile_function(profile)
+def promote():
+    """stop replicating the primary and serve its realms read-write"""
+    try:
+        return replication.promote()
+    except ValueError as err:
+        raise JSONError(client.BAD_REQUEST,
+                        exception='ValueError',
+                        message=str(err))
+
+
+@bottle.hook('before_request')
+def _check_writable():
+    """turn away changes made to a replica"""
+    if request.method not in ('GET', 'HEAD') and \
+            request.path not in ('/promote', '/profile') and \
+            replication.following():
+        raise JSONError(client.FORBIDDEN,
+                        exception='ReadOnlyRealm',
+                        message="This node is a replica of %s" %
+                                config.replication['primary'])
+
+
+@bottle.hook('before_request')
+def _check_owner():
+    """turn away calls on a realm that another node of the cluster owns"""
+    parts = request.path.lstrip('/').split('/', 1)
+    if len(parts) < 2:
+        return
+    owner = cluster.misdirected(parts[0])
+    if owner is not None:
+        raise JSONError(cluster.MISDIRECTED_REQUEST,
+                        exception='RealmMoved',
+                        message="Realm '%s' is served by %s" %
+                                (parts[0], owner))
+
+
 app = bottle.default_app()
+app.uninstall('json')
+app.install(CodecPlugin())
 def run():
     global proxy_requests
+    cluster.configure()
+    replication.configure()
     bottle_kwargs = dict(debug=config.webapp['debug'],
                          quiet=config.webapp['quiet'],
                          host=config.webapp['host'],
                          port=config.webapp['port'],
                          server=config.webapp['server'])
+    if bottle_kwargs['server'] == 'asyncio':
+        # registers the asyncio server adapter with bottle
+        from restq import aioserver
     bottle.run(app=app, **bottle_kwargs)
@@ -0,0 +1,75 @@
+"""Compare jobs/s of the per-job and batched realm operations.
+
+    python -m tests.bench_bulk [jobs] [queues]
+
+Each operation is run over a batch of jobs against a realm directly, and
+then through the bulk endpoints of the web app in process.
+"""
+from __future__ import print_function
+import json
+import sys
+import time
+
+import webtest
+
+from restq import realms
+from restq import webapp
+
+
+REALM = 'bench_bulk'
+
+
+def timed(label, count, func, *a):
+    t = time.time()
+    func(*a)
+    t = time.time() - t
+    print("%-28s %10.0f jobs/s" % (label, count / t))
+
+
+def per_job(realm, jobs, queues):
+    timed('add', len(jobs), lambda: [realm.add(*job) for job in jobs])
+    moves = [(job[0], job[1], (job[1] + 1) % queues) for job in jobs]
+    timed('move_job', len(jobs), lambda: [realm.move_job(*m) for m in moves])
+    job_ids = [job[0] for job in jobs]
+    timed('remove_job', len(jobs),
+          lambda: [realm.remove_job(job_id) for job_id in job_ids])
+
+
+def batched(realm, jobs, queues):
+    timed('add_many', len(jobs), realm.add_many, jobs)
+    moves = [(job[0], job[1], (job[1] + 1) % queues) for job in jobs]
+    timed('move_many', len(jobs), realm.move_many, moves)
+    timed('remove_many', len(jobs), realm.remove_many,
+          [job[0] for job in jobs])
+
+
+def http(jobs):
+    app = webtest.TestApp(webapp.app)
+    body = json.dumps({'jobs': [dict(job_id=job_id, queue_id=queue_id,
+                                     data=data, tags=tags)
+                                for job_id, queue_id, data, tags in jobs]})
+    timed('POST /realm/jobs', len(jobs), app.post, '/%s/jobs' % REALM, body)
+    body = '\n'.join(json.dumps(dict(job_id=job_id + len(jobs),
+                                     queue_id=queue_id, data=data, tags=tags))
+                     for job_id, queue_id, data, tags in jobs)
+    timed('POST /realm/jobs (ndjson)', len(jobs), app.post,
+          '/%s/jobs' % REALM, body.encode('utf-8'),
+          {'Content-Type': 'application/x-ndjson'})
+    body = json.dumps({'jobs': [job[0] for job in jobs]})
+    timed('DELETE /realm/jobs', len(jobs), app.delete, '/%s/jobs' % REALM,
+          body)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queues = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    jobs = [(i, i % queues, 'a' * 20, ['task %d' % (i % 100)])
+            for i in range(count)]
+    realms.delete(REALM)
+    try:
+        realm = realms.get(REALM)
+        per_job(realm, jobs, queues)
+        batched(realm, jobs, queues)
+        http(jobs)
+    finally:
+        realms.delete(REALM)
@@ -0,0 +1,90 @@
+"""Compare the sync client run on threads with the asyncio client.
+
+    python -m tests.bench_client [seconds] [concurrency]
+
+A restq server (the asyncio server) is started in its own process, then each
+client runs concurrency workers that add, pull and remove jobs for a number
+of seconds.  The sync client's workers are threads sharing its session, the
+asyncio client's are tasks on one loop sharing its connection pool.
+Python 3 only.
+"""
+from __future__ import print_function
+import asyncio
+import sys
+import threading
+import time
+
+from restq import aioclient
+from restq import client
+from tests.bench_server import free_port, start
+
+
+def sync_worker(realm, n, deadline, counts):
+    i = 0
+    while time.time() < deadline:
+        i += 1
+        job_id = '%d.%d' % (n, i)
+        realm.add(job_id, n % 4, i)
+        for pulled in realm.pull(1):
+            realm.remove_job(pulled)
+        counts[n] += 3
+
+
+def bench_sync(uri, seconds, concurrency):
+    session = client.session(pool_size=concurrency)
+    realm = client.Realms(uri, requester=session)['bench_client']
+    counts = [0] * concurrency
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=sync_worker,
+                                args=(realm, n, deadline, counts))
+               for n in range(concurrency)]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.time() - t)
+
+
+async def async_worker(realm, n, deadline, counts):
+    i = 0
+    while time.time() < deadline:
+        i += 1
+        job_id = '%d.%d' % (n, i)
+        await realm.add(job_id, n % 4, i)
+        for pulled in await realm.pull(1):
+            await realm.remove_job(pulled)
+        counts[n] += 3
+
+
+def bench_async(uri, seconds, concurrency):
+    loop = asyncio.new_event_loop()
+    pool = aioclient.ConnectionPool('127.0.0.1', int(uri.rsplit(':', 1)[1]),
+                                    size=concurrency)
+    realm = aioclient.Realms(uri, pool=pool)['bench_client']
+    counts = [0] * concurrency
+    deadline = time.time() + seconds
+    workers = [loop.create_task(async_worker(realm, n, deadline, counts))
+               for n in range(concurrency)]
+    t = time.time()
+    loop.run_until_complete(asyncio.gather(*workers))
+    t = time.time() - t
+    pool.close()
+    loop.close()
+    return sum(counts) / t
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    port = free_port()
+    proc = start('asyncio', port)
+    uri = 'http://127.0.0.1:%d' % port
+    try:
+        for name, bench in [('sync', bench_sync), ('asyncio', bench_async)]:
+            rate = bench(uri, seconds, concurrency)
+            print("%-8s client %8.0f requests/s (%d workers)" % \
+                    (name, rate, concurrency))
+    finally:
+        proc.terminate()
+        proc.wait()
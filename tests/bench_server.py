@@ -0,0 +1,110 @@
+"""Compare request throughput of the restq web app across server adapters.
+
+    python -m tests.bench_server [seconds] [connections] [server,...]
+
+Each server is started in its own process and hammered with GET and PUT
+requests from a number of concurrent connections, reusing connections
+where the server keeps them alive.  Python 3 only.
+"""
+from __future__ import print_function
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+
+
+SERVE = """
+from restq import config, webapp
+config.webapp.update(host='127.0.0.1', port=%d, server=%r, quiet=True)
+webapp.run()
+"""
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start(server, port):
+    proc = subprocess.Popen([sys.executable, '-c', SERVE % (port, server)])
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception("%s server failed to start" % server)
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').lower().split('\r\n')
+    length = 0
+    keep_alive = lines[0].startswith('http/1.1')
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value.strip() == 'keep-alive'
+    await reader.readexactly(length)
+    return keep_alive
+
+
+async def client(port, deadline, n, counts):
+    reader = writer = None
+    i = 0
+    while time.time() < deadline:
+        if writer is None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        i += 1
+        if i % 2:
+            body = json.dumps({'queue_id': 0, 'data': i}).encode()
+            request = ('PUT /bench/job/%d.%d HTTP/1.1\r\nHost: x\r\n'
+                       'Content-Length: %d\r\n\r\n' % (n, i, len(body)))
+            writer.write(request.encode() + body)
+        else:
+            writer.write(b'GET /bench/status HTTP/1.1\r\nHost: x\r\n\r\n')
+        if not await read_response(reader):
+            writer.close()
+            writer = None
+        counts[0] += 1
+    if writer is not None:
+        writer.close()
+
+
+def bench(server, seconds, connections):
+    port = free_port()
+    proc = start(server, port)
+    try:
+        counts = [0]
+        deadline = time.time() + seconds
+        async def clients():
+            await asyncio.gather(*[client(port, deadline, n, counts)
+                                   for n in range(connections)])
+        loop = asyncio.new_event_loop()
+        t = time.time()
+        loop.run_until_complete(clients())
+        t = time.time() - t
+        loop.close()
+        return counts[0] / t
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    servers = sys.argv[3].split(',') if len(sys.argv) > 3 \
+        else ['wsgiref', 'asyncio']
+    for server in servers:
+        rate = bench(server, seconds, connections)
+        print("%-10s %8.0f requests/s (%d connections)" % \
+                (server, rate, connections))
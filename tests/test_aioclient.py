@@ -0,0 +1,74 @@
+import unittest
+import sys
+import threading
+
+from restq import realms
+from restq import webapp
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio client needs Python 3.5")
+class TestAioClient(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        from functools import partial
+        from restq import aioclient, aioserver
+        realms.delete('aio')
+        self.server_loop = asyncio.new_event_loop()
+        start = asyncio.start_server(partial(aioserver._serve, webapp.app),
+                                     '127.0.0.1', 0)
+        self.server = self.server_loop.run_until_complete(start)
+        port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.server_loop.run_forever)
+        self.thread.start()
+        self.loop = asyncio.new_event_loop()
+        self.realms = aioclient.Realms('http://127.0.0.1:%d/' % port)
+        self.realm = self.realms['aio']
+
+    def tearDown(self):
+        self.complete(self.realms.close())
+        self.loop.close()
+        self.server_loop.call_soon_threadsafe(self.server_loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.server_loop.run_until_complete(self.server.wait_closed())
+        self.server_loop.close()
+        realms.delete('aio')
+
+    def complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_realm(self):
+        realm = self.realm
+        self.complete(realm.add("job 1", 0, 'data', tags=['t 1']))
+        self.complete(realm.bulk_add([dict(job_id=i, queue_id=1)
+                                      for i in range(5)]))
+        self.assertEqual(self.complete(realm.status)['total_jobs'], 6)
+        self.assertEqual(self.complete(realm.get_tag_status('t 1'))['count'],
+                         1)
+        self.assertEqual(list(self.complete(realm.get_tagged_jobs('t 1'))),
+                         ["job 1"])
+        self.assertEqual(
+            self.complete(realm.get_tagged_page('t 1', count=1,
+                                                fields='ids')),
+            {'jobs': {"job 1": {}}, 'next': None})
+        self.assertEqual(self.complete(realm.pull(2)),
+                         {"job 1": [0, 'data'], "0": [1, None]})
+        self.complete(realm.remove_job("job 1"))
+        self.complete(realm.bulk_remove([1, 2]))
+        self.assertEqual(self.complete(realm.status)['total_jobs'], 3)
+        with self.assertRaises(KeyError):
+            self.complete(realm.get_job("job 1"))
+        self.assertTrue('aio' in self.complete(self.realms.realms()))
+        # only one connection was needed for all of that
+        self.assertEqual(len(self.realms.pool._idle), 1)
+
+    def test_concurrent_pulls(self):
+        import asyncio
+        waiting = [self.loop.create_task(self.realm.pull(1, wait=5))
+                   for i in range(5)]
+        adds = [self.loop.create_task(self.realm.add(i, 0))
+                for i in range(5)]
+        results = self.complete(asyncio.gather(*(waiting + adds)))[:5]
+        self.assertEqual(sorted(list(r)[0] for r in results),
+                         ["0", "1", "2", "3", "4"])
@@ -0,0 +1,72 @@
+import unittest
+import json
+import socket
+import sys
+import threading
+
+from restq import webapp
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio server needs Python 3.5")
+class TestAioServer(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        from functools import partial
+        from restq import aioserver
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        start = asyncio.start_server(partial(aioserver._serve, webapp.app),
+                                     '127.0.0.1', 0)
+        self.server = self.loop.run_until_complete(start)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def exchange(self, *requests):
+        """send requests on one connection, return the raw responses"""
+        conn = socket.create_connection(('127.0.0.1', self.port))
+        f = conn.makefile('rb')
+        responses = []
+        for request in requests:
+            conn.sendall(request)
+            head = []
+            while not head or head[-1] != b'\r\n':
+                head.append(f.readline())
+            head = b''.join(head)
+            length = [int(l.split(b':')[1]) for l in head.split(b'\r\n')
+                      if l.lower().startswith(b'content-length')][0]
+            responses.append((head, f.read(length)))
+        f.close()
+        conn.close()
+        return responses
+
+    def test_keep_alive(self):
+        body = json.dumps({'queue_id': 0, 'data': 'x'}).encode()
+        put = b'PUT /aio/job/1 HTTP/1.1\r\nContent-Length: ' + \
+              str(len(body)).encode() + b'\r\n\r\n' + body
+        get = b'GET /aio/job HTTP/1.1\r\n\r\n'
+        delete = b'DELETE /aio/ HTTP/1.1\r\n\r\n'
+        (h1, b1), (h2, b2), (h3, b3) = self.exchange(put, get, delete)
+        self.assertTrue(h1.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(b'Connection: keep-alive' in h1)
+        self.assertEqual(json.loads(b2.decode()), {'1': [0, 'x']})
+
+    def test_chunked_request(self):
+        body = json.dumps({'queue_id': 0}).encode()
+        put = b'PUT /aio/job/2 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n' \
+              b'\r\n' + ('%x' % len(body)).encode() + b'\r\n' + body + \
+              b'\r\n0\r\n\r\n'
+        get = b'GET /aio/job/2 HTTP/1.0\r\n\r\n'
+        (h1, b1), (h2, b2) = self.exchange(put, get)
+        self.assertEqual(b1, b'{}')
+        self.assertTrue(b'Connection: close' in h2)
+        self.assertEqual(json.loads(b2.decode())['data'], None)
+        self.exchange(b'DELETE /aio/ HTTP/1.1\r\n\r\n')
@@ -48,3 +48,209 @@ class TestApi(unittest.TestCase):
         for i in range(50, 100):
             resp = self.app.delete("/realm/job/%d" % i)
             self.assertEquals(resp.status_int, 200)
+
+    def test_metrics(self):
+        #the realms' counts and stats are exported
+        realms.delete("metrics")
+        self.app.put("/metrics/job/0", json.dumps(dict(queue_id=1, data="x")))
+        self.app.get("/metrics/job?count=1")
+        self.app.delete("/metrics/job/0")
+        text = self.app.get("/metrics").text
+        for line in ['restq_enqueued_jobs_total{queue="1",realm="metrics"} 1.0',
+                     'restq_acked_jobs_total{queue="1",realm="metrics"} 1.0',
+                     'restq_job_data_bytes{realm="metrics"} 0.0',
+                     'restq_job_deliveries_bucket{le="1",queue="1",'
+                     'realm="metrics"} 1.0',
+                     'restq_dead_lettered_jobs_total{queue="1",'
+                     'realm="metrics"} 0.0',
+                     'restq_lock_wait_seconds_count{realm="metrics"} 2.0']:
+            self.assertTrue(line in text, line)
+        realms.delete("metrics")
+
+    def test_performance(self):
+        #each route and realm operation keeps its fastest and slowest calls
+        realms.delete("perf")
+        for i in range(20):
+            self.app.put("/perf/job/%d" % i, json.dumps(dict(queue_id=0)))
+        routes = self.app.get("/performance").json
+        add = routes["add_job"]
+        self.assertTrue(add["call_count"] >= 20)
+        self.assertTrue(add["min_time"] <= add["p50"] <= add["p90"] <=
+                        add["p99"] <= add["max_time"])
+        ops = self.app.get("/perf/performance").json
+        self.assertEqual(ops["add"]["call_count"], 20)
+        self.assertTrue(ops["add"]["min_time"] <= ops["add"]["max_time"])
+        text = self.app.get("/metrics").text
+        self.assertTrue('restq_realm_operation_seconds_count{operation="add",'
+                        'realm="perf"} 20.0' in text)
+        realms.delete("perf")
+
+    def test_profile(self):
+        #sample the stacks of the threads serving the app
+        status = self.app.post("/profile?interval=0.001").json
+        self.assertTrue(status["running"])
+        self.assertEqual(self.app.post("/profile", status=400).json[
+                         "exception"], "ValueError")
+        time.sleep(0.1)
+        folded = self.app.delete("/profile").text
+        self.assertTrue(folded)
+        for line in folded.splitlines():
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
+            self.assertTrue(";" in stack)
+        self.assertTrue("test_api.py:test_profile" in folded)
+        self.assertEqual(self.app.delete("/profile").text, folded)
+
+    def test_tagged_jobs(self):
+        #a tag's jobs are streamed a page at a time, or read by the page
+        realms.delete("tagged")
+        for i in range(25):
+            self.app.put("/tagged/job/%02d" % i,
+                         json.dumps(dict(queue_id=0, data=i, tags=["t"])))
+        webapp.config.webapp['tag_page_size'] = 10
+        try:
+            resp = self.app.get("/tagged/tag/t")
+        finally:
+            webapp.config.webapp['tag_page_size'] = 1000
+        jobs = resp.json
+        self.assertEqual(len(jobs), 25)
+        self.assertEqual(jobs["07"]["data"], 7)
+        page = self.app.get("/tagged/tag/t?count=20&after=04&fields=ids").json
+        self.assertEqual(page, {"jobs": dict(("%02d" % i, {})
+                                             for i in range(5, 25)),
+                                "next": None})
+        self.app.get("/tagged/tag/t?fields=all", status=400)
+        realms.delete("tagged")
+
+    def test_removal_progress(self):
+        #a tag is removed a slice at a time, reporting each slice
+        realms.delete("removal")
+        for i in range(25):
+            self.app.put("/removal/job/%d" % i,
+                         json.dumps(dict(queue_id=0, tags=["t"])))
+        realms.config.realms['removal_batch_size'] = 10
+        try:
+            resp = self.app.delete("/removal/tag/t?progress=1")
+        finally:
+            realms.config.realms['removal_batch_size'] = 10000
+        self.assertEqual([json.loads(line) for line in resp.text.splitlines()],
+                         [{"removed": 10, "remaining": 15},
+                          {"removed": 20, "remaining": 5},
+                          {"removed": 25, "remaining": 0}])
+        self.assertEqual(realms.get("removal").status["total_jobs"], 0)
+        realms.delete("removal")
+
+    def test_delayed_jobs(self):
+        #jobs are delayed by a put, a bulk post or an NDJSON line
+        realms.delete("delayed")
+        self.app.put("/delayed/job/0", json.dumps(dict(queue_id=0, delay=60)))
+        resp = self.app.put("/delayed/job/1",
+                            json.dumps(dict(queue_id=0, delay="soon")),
+                            expect_errors=True)
+        self.assertEqual(resp.status_int, 400)
+        resp = self.app.post("/delayed/jobs", json.dumps(dict(jobs=[
+            dict(job_id=2, queue_id=0, not_before=time.time() + 60),
+            dict(job_id=3, queue_id=0, delay=[1]),
+            dict(job_id=4, queue_id=0)])))
+        self.assertEqual(resp.json['added'], 2)
+        self.assertEqual([e['index'] for e in resp.json['errors']], [1])
+        self.app.post("/delayed/jobs", json.dumps(dict(job_id=5, queue_id=0,
+                                                       delay=60)),
+                      content_type='application/x-ndjson')
+        status = realms.get("delayed").status
+        self.assertEqual((status['total_jobs'], status['delayed_jobs']),
+                         (4, 3))
+        self.assertEqual(list(realms.get("delayed").pull(5)), [4])
+        self.app.post("/delayed/config", json.dumps(dict(retry_delay=5)))
+        self.assertEqual(realms.get("delayed").retry_delay, 5)
+        self.app.post("/delayed/config",
+                      json.dumps(dict(queue_max_deliveries=[0, 3, "dlq"])))
+        self.assertEqual(realms.get("delayed").queue_dead_letter,
+                         {0: (3, "dlq")})
+        resp = self.app.post("/delayed/config",
+                             json.dumps(dict(queue_max_deliveries=[0, "3"])),
+                             expect_errors=True)
+        self.assertEqual(resp.status_int, 400)
+        realms.delete("delayed")
+
+    def test_ndjson_add(self):
+        #stream jobs in as NDJSON, bad lines are reported and skipped
+        realms.delete("ndjson")
+        lines = [json.dumps(dict(job_id=i, queue_id=1, data=i, tags=["t"]))
+                 for i in range(10)]
+        lines.insert(3, "not json")
+        lines.insert(6, json.dumps(dict(job_id=0, queue_id=1, data="other")))
+        lines.append(json.dumps(dict(job_id=[1], queue_id=1)))
+        body = "\n".join(lines).encode('utf-8')
+        resp = self.app.post("/ndjson/jobs", body,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.json['added'], 10)
+        errors = resp.json['errors']
+        self.assertEqual([e['line'] for e in errors], [4, 7, 13])
+        self.assertEqual(errors[1]['job_id'], 0)
+        self.assertEqual(realms.get("ndjson").get_tag_status("t")['count'],
+                         10)
+
+        #the same across realms, with a chunked body
+        body = "".join(json.dumps(dict(realm_id="ndjson", job_id=i,
+                                       queue_id=1)) + "\n"
+                       for i in range(10, 15)).encode('utf-8')
+        chunked = b"".join(b"%x\r\n%s\r\n" % (len(body[i:i+16]), body[i:i+16])
+                           for i in range(0, len(body), 16)) + b"0\r\n\r\n"
+        resp = self.app.post("/jobs", chunked,
+                             content_type='application/x-ndjson',
+                             headers={'Transfer-Encoding': 'chunked'})
+        self.assertEqual(resp.json, {'added': 5, 'errors': []})
+        self.assertEqual(realms.get("ndjson").status['total_jobs'], 15)
+        realms.delete("ndjson")
+
+    def test_bulk_jobs(self):
+        #add, move and remove jobs in bulk
+        realms.delete("bulk")
+        jobs = [dict(job_id=i, queue_id=1, data=i) for i in range(10)]
+        jobs.append(dict(job_id=0, queue_id=1, data="other"))
+        resp = self.app.post("/bulk/jobs", json.dumps(dict(jobs=jobs)))
+        self.assertEqual(resp.json['added'], 10)
+        self.assertEqual([e['index'] for e in resp.json['errors']], [10])
+
+        moves = [[i, 1, 2] for i in range(5)] + [[99, 1, 2]]
+        resp = self.app.post("/bulk/jobs/move", json.dumps(dict(moves=moves)))
+        self.assertEqual([e['job_id'] for e in resp.json['errors']], [99])
+        self.assertEqual(realms.get("bulk").status['queues'], {1: 5, 2: 5})
+
+        body = json.dumps(dict(jobs=[["bulk", i] for i in range(8)]))
+        self.app.delete("/jobs", body)
+        body = json.dumps(dict(jobs=[8, 99]))
+        self.app.delete("/bulk/jobs", body)
+        self.assertEqual(realms.get("bulk").status['total_jobs'], 1)
+        realms.delete("bulk")
+
+    def test_export(self):
+        #an export imported elsewhere keeps the leases and deliveries
+        for realm_id in ("export", "import"):
+            realms.delete(realm_id)
+        realm = realms.get("export")
+        for i in range(4):
+            realm.add(i, 0, data=i, tags=["t"])
+        realm.add(4, 1, not_before=time.time() + 60)
+        self.assertEqual(list(realm.pull(2)), [0, 1])
+        realm.release(1)
+        resp = self.app.get("/export/export")
+        lines = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual([job['job_id'] for job in lines], [0, 1, 2, 3, 4])
+        self.assertTrue('leased_at' in lines[0])
+        self.assertEqual([job.get('deliveries') for job in lines],
+                         [1, 1, None, None, None])
+        resp = self.app.post("/import/jobs", resp.body,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.json, {'added': 5, 'errors': []})
+        imported = realms.get("import")
+        status = imported.status
+        self.assertEqual((status['total_jobs'], status['leased_jobs'],
+                          status['delayed_jobs']), (5, 1, 1))
+        self.assertEqual(imported.get_job(1)['deliveries'], [(0, 1)])
+        self.assertEqual(sorted(imported.pull(5)), [1, 2, 3])
+        self.assertEqual(imported.get_tag_status("t")['count'], 4)
+        for realm_id in ("export", "import"):
+            realms.delete(realm_id)
@@ -7,6 +7,7 @@ import webtest
 
 from restq import webapp
 from restq import client
+from restq import codec
 
 from tests import test_realms
 
@@ -21,11 +22,14 @@ def hooker(func):
                 res = object.__getattribute__(self, '_res')
                 if k == 'json':
                     return lambda: res.json
+                if k == 'content':
+                    return res.body
                 if k == 'ok':
                     return self.status_code == 200
                 if k == 'url':
                     return ''
                 return getattr(res, k)
+        k.pop('timeout', None)
         data = k.pop('data', None)
         if data is not None:
             a = list(a)
@@ -50,6 +54,7 @@ class Requester():
 
     @hooker
     def post(self, *a, **k): 
+        k['expect_errors'] = '*'
         return self.app.post(*a, **k)
 
     @hooker
@@ -67,14 +72,126 @@ class TestClient(test_realms.TestRealms):
         test_realms.TestRealms.setUp(self)
         requester = Requester()
         self.realms = client.Realms(uri='', requester=requester)
-    
-
-
-
-
-
-
-
-
 
+    def test_pipeline(self):
+        """adds and removes are queued and sent through the bulk calls"""
+        realm = self.realms.get('test')
+        calls = []
+        request = realm.request
+        def counted_request(rtype, uri, **k):
+            calls.append((rtype, uri))
+            return request(rtype, uri, **k)
+        realm.request = counted_request
+        with realm.pipeline(size=4) as result:
+            for i in range(6):
+                realm.add("job%s" % i, 'q0', i)
+            self.assertEqual(len(calls), 1)
+            realm.remove_job("job0")
+            realm.add("job6", 'q0', 'data')
+            self.assertEqual(len(calls), 4)
+            realm.add("job1", 'q0', 'other')
+        self.assertEqual(calls, [('post', '/test/jobs'),
+                                 ('post', '/test/jobs'),
+                                 ('delete', '/test/jobs'),
+                                 ('post', '/test/jobs'),
+                                 ('post', '/test/jobs')])
+        self.assertEqual(result['added'], 7)
+        self.assertEqual([e['job_id'] for e in result['errors']], ["job1"])
+        self.assertEqual(realm.status['total_jobs'], 6)
+        self.assertEqual(realm.bulk_flush(), {'added': 0, 'errors': []})
+        realm.add("job7", 'q0')
+        self.assertEqual(realm.status['total_jobs'], 7)
+
+    def test_tagged_page_int_ids(self):
+        """the after of a page keeps an int job_id an int"""
+        realm = self.realms.get('test')
+        realm.bulk_add([dict(job_id=i, queue_id='q0', tags=['ints'])
+                        for i in range(25)])
+        sizes = []
+        after = None
+        while True:
+            page = realm.get_tagged_page('ints', after, 10, fields='ids')
+            sizes.append(len(page['jobs']))
+            after = page['next']
+            if after is None:
+                break
+        self.assertEqual(sizes, [10, 10, 5])
+        self.assertEqual(len(list(realm.iter_tagged_jobs('ints',
+                                                         page_size=7))), 25)
+        page = realm.get_tagged_page('ints', 'job', 10)
+        self.assertEqual(page, {'jobs': {}, 'next': None})
+
+    def test_consumer(self):
+        """jobs are prefetched and acknowledged in batches"""
+        realm = self.realms.get('test')
+        realm.bulk_add([dict(job_id="job%s" % i, queue_id=i % 3, data=i)
+                        for i in range(50)])
+        handled = []
+        def handler(job_id, queue_id, data):
+            if data == 7:
+                raise ValueError("bad job")
+            handled.append(job_id)
+        errors = []
+        consumer = client.Consumer(
+                realm, handler, workers=3, prefetch=10, ack_batch_size=20,
+                wait=0.1, on_error=lambda job_id, exc: errors.append(job_id))
+        with consumer:
+            deadline = time.time() + 10
+            while consumer.stats['done'] + consumer.stats['failed'] < 50 \
+                    and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(sorted(handled),
+                         sorted("job%s" % i for i in range(50) if i != 7))
+        self.assertEqual(errors, ["job7"])
+        self.assertEqual(realm.status['total_jobs'], 1)
+        self.assertTrue(consumer.stats['pulls'] + consumer.stats['acks'] < 25)
+
+
+    def test_consumer_renews(self):
+        """leases are renewed while a job is worked on, and buffered jobs
+        are released on stop"""
+        realm = self.realms.get('test')
+        realm.set_default_lease_time(1)
+        realm.add("job0", 'q0', 'slow')
+        started = []
+        def handler(job_id, queue_id, data):
+            started.append(job_id)
+            time.sleep(2)
+        consumer = client.Consumer(realm, handler, workers=1, prefetch=2,
+                                   lease_time=1, wait=0.1)
+        with consumer:
+            time.sleep(0.2)
+            realm.add("job1", 'q0', 'buffered')
+            time.sleep(1.2)
+            # job0 would have expired without a renewal
+            self.assertEqual(realm.pull(2), {})
+        self.assertEqual(started, ["job0"])
+        self.assertTrue(consumer.stats['renewals'] >= 1)
+        self.assertEqual(consumer.stats['released'], 1)
+        self.assertEqual(list(realm.pull(2)), ["job1"])
+        self.assertEqual(realm.status['total_jobs'], 1)
+
+    def test_queue_retry_delay(self):
+        """a queue's retry backoff is set through the config"""
+        realm = self.realms.get('test')
+        realm.set_queue_retry_delay('q0', 1, 2, 30)
+        realm.set_queue_retry_delay('q1', 0.5, 1.5)
+        self.assertEqual(test_realms.realms.get('test').queue_retry,
+                         {'q0': (1, 2, 30), 'q1': (0.5, 1.5, 3600.0)})
+        realm.set_queue_retry_delay('q1', None)
+        self.assertEqual(list(test_realms.realms.get('test').queue_retry),
+                         ['q0'])
+        self.assertRaises(ValueError, realm.set_queue_retry_delay, 'q0', 1,
+                          0.5)
+        self.assertRaises(ValueError, realm.set_queue_retry_delay, 'q0',
+                          'soon')
+
+
+@unittest.skipIf(codec.msgpack is None, "msgpack is not installed")
+class TestClientMsgpack(test_realms.TestRealms):
 
+    def setUp(self):
+        test_realms.TestRealms.setUp(self)
+        requester = Requester()
+        self.realms = client.Realms(uri='', requester=requester,
+                                    wire_format='msgpack')
@@ -0,0 +1,160 @@
+import unittest
+import multiprocessing
+import shutil
+import sys
+import tempfile
+
+import requests
+
+from restq import client
+from restq import cluster
+from restq import config
+from restq import realms
+from restq import router
+from restq import webapp
+from tests.test_router import free_port
+
+
+REALMS = sorted('cluster%d' % i for i in range(30))
+
+
+def serve(values, root, nodes, node, port):
+    """run a cluster node on port with its realms under root"""
+    for interface, kwargs in values.items():
+        config.values[interface].update(kwargs)
+    # forget the realms of the parent process, their files are its own
+    realms.set_partition(0, 1)
+    realms.set_realms_config_root(root)
+    config.cluster['nodes'] = ','.join(nodes)
+    config.cluster['node'] = node
+    config.webapp['host'] = '127.0.0.1'
+    config.webapp['port'] = port
+    webapp.run()
+
+
+class TestCluster(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved = dict(config.webapp)
+        config.webapp['quiet'] = True
+        if sys.version_info >= (3, 5):
+            config.webapp['server'] = 'asyncio'
+        cls.ports = [free_port() for _ in range(3)]
+        cls.nodes = ['http://127.0.0.1:%d' % port for port in cls.ports]
+        cls.roots = []
+        cls.procs = []
+        for i in range(2):
+            cls.start(i, cls.nodes[:2])
+
+    @classmethod
+    def start(cls, i, nodes):
+        root = tempfile.mkdtemp()
+        proc = multiprocessing.Process(
+            target=serve,
+            args=(config.values, root, nodes, cls.nodes[i], cls.ports[i]))
+        proc.daemon = True
+        proc.start()
+        router._wait_for_port(cls.ports[i], proc)
+        cls.roots.append(root)
+        cls.procs.append(proc)
+
+    @classmethod
+    def tearDownClass(cls):
+        for proc in cls.procs:
+            proc.terminate()
+            proc.join()
+        for root in cls.roots:
+            shutil.rmtree(root)
+        config.webapp.update(cls.saved)
+
+    def held(self, node):
+        return sorted(requests.get(node + '/').json())
+
+    def test_cluster(self):
+        ring = cluster.HashRing(self.nodes[:2])
+        rlms = client.Realms(self.nodes[0])
+        self.assertEqual(rlms._cluster().nodes, self.nodes[:2])
+        result = rlms.bulk_add([dict(realm_id=realm_id, job_id='job%d' % i,
+                                     queue_id=i % 3, tags=['t%d' % i])
+                                for i, realm_id in enumerate(REALMS)])
+        self.assertEqual(result, {'added': 30, 'errors': []})
+        rlms['cluster0'].add('extra', 1, data='extra')
+
+        # each realm is held by its owner alone
+        for node in self.nodes[:2]:
+            self.assertEqual(self.held(node),
+                             [realm_id for realm_id in REALMS
+                              if ring.owner(realm_id) == node])
+        self.assertEqual(sorted(rlms), REALMS)
+
+        # a node answers for a realm it doesn't own with a 421
+        other = [node for node in self.nodes[:2]
+                 if node != ring.owner('cluster1')][0]
+        r = requests.get(other + '/cluster1/status')
+        self.assertEqual(r.status_code, cluster.MISDIRECTED_REQUEST)
+        self.assertEqual(r.json()['exception'], 'RealmMoved')
+
+        jobs = rlms.pull(count=40)
+        self.assertEqual(len(jobs), 31)
+        for i, realm_id in enumerate(REALMS):
+            rlms[realm_id].release('job%d' % i)
+        rlms['cluster0'].release('extra')
+
+        # add a third node and move the realms it now owns onto it
+        stale = client.Realms(self.nodes[0])
+        stale_realms = [stale[realm_id] for realm_id in REALMS]
+        self.start(2, self.nodes)
+        for node in self.nodes[:2]:
+            requests.post(node + '/cluster',
+                          json={'nodes': self.nodes}).raise_for_status()
+        moved = []
+        for node in self.nodes[:2]:
+            r = requests.post(node + '/rebalance')
+            r.raise_for_status()
+            moved.extend(r.json())
+        ring = cluster.HashRing(self.nodes)
+        self.assertEqual(sorted(moved),
+                         [realm_id for realm_id in REALMS
+                          if ring.owner(realm_id) == self.nodes[2]])
+        self.assertTrue(moved)
+        for node in self.nodes:
+            self.assertEqual(self.held(node),
+                             [realm_id for realm_id in REALMS
+                              if ring.owner(realm_id) == node])
+
+        # the stale client learns the new nodes when told a realm moved
+        for i, realm in enumerate(stale_realms):
+            self.assertEqual(realm.get_job('job%d' % i)['tags'],
+                             ['t%d' % i])
+        self.assertEqual(stale['cluster0'].status['total_jobs'], 2)
+        self.assertEqual(len(client.Realms(self.nodes[1]).pull(count=40)),
+                         31)
+
+    def test_failed_migration(self):
+        """a move that fails part way deletes the part copied"""
+        rlms = client.Realms(self.nodes[0])
+        node = rlms._cluster(refresh=True).owner('partial')
+        realms.delete('partial')
+        realm = realms.get('partial')
+        for i in range(3):
+            realm.add('job%d' % i, 'q0', i)
+        stream_add = client.Realm.stream_add
+        def lost(target, jobs):
+            stream_add(target, [next(iter(jobs))])
+            raise IOError("connection lost")
+        client.Realm.stream_add = lost
+        try:
+            self.assertRaises(IOError, cluster.migrate, 'partial', node)
+        finally:
+            client.Realm.stream_add = stream_add
+        self.assertNotIn('partial', self.held(node))
+        self.assertEqual(realm.moved_to, None)
+        self.assertEqual(realm.status['total_jobs'], 3)
+
+        # a copy that can't be deleted is reported
+        unreachable = 'http://127.0.0.1:%d' % free_port()
+        self.assertRaises(cluster.MigrationError, cluster.migrate,
+                          'partial', unreachable)
+        self.assertEqual(realm.moved_to, None)
+        realms.delete('partial')
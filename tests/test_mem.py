@@ -1,8 +1,19 @@
 import sys
 import time
+import resource
 from pprint import pprint
 
-from restq import realms 
+from restq import realms
+
+
+def rss():
+    """return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 
 if __name__ == '__main__':
     jobs = realms.get('test_mem')
@@ -16,13 +27,17 @@ if __name__ == '__main__':
         print("python test_mem.py 20 10000 2 1000")
         exit()
     print("Start insert")
+    mem = rss()
     t = time.time()
     for job_id in range(jobcount):
-        for task_id in range(taskcount):
-            for queue_id in range(queuecount):
-                jobs.add(job_id, task_id, queue_id, "a" * datasize)
+        tags = ["task %s" % (job_id % taskcount)]
+        for queue_id in range(queuecount):
+            jobs.add(job_id, queue_id, "a" * datasize, tags=tags)
     t = time.time() - t
+    mem = rss() - mem
     print("Completed insert in %0.2f" % t)
+    print("Using %d bytes per job (%d bytes of data)" % \
+            (mem / jobcount, datasize))
     pprint(jobs.status)
 
     print("Start dequeue")
@@ -32,4 +47,4 @@ if __name__ == '__main__':
         c += 5
     t = time.time() - t
     print("Pulled %s jobs in %0.2f seconds" % (c, t))
-    raw_input()
+    realms.delete('test_mem')
@@ -3,11 +3,13 @@ from pprint import pprint
 import time
 import os
 import sys
+import threading
 
 if sys.version_info[0] >= 3:
     from imp import reload
 
 from restq import realms
+from restq import stats
 
 
 class TestRealmsBase(unittest.TestCase):
@@ -102,7 +104,10 @@ class TestRealms(TestRealmsBase):
         self.assertEqual(status['total_jobs'], 1)
         self.assertEqual(status['total_tags'], 2)
         self.assertEqual(realm.get_tag_status('project 2')['count'], 1)
-        self.assertRaises(KeyError, realm.get_tag_status, 'project 1')
+        # the removed jobs are counted as completed for a while
+        self.assertEqual(realm.get_tag_status('project 1')['completed'], 1)
+        self.assertEqual(realm.get_tag_status('project 1')['count'], 0)
+        self.assertRaises(KeyError, realm.get_tag_status, 'project 3')
 
     def test_get_jobs(self):
         """get the state of a job"""
@@ -116,6 +121,73 @@ class TestRealms(TestRealmsBase):
         state = realm.get_tagged_jobs("task 1")
         state = realm.get_tagged_jobs("project 1")
 
+    def test_tagged_pages(self):
+        """read the jobs of a tag a page at a time"""
+        realm = self.realms.get('test')
+        for i in range(25):
+            realm.add("job%02d" % i, 'q0', i, tags=['t', 'e%d' % (i % 2)])
+        job_ids = ["job%02d" % i for i in range(25)]
+
+        page = realm.get_tagged_page('t', count=10)
+        self.assertEqual(sorted(page['jobs']), job_ids[:10])
+        self.assertEqual(page['next'], 'job09')
+        self.assertEqual(page['jobs']['job03']['data'], 3)
+        page = realm.get_tagged_page('t', 'job19', 10, fields='status')
+        self.assertEqual(sorted(page['jobs']), job_ids[20:])
+        self.assertEqual(page['next'], None)
+        self.assertEqual(sorted(page['jobs']['job20']),
+                         ['deliveries', 'queues', 'tags'])
+
+        jobs = list(realm.iter_tagged_jobs('e1', page_size=4))
+        self.assertEqual([job_id for job_id, _ in jobs], job_ids[1::2])
+        self.assertEqual([status['data'] for _, status in jobs],
+                         list(range(1, 25, 2)))
+        self.assertEqual(realm.get_tagged_jobs('e0', fields='ids'),
+                         dict((job_id, {}) for job_id in job_ids[::2]))
+        self.assertRaises(ValueError, realm.get_tagged_page, 't',
+                          fields='everything')
+
+    def test_tag_status(self):
+        """a tag counts its jobs as they're pulled, moved and removed"""
+        realm = self.realms.get('test')
+        realm.set_queue_lease_time('q0', 1)
+        for i in range(6):
+            realm.add("job%d" % i, 'q0', None, tags=['batch'])
+        realm.add("job0", 'q1', None, tags=['batch', 'other'])
+        realm.add("job9", 'q1', None)
+        status = realm.get_tag_status('batch')
+        self.assertEqual((status['count'], status['queued'],
+                          status['available'], status['leased']),
+                         (6, 7, 7, 0))
+
+        pulled = sorted(realm.pull(3, max_queue='q0'))
+        realm.remove_job(pulled[0])
+        realm.release(pulled[1])
+        realm.move_job("job5", 'q0', 'q1')
+        status = realm.get_tag_status('batch')
+        self.assertEqual((status['count'], status['completed'],
+                          status['queued'], status['leased']), (5, 1, 5, 1))
+        self.assertEqual(status['queues'],
+                         {'q0': {'total': 4, 'available': 3, 'leased': 1,
+                                 'delayed': 0},
+                          'q1': {'total': 1, 'available': 1, 'leased': 0,
+                                 'delayed': 0}})
+        status = realm.get_tag_status('other')
+        self.assertEqual((status['count'], status['completed']), (0, 1))
+
+        # the lease runs out when the queue is next pulled
+        time.sleep(1.2)
+        self.assertEqual(len(realm.pull(10, max_queue='q0')), 4)
+        self.assertEqual(realm.get_tag_status('batch')['leased'], 4)
+
+        realm.remove_tagged_jobs('batch')
+        status = realm.get_tag_status('batch')
+        self.assertEqual((status['count'], status['completed'],
+                          status['queued']), (0, 6, 0))
+        # a batch taken up again counts on
+        realm.add("job7", 'q0', None, tags=['batch'])
+        self.assertEqual(realm.get_tag_status('batch')['completed'], 6)
+
     def test_pull(self):
         """pull data test"""
         realm = self.realms.get('test')
@@ -195,6 +267,113 @@ class TestRealms(TestRealmsBase):
         realm.pull(5)
         self.assertRaises(ValueError, realm.move_job, "job3", "q1", "q2")
 
+    def test_renew_release(self):
+        """leases can be extended and given back early"""
+        realm = self.realms.get('test')
+        realm.set_default_lease_time(1)
+        realm.add("job0", "q0", 'h')
+        realm.add("job1", "q0", None)
+        self.assertRaises(ValueError, realm.renew, "job0", 1)
+        self.assertEqual(sorted(realm.pull(2)), ["job0", "job1"])
+        realm.renew("job0", 3)
+        realm.release("job1")
+        self.assertRaises(ValueError, realm.release, "job1")
+        self.assertRaises(ValueError, realm.release, "job9")
+        self.assertEqual(list(realm.pull(2)), ["job1"])
+
+        # job1's lease runs out but job0's was renewed
+        time.sleep(1.5)
+        self.assertEqual(list(realm.pull(2)), ["job1"])
+
+    def test_status_counts(self):
+        """each queue counts its available, leased and expired jobs"""
+        realm = self.realms.get('test')
+        realm.set_default_lease_time(1)
+        for i in range(5):
+            realm.add("job%d" % i, "q0")
+        realm.add("job0", "q1")
+        self.assertEqual(sorted(realm.pull(2)), ["job0", "job1"])
+        realm.renew("job1", 3)
+        status = realm.status
+        self.assertEqual(status['queue_status']['q0'],
+                dict(total=5, available=3, leased=2, expired=0, delayed=0,
+                     dead_lettered=0))
+        self.assertEqual(status['queue_status']['q1'],
+                dict(total=1, available=1, leased=0, expired=0, delayed=0,
+                     dead_lettered=0))
+        self.assertEqual(status['leased_jobs'], 2)
+
+        # job0's lease runs out but job1's was renewed
+        time.sleep(1.5)
+        status = realm.status
+        self.assertEqual(status['queue_status']['q0'],
+                dict(total=5, available=4, leased=1, expired=1, delayed=0,
+                     dead_lettered=0))
+        self.assertEqual(status['expired_jobs'], 1)
+        self.assertEqual(list(realm.pull(1)), ["job0"])
+        self.assertEqual(realm.status['queue_status']['q0'],
+                dict(total=5, available=3, leased=2, expired=0, delayed=0,
+                     dead_lettered=0))
+
+    def test_delayed_jobs(self):
+        """a delayed job isn't pulled before it's due"""
+        realm = self.realms.get('test')
+        realm.add("job0", "q0", None, tags=['t'], delay=0.5)
+        realm.add("job1", "q0", None, tags=['t'])
+        realm.add("job2", "q0", None, tags=['t'], not_before=time.time() - 1)
+        realm.add("job3", "q0", None, not_before=time.time() + 3600)
+        status = realm.status
+        self.assertEqual(status['delayed_jobs'], 3)
+        self.assertEqual(status['queue_status']['q0'],
+                dict(total=4, available=1, leased=0, expired=0, delayed=3,
+                     dead_lettered=0))
+        status = realm.get_tag_status('t')
+        self.assertEqual((status['queued'], status['available'],
+                          status['delayed']), (3, 1, 2))
+
+        self.assertEqual(sorted(realm.pull(5)), ["job1", "job2"])
+        self.assertFalse(realm.pull(5))
+        time.sleep(0.7)
+        self.assertEqual(list(realm.pull(5)), ["job0"])
+        self.assertEqual(realm.get_tag_status('t')['delayed'], 0)
+        self.assertEqual(realm.status['delayed_jobs'], 1)
+        realm.remove_job("job3")
+        self.assertEqual(realm.status['delayed_jobs'], 0)
+
+    def test_dead_letter(self):
+        """a job handed out max_deliveries times goes to the dead-letter
+        queue"""
+        realm = self.realms.get('test')
+        realm.set_queue_lease_time('q0', 1)
+        realm.set_queue_max_deliveries('q0', 2, 'dead')
+        realm.add("job0", "q0", None, tags=['t'])
+        realm.add("job1", "q0", None, tags=['t'])
+        self.assertEqual(list(realm.pull(1, max_queue='q0')), ["job0"])
+        time.sleep(1.1)
+        self.assertEqual(list(realm.pull(1, max_queue='q0')), ["job0"])
+        self.assertEqual([list(d) for d in realm.get_job("job0")['deliveries']],
+                         [['q0', 2]])
+        time.sleep(1.1)
+        self.assertEqual(list(realm.pull(1, max_queue='q0')), ["job1"])
+        status = realm.status
+        self.assertEqual(status['dead_lettered_jobs'], 1)
+        self.assertEqual(status['queue_status']['q0']['dead_lettered'], 1)
+        self.assertEqual(status['queues']['dead'], 1)
+        self.assertEqual([q for q, _ in realm.get_job("job0")['queues']],
+                         ['dead'])
+        status = realm.get_tag_status('t')
+        self.assertEqual(status['queues']['dead']['available'], 1)
+        self.assertEqual(status['queues']['q0']['total'], 1)
+        # the dead-letter queue is only pulled from by name
+        self.assertFalse(realm.pull(5))
+        self.assertEqual(list(realm.pull(5, queue_id='dead')), ["job0"])
+
+        # a dead-letter queue doesn't dead-letter
+        self.assertRaises(ValueError, realm.set_queue_max_deliveries,
+                          'dead', 2, 'q0')
+        self.assertRaises(ValueError, realm.set_queue_max_deliveries,
+                          'q1', 2, 'q0')
+
     def test_clear_queue(self):
         """clear queue test"""
         realm = self.realms.get('test')
@@ -313,3 +492,492 @@ class TestRealmsNonGeneric(TestRealmsBase):
         realm.add("job 1", 'q0', 'data one')
         self.assertRaises(ValueError,
                 realm.add, "job 1", "q0", "data broke")
+
+    def test_tagged_page_snapshot(self):
+        """int job_ids page in number order from a snapshot of the tag, the
+        jobs removed on the way are skipped and those added are missed"""
+        realm = self.realms.get('test')
+        for i in range(25):
+            realm.add(i, 'q0', i, tags=['ints'])
+        pages = [realm.get_tagged_page('ints', count=10, fields='ids')]
+        realm.remove_job(12)
+        realm.add(15.5, 'q0', tags=['ints'])
+        while pages[-1]['next'] is not None:
+            pages.append(realm.get_tagged_page('ints', pages[-1]['next'], 10,
+                                               fields='ids'))
+        self.assertEqual([sorted(page['jobs']) for page in pages],
+                         [list(range(10)), [10, 11] + list(range(13, 21)),
+                          list(range(21, 25))])
+        self.assertEqual([page['next'] for page in pages], [9, 20, None])
+        # a first page sees the tag as it is now
+        page = realm.get_tagged_page('ints', count=30, fields='ids')
+        self.assertEqual(len(page['jobs']), 25)
+
+        # a page after its snapshot was dropped takes the tag again
+        for i in range(realms.TAG_PAGE_SNAPSHOTS):
+            realm.add("other%d" % i, 'q0', tags=['t%d' % i])
+            realm.get_tagged_page('t%d' % i)
+        self.assertNotIn('ints', realm._tag_pages)
+        page = realm.get_tagged_page('ints', 20, 10, fields='ids')
+        self.assertEqual(sorted(page['jobs']), list(range(21, 25)))
+
+    def test_pull_order_after_expiry(self):
+        """expired leases go back into the queue in their original order"""
+        realm = self.realms.get('test')
+        realm.set_default_lease_time(0.5)
+        for i in range(5):
+            realm.add("job%s" % i, "q0", i)
+        self.assertEqual(len(realm.pull(3)), 3)
+        realm.remove_job("job1")
+        time.sleep(1)
+        realm.add("job5", "q0", 5)
+        pulled = [list(realm.pull(1))[0] for i in range(5)]
+        self.assertEqual(pulled, ["job0", "job2", "job3", "job4", "job5"])
+        self.assertFalse(realm.pull(1))
+
+    def test_durability(self):
+        """jobs survive a restart when the realm is journaled"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.add("job0", "q0", 'h', tags=['project 1'])
+        realm.add("job1", "q0", None, tags=['project 1', 'task 1'])
+        realm.add("job2", "q1", 443434)
+        realm.add("job3", "q0", [1, 2])
+        realm.pull(1, max_queue="q0")
+        realm.move_job("job1", "q0", "q2")
+        realm.remove_job("job3")
+        realm.add("job4", "q1", None, tags=['task 1'])
+        realm.remove_tagged_jobs('task 1')
+        status = realm.status
+        tag_status = realm.get_tag_status('project 1')
+        jobs = dict((j, realm.get_job(j)) for j in ["job0", "job2"])
+
+        # restart the realm from its journal
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.durability, 'per-op')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_tag_status('project 1'), tag_status)
+        self.assertEqual(realm.get_tag_status('task 1')['completed'], 2)
+        for job_id, job in jobs.items():
+            self.assertEqual(realm.get_job(job_id)['data'], job['data'])
+            self.assertEqual(realm.get_job(job_id)['tags'], job['tags'])
+        # job0 is still checked out
+        self.assertEqual(sorted(realm.pull(5)), ["job2"])
+        status = realm.status
+        tag_status = realm.get_tag_status('project 1')
+
+        # restart again from a snapshot plus a torn journal record
+        realm.close()
+        with open(realm.journal_path, 'ab') as f:
+            f.write(b'\x10\x00')
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_tag_status('project 1'), tag_status)
+        self.assertEqual(realm.get_tag_status('task 1')['completed'], 2)
+        self.assertFalse(realm.pull(5))
+
+    def test_background_snapshot(self):
+        """a snapshot is written out after the lock is let go, the old
+        journal is replayed until it's on disk"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.add("job0", "q0", 'h', tags=['t'])
+        realm.add("job1", "q0", None)
+        realm.remove_job("job1")
+        previous = realm.journal_path + realms.journal.PREVIOUS
+
+        # the process stops before the snapshot is written
+        write_snapshot = realms.journal.write_snapshot
+        drop_previous = realms.journal.Journal.drop_previous
+        realms.journal.write_snapshot = lambda path, state: None
+        realms.journal.Journal.drop_previous = lambda journal: None
+        try:
+            with realm.lock.exclusive:
+                realm._snapshot_behind()
+            realm._join_snapshot()
+        finally:
+            realms.journal.write_snapshot = write_snapshot
+            realms.journal.Journal.drop_previous = drop_previous
+        self.assertTrue(os.path.exists(previous))
+        realm.add("job2", "q1", [1, 2], tags=['t'])
+        status = realm.status
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_tag_status('t')['count'], 2)
+        self.assertFalse(os.path.exists(previous))
+
+        # the jobs changed while it's written are journaled after it
+        with realm.lock.exclusive:
+            realm._snapshot_behind()
+        realm.add("job3", "q0", None)
+        realm._join_snapshot()
+        self.assertFalse(os.path.exists(previous))
+        status = realm.status
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(sorted(realm.pull(5)), ["job0", "job2", "job3"])
+
+    def test_sliced_removal(self):
+        """tags and queues are emptied a slice at a time"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        for i in range(35):
+            realm.add("job%d" % i, 'q0', 'x', tags=['t'])
+            realm.add("job%d" % i, 'q%d' % (i % 2 + 1), 'x')
+        realm.add("keep", 'q0', 'x', tags=['k'])
+        realm.pull(5, max_queue='q0')
+        self.assertEqual(list(realm.iter_remove_tagged_jobs('t', 10)),
+                         [(10, 25), (20, 15), (30, 5), (35, 0)])
+        self.assertEqual(realm.status['total_jobs'], 1)
+        self.assertEqual(realm.status['queues'], {'q0': 1, 'q1': 0, 'q2': 0})
+        self.assertEqual(realm.stats.data_bytes, 1)
+        self.assertEqual(realm.get_tag_status('t')['completed'], 35)
+        self.assertRaises(KeyError, realm.iter_remove_tagged_jobs, 't')
+
+        for i in range(25):
+            realm.add("job%d" % i, 'q1', None)
+            realm.add("job%d" % i, 'q2', None)
+        progress = list(realm.iter_clear_queue('q1', 10))
+        self.assertEqual(progress, [(10, 15), (20, 5), (25, 0)])
+        self.assertEqual(realm.status['queues'],
+                         {'q0': 1, 'q1': 0, 'q2': 25})
+        realm.clear_queue('q2')
+        self.assertEqual(realm.status['total_jobs'], 1)
+        self.assertRaises(ValueError, realm.iter_clear_queue, 'q9')
+
+        # the slices are replayed from the journal
+        status = realm.status
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+
+    def test_retry_delay(self):
+        """a job whose lease ran out waits out the retry delay"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.set_default_lease_time(0.2)
+        realm.set_retry_delay(0.5)
+        realm.add("job0", "q0", None, tags=['t'])
+        realm.add("job1", "q0", None)
+        self.assertEqual(list(realm.pull(1)), ["job0"])
+        time.sleep(0.3)
+        self.assertEqual(list(realm.pull(5)), ["job1"])
+        self.assertEqual(realm.get_tag_status('t')['delayed'], 1)
+        self.assertEqual(realm.status['delayed_jobs'], 1)
+        # job0 is counted as delayed alone, each job in one column
+        counts = realm.status['queue_status']['q0']
+        self.assertEqual((counts['total'], counts['available'],
+                          counts['leased'], counts['expired'],
+                          counts['delayed']), (2, 0, 1, 0, 1))
+        self.assertEqual(counts['available'] + counts['leased'] +
+                         counts['delayed'], counts['total'])
+        # the delay runs from when the lease ran out
+        self.assertTrue(realm.next_expiry() <= time.time() + 0.5)
+
+        # delayed jobs and the retry delay survive a restart
+        realm.add("job2", "q1", None, delay=0.4)
+        realm.move_job("job2", "q1", "q2")
+        status = realm.status
+        tag_status = realm.get_tag_status('t')
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.retry_delay, 0.5)
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_tag_status('t'), tag_status)
+        realm._snapshot()
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertFalse(realm.pull(5))
+        time.sleep(0.5)
+        self.assertEqual(sorted(realm.pull(5)), ["job0", "job2"])
+        self.assertRaises(ValueError, realm.set_retry_delay, -1)
+
+    def test_dead_letter_durability(self):
+        """dead-lettering replays from the journal"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.set_default_lease_time(0.1)
+        realm.set_queue_max_deliveries('q0', 3)
+        realm.add("job0", "q0", None, tags=['t'])
+        realm.set_retry_delay(0.1)
+        self.assertEqual(list(realm.pull(1)), ["job0"])
+        time.sleep(0.15)
+        self.assertFalse(realm.pull(1))
+        self.assertTrue(realm.queues['q0'].delays["job0"] >
+                        realm.queues['q0'].leases.get("job0", 0) + 0.15)
+        time.sleep(0.15)
+        self.assertEqual(list(realm.pull(1)), ["job0"])
+        # the second retry waits as long as the first
+        time.sleep(0.15)
+        self.assertFalse(realm.pull(1))
+        time.sleep(0.1)
+        self.assertEqual(list(realm.pull(1)), ["job0"])
+        self.assertEqual(realm.queues['q0'].deliveries["job0"], 3)
+        status = realm.status
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.queue_dead_letter, {'q0': (3, 'dead-letter')})
+
+        # the pull that runs out job0's third lease moves it
+        time.sleep(0.15)
+        self.assertFalse(realm.pull(1, max_queue='q0'))
+        status = realm.status
+        self.assertEqual(status['queues'], {'q0': 0, 'dead-letter': 1})
+        self.assertEqual(realm.queues['q0'].stats.deliveries.counts[2], 1)
+        tag_status = realm.get_tag_status('t')
+        realm._snapshot()
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_tag_status('t'), tag_status)
+
+    def test_retry_backoff(self):
+        """a queue's retry delay backs off with each delivery"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.set_default_lease_time(0.1)
+        realm.set_queue_retry_delay('q0', 0.1, backoff=2, max_retry_delay=0.3)
+        realm.add("job0", "q0", None, tags=['t'])
+        realm.add("job1", "q1", None)
+        queue = realm.queues['q0']
+        # 0.1, 0.2 then 0.4 capped to 0.3 after a lease of 0.1
+        for delay in (0.2, 0.3, 0.4):
+            t = time.time()
+            self.assertEqual(list(realm.pull(1, max_queue='q0')), ["job0"])
+            time.sleep(0.15)
+            self.assertFalse(realm.pull(1, max_queue='q0'))
+            self.assertAlmostEqual(queue.delays["job0"] - t, delay,
+                                   delta=0.03)
+            time.sleep(queue.delays["job0"] - time.time() + 0.01)
+        # q1 keeps the realm's retry delay of 0
+        t = time.time()
+        self.assertEqual(sorted(realm.pull(2)), ["job0", "job1"])
+        time.sleep(0.15)
+        self.assertEqual(list(realm.pull(2)), ["job1"])
+
+        # the backoff and deliveries survive a restart
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.queue_retry, {'q0': (0.1, 2, 0.3)})
+        self.assertFalse(realm.pull(1, max_queue='q0'))
+        self.assertAlmostEqual(realm.queues['q0'].delays["job0"] - t, 0.4,
+                               delta=0.03)
+        realm.set_queue_retry_delay('q0', None)
+        self.assertEqual(realm.queue_retry, {})
+        self.assertRaises(ValueError, realm.set_queue_retry_delay, 'q0', -1)
+        self.assertRaises(ValueError, realm.set_queue_retry_delay, 'q0', 1,
+                          0.5)
+        self.assertRaises(ValueError, realm.set_queue_retry_delay, 'q0', 1,
+                          2, 0.5)
+
+    def test_concurrent_access(self):
+        """producers, consumers and readers run across threads"""
+        realm = self.realms.get('test')
+        realm.add("seed", 'q0', 0, tags=['t'])
+        errors = []
+        pulled = []
+        def run(func, *a):
+            try:
+                func(*a)
+            except Exception as exc:
+                errors.append(exc)
+        def produce(queue_id):
+            for i in range(500):
+                realm.add("%s.%s" % (queue_id, i), queue_id, i, tags=['t'])
+        def consume():
+            for i in range(200):
+                pulled.extend(realm.pull(5))
+        def read():
+            for i in range(200):
+                realm.status
+                realm.get_tag_status('t')
+        threads = [threading.Thread(target=run, args=a) for a in
+                   [(produce, 'q0'), (produce, 'q1'), (produce, 'q2'),
+                    (consume,), (consume,), (read,)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(pulled), len(set(pulled)))
+        self.assertEqual(realm.status['total_jobs'], 1501)
+        self.assertEqual(len(pulled) + len(realm.pull(1501)), 1501)
+        status = realm.get_tag_status('t')
+        self.assertEqual((status['queued'], status['leased']), (1501, 1501))
+
+    def test_pull_wait(self):
+        """a waiting pull returns once a job is added or a lease expires"""
+        realm = self.realms.get('test')
+        self.assertEqual(realm.pull(5, wait=0.05), {})
+        timer = threading.Timer(0.1, realm.add, ("job1", 'q0', 'data'))
+        timer.start()
+        t = time.time()
+        self.assertEqual(realm.pull(5, wait=5), {"job1": ('q0', 'data')})
+        self.assertLess(time.time() - t, 4)
+        timer.join()
+
+        realm.set_queue_lease_time('q0', 0.2)
+        t = time.time()
+        self.assertEqual(self.realms.pull(5, wait=5),
+                         {"job1": ('test', 'q0', 'data')})
+        self.assertLess(time.time() - t, 4)
+
+    def test_pull_mixed_queue_ids(self):
+        """numeric queue ids are pulled before any other id"""
+        realm = self.realms.get('test')
+        realm.add("job1", 'q0', None)
+        realm.add("job2", 2, None)
+        realm.add("job3", 10, None)
+        self.assertEqual(sorted(realm.pull(2)), ["job2", "job3"])
+        self.assertEqual(list(realm.pull(2, max_queue=10)), [])
+        self.assertEqual(list(self.realms.pull(2, realms=['test'])), ["job1"])
+
+    def test_moved_realm_skipped(self):
+        """a realm on its way to another node is left out of the pulls and
+        status across realms"""
+        self.realms.delete('test_moved')
+        moving = self.realms.get('test_moved')
+        moving.add("job0", 'q0', None)
+        self.realms.get('test').add("job1", 'q0', None)
+        moving.moved_to = 'http://elsewhere'
+        try:
+            self.assertNotIn('test_moved', self.realms.get_status())
+            self.assertIn('test', self.realms.get_status())
+            self.assertEqual(list(self.realms.pull(5, wait=0.05)), ["job1"])
+        finally:
+            moving.moved_to = None
+            self.realms.delete('test_moved')
+
+    def test_add_many(self):
+        """jobs are added in one operation, failures are returned"""
+        realm = self.realms.get('test')
+        realm.add("job1", 'q0', 'data')
+        errors = realm.add_many([("job2", 'q0', None, ['t']),
+                                 ("job1", 'q1', 'other', []),
+                                 (["job3"], 'q0', None, []),
+                                 ("job4", 'q1', None, ['t'])])
+        self.assertEqual([(i, type(exc)) for i, exc in errors],
+                         [(1, ValueError), (2, TypeError)])
+        self.assertEqual(realm.status['total_jobs'], 3)
+        self.assertEqual(realm.status['queues'], {'q0': 2, 'q1': 1})
+        self.assertEqual(realm.get_tag_status('t')['count'], 2)
+
+    def test_batch_operations(self):
+        """remove_many and move_many apply in one go and are journaled"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        saves = []
+        save_config = realm._save_config
+        def counted_save_config():
+            if not realm._config_held:
+                saves.append(1)
+            save_config()
+        realm._save_config = counted_save_config
+        realm.add_many([("job%s" % i, "q%s" % (i % 3), i, ['t'])
+                        for i in range(9)])
+        self.assertEqual(len(saves), 1)
+        realm.pull(1, max_queue="q0")
+        errors = realm.move_many([("job0", "q0", "q3"),
+                                  ("job3", "q0", "q4"),
+                                  ("job4", "q1", "q5"),
+                                  ("nojob", "q1", "q5")])
+        self.assertEqual([(i, type(exc)) for i, exc in errors],
+                         [(0, ValueError), (3, ValueError)])
+        self.assertEqual(len(saves), 2)
+        self.assertEqual(realm.remove_many(["job1", "job2", "nojob"]),
+                         ["nojob"])
+        status = realm.status
+        self.assertEqual(status['total_jobs'], 7)
+        self.assertEqual(status['queues']['q4'], 1)
+
+        # restart the realm from its journal
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(realm.status, status)
+        self.assertEqual(realm.get_job("job4")['queues'][0][0], "q5")
+
+    def test_renew_release_many(self):
+        """renew_many and release_many apply in one go and are journaled"""
+        realm = self.realms.get('test')
+        realm.set_durability('per-op')
+        realm.set_default_lease_time(0.5)
+        realm.add_many([("job%s" % i, "q0", i, []) for i in range(4)])
+        self.assertEqual(len(realm.pull(3)), 3)
+        errors = realm.renew_many([("job0", 5), ("job1", 5), ("job3", 5),
+                                   ("job1", -1)])
+        self.assertEqual([(i, type(exc)) for i, exc in errors],
+                         [(2, ValueError), (3, TypeError)])
+        errors = realm.release_many(["job1", "job3"])
+        self.assertEqual([(i, type(exc)) for i, exc in errors],
+                         [(1, ValueError)])
+        time.sleep(0.6)
+
+        # restart the realm from its journal, job0 is still leased
+        realm.close()
+        self.realms._realms.pop('test')
+        realm = self.realms.get('test')
+        self.assertEqual(sorted(realm.pull(4)), ["job1", "job2", "job3"])
+
+    def test_stats(self):
+        """queues count the jobs through them and mark when they arrived"""
+        realm = self.realms.get('test')
+        realm.set_default_lease_time(0.5)
+        realm.add_many([("job%s" % i, "q0", 'x' * i, []) for i in range(200)])
+        self.assertEqual(realm.stats.data_bytes, sum(range(200)))
+        queue = realm.queues["q0"]
+        self.assertEqual(len(realm.pull(3)), 3)
+        realm.remove_job("job0")
+        realm.remove_job("job5")
+        time.sleep(0.6)
+        self.assertEqual(len(realm.pull(4)), 4)
+        self.assertEqual((queue.stats.enqueued, queue.stats.dequeued,
+                          queue.stats.acked, queue.stats.expired),
+                         (200, 7, 1, 2))
+        self.assertEqual(queue.stats.scanned.counts[
+                         queue.stats.scanned.bounds.index(5)], 1)
+        self.assertEqual(realm.stats.data_bytes, sum(range(200)) - 5)
+        self.assertTrue(realm.stats.lock_hold.buckets()[-1][1] >= 4)
+
+        # the oldest job waiting keeps its age as the queue is renumbered
+        age = queue.oldest_age(time.time())
+        self.assertTrue(0.6 < age < 2)
+        queue.mark_seqs.append(len(queue.order))
+        queue.mark_times.append(time.time())
+        realm.add("late", "q0")
+        realm.remove_many(["job%s" % i for i in range(6, 150)])
+        self.assertTrue(len(queue.order) < 100)
+        self.assertEqual(queue.mark_seqs, [0, len(queue.order) - 1])
+        self.assertTrue(0.6 < queue.oldest_age(time.time()) < 2)
+
+    def test_timing(self):
+        """the percentiles of a timing fall within the times seen"""
+        timing = stats.Timing()
+        self.assertEqual(timing.summary()['p50'], None)
+        for i in range(1, 101):
+            timing.observe(i / 1000.0)
+        summary = timing.summary()
+        self.assertEqual((summary['call_count'], summary['min_time'],
+                          summary['max_time']), (100, 0.001, 0.1))
+        self.assertTrue(0.02 <= summary['p50'] <= 0.05)
+        self.assertTrue(0.05 <= summary['p90'] <= summary['p99'] <= 0.1)
+        realm = self.realms.get('test')
+        realm.add("job", "q0")
+        realm.pull(1)
+        self.assertEqual(realm.stats.ops['add'].count, 1)
+        self.assertEqual(realm.stats.ops['pull'].count, 1)
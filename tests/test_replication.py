@@ -0,0 +1,182 @@
+import unittest
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+from restq import config
+from restq import realms
+from restq import replication
+from restq import router
+from restq import webapp
+from tests.test_router import free_port
+
+
+def serve(values, root, port):
+    """run a node on port with its realms under root"""
+    for interface, kwargs in values.items():
+        config.values[interface].update(kwargs)
+    # forget the realms of the parent process, their files are its own
+    realms.set_partition(0, 1)
+    realms.set_realms_config_root(root)
+    config.webapp['host'] = '127.0.0.1'
+    config.webapp['port'] = port
+    webapp.run()
+
+
+def start(primary=''):
+    port = free_port()
+    root = tempfile.mkdtemp()
+    values = dict((k, dict(v)) for k, v in config.values.items())
+    values['replication'].update(primary=primary, wait=0.2,
+                                 retry_interval=0.1)
+    proc = multiprocessing.Process(target=serve, args=(values, root, port))
+    proc.daemon = True
+    proc.start()
+    router._wait_for_port(port, proc)
+    return proc, root, 'http://127.0.0.1:%d' % port
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def test_since(self):
+        log = replication.ChangeLog(backlog=3)
+        self.assertEqual(log.since(0, 10), ([], None))
+        for i in range(5):
+            log.append(('add', i))
+        self.assertEqual(log.seq, 5)
+        # changes 1 and 2 have gone
+        self.assertEqual(log.since(1, 10), None)
+        self.assertEqual(log.since(6, 10), None)
+        records, pending = log.since(2, 2)
+        self.assertEqual([(seq, record) for seq, _, record in records],
+                         [(3, ('add', 2)), (4, ('add', 3))])
+        self.assertEqual(pending, log.changes[-1][1])
+        self.assertEqual(log.since(5, 10), ([], None))
+
+
+class TestReplication(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved = dict(config.webapp)
+        config.webapp['quiet'] = True
+        if sys.version_info >= (3, 5):
+            # wsgiref handles one request at a time, so the replicas' long
+            # polls would hold up the rest
+            config.webapp['server'] = 'asyncio'
+        cls.procs = []
+        cls.roots = []
+
+    @classmethod
+    def tearDownClass(cls):
+        for proc in cls.procs:
+            proc.terminate()
+            proc.join()
+        for root in cls.roots:
+            shutil.rmtree(root)
+        config.webapp.update(cls.saved)
+
+    def start(self, primary=''):
+        proc, root, uri = start(primary)
+        self.procs.append(proc)
+        self.roots.append(root)
+        return uri
+
+    def put(self, uri, realm_id, job_id, queue_id, tags=()):
+        requests.put('%s/%s/job/%s' % (uri, realm_id, job_id),
+                     json={'queue_id': queue_id, 'data': job_id,
+                           'tags': list(tags)}).raise_for_status()
+
+    def caught_up(self, primary, replica, realm_ids):
+        """wait for the replica to serve what the primary does"""
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            status = requests.get(replica + '/replication').json()
+            if all(realm_id in status['realms'] and
+                   status['realms'][realm_id]['behind'] == 0 and
+                   requests.get('%s/%s/status' % (replica, realm_id)).json()
+                   == requests.get('%s/%s/status' % (primary, realm_id)).json()
+                   for realm_id in realm_ids):
+                return status
+            time.sleep(0.05)
+        self.fail("replica did not catch up")
+
+    def test_replication(self):
+        primary = self.start()
+        for i in range(20):
+            self.put(primary, 'rep0', 'job%d' % i, i % 3, ['t%d' % (i % 2)])
+        requests.post(primary + '/rep0/config',
+                      json={'queue_lease_time': [1, 5]}).raise_for_status()
+        pulled = requests.get(primary + '/rep0/job?count=4').json()
+
+        replica = self.start(primary)
+        self.caught_up(primary, replica, ['rep0'])
+
+        # the changes made since are shipped
+        for job_id in pulled:
+            requests.delete('%s/rep0/job/%s' % (primary, job_id))
+        requests.get(primary + '/rep0/job/job10/from_q/1/to_q/4')
+        requests.get(primary + '/rep0/queues/2/clear')
+        pulled = requests.get(primary + '/rep0/job?count=2').json()
+        requests.post('%s/rep0/job/%s/renew' % (primary, sorted(pulled)[0]),
+                      json={'extra': 100}).raise_for_status()
+        self.put(primary, 'rep1', 'other', 0, ['x'])
+        status = self.caught_up(primary, replica, ['rep0', 'rep1'])
+        self.assertEqual(status['primary'], primary)
+        for job_id in ['job10', sorted(pulled)[0], sorted(pulled)[1]]:
+            copy = requests.get('%s/rep0/job/%s' % (replica, job_id)).json()
+            job = requests.get('%s/rep0/job/%s' % (primary, job_id)).json()
+            # the leases are the same, the time since checkout moves on
+            queues = zip(copy.pop('queues'), job.pop('queues'))
+            self.assertEqual(copy, job)
+            for (queue_id, t), (other_id, other_t) in queues:
+                self.assertEqual(queue_id, other_id)
+                self.assertAlmostEqual(t, other_t, delta=1)
+        self.assertEqual(
+            sorted(requests.get(replica + '/rep0/tag/t0').json()),
+            sorted(requests.get(primary + '/rep0/tag/t0').json()))
+
+        # a replica is read only
+        r = requests.put(replica + '/rep0/job/new', json={'queue_id': 0})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(r.json()['exception'], 'ReadOnlyRealm')
+        r = requests.get(replica + '/rep0/job?count=1')
+        self.assertEqual(r.json()['exception'], 'ReadOnlyRealm')
+
+        text = requests.get(replica + '/metrics').text
+        self.assertTrue('restq_replication_lag_seconds{realm="rep0"}' in text)
+
+        # promoted, the replica takes the changes itself
+        requests.post(replica + '/promote').raise_for_status()
+        self.assertEqual(requests.get(replica + '/replication').json(),
+                         {'primary': None, 'realms': {}})
+        self.put(replica, 'rep1', 'promoted', 0)
+        jobs = requests.get(replica + '/rep1/job?count=5').json()
+        self.assertEqual(sorted(jobs), ['other', 'promoted'])
+        self.put(primary, 'rep1', 'ignored', 0)
+        time.sleep(0.5)
+        self.assertEqual(
+            requests.get(replica + '/rep1/status').json()['total_jobs'], 2)
+
+    def test_lag(self):
+        # the lag grows from the last sync while the primary is down
+        primary = self.start()
+        self.put(primary, 'lag', 'job', 0)
+        replica = self.start(primary)
+        status = self.caught_up(primary, replica, ['lag'])
+        self.assertEqual(status['realms']['lag']['lag'], 0.0)
+        proc = self.procs[-2]
+        proc.terminate()
+        proc.join()
+        time.sleep(0.5)
+        lag = requests.get(replica + '/replication').json()
+        lag = lag['realms']['lag']['lag']
+        self.assertTrue(lag >= 0.3)
+        time.sleep(0.5)
+        later = requests.get(replica + '/replication').json()
+        self.assertTrue(later['realms']['lag']['lag'] >= lag + 0.3)
+        self.assertTrue(later['realms']['lag']['error'])
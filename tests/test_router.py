@@ -0,0 +1,156 @@
+import unittest
+import json
+import socket
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import webtest
+
+from restq import config
+from restq import realms
+from restq import router
+
+
+REALMS = ['router%d' % i for i in range(6)]
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestRouter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved = dict(config.webapp), dict(config.realms)
+        config.webapp['quiet'] = True
+        config.realms['realms_config_root'] = tempfile.mkdtemp()
+        if sys.version_info >= (3, 5):
+            # the workers' wsgiref server handles one request at a time, so
+            # test_pull_wait's long poll would hold up the add that ends it
+            config.webapp['server'] = 'asyncio'
+        port = free_port()
+        cls.procs = router.start_workers(2, port)
+        cls.workers = ['http://127.0.0.1:%d' % (port + 1 + i)
+                       for i in range(2)]
+        router.set_workers(cls.workers)
+        cls.app = webtest.TestApp(router.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        for proc in cls.procs:
+            proc.terminate()
+            proc.join()
+        shutil.rmtree(config.realms['realms_config_root'])
+        config.webapp.update(cls.saved[0])
+        config.realms.update(cls.saved[1])
+
+    def setUp(self):
+        for realm_id in REALMS:
+            self.app.delete('/%s/' % realm_id)
+
+    def add(self, realm_id, job_id, queue_id):
+        self.app.put('/%s/job/%s' % (realm_id, job_id),
+                     json.dumps({'queue_id': queue_id}))
+
+    def test_realms_are_partitioned(self):
+        owners = set(realms.owner(realm_id, 2) for realm_id in REALMS)
+        self.assertEqual(owners, set([0, 1]))
+        for i, realm_id in enumerate(REALMS):
+            self.add(realm_id, 'job%d' % i, i)
+        self.assertEqual(sorted(self.app.get('/').json), REALMS)
+        for worker, uri in enumerate(self.workers):
+            served = requests.get(uri + '/').json()
+            self.assertEqual(sorted(served),
+                             [realm_id for realm_id in REALMS
+                              if realms.owner(realm_id, 2) == worker])
+        status = self.app.get('/router3/status').json
+        self.assertEqual(status['total_jobs'], 1)
+        r = self.app.get('/router3/job/nojob', expect_errors=True)
+        self.assertEqual(r.json['exception'], 'KeyError')
+
+    def test_bulk_jobs(self):
+        jobs = [dict(realm_id=REALMS[i % 6], job_id='job%d' % i, queue_id=i)
+                for i in range(12)]
+        jobs[7]['job_id'] = ['unhashable']
+        result = self.app.post('/jobs', json.dumps({'jobs': jobs})).json
+        self.assertEqual(result['added'], 11)
+        self.assertEqual([e['index'] for e in result['errors']], [7])
+
+        lines = [json.dumps(dict(realm_id=REALMS[i % 6], job_id='line%d' % i,
+                                 queue_id=i)) for i in range(6)]
+        lines.insert(3, '{not json')
+        result = self.app.post('/jobs', '\n'.join(lines).encode('utf-8'),
+                               {'Content-Type': 'application/x-ndjson'}).json
+        self.assertEqual(result['added'], 6)
+        self.assertEqual([e['line'] for e in result['errors']], [4])
+
+        self.app.delete('/jobs', json.dumps(
+            {'jobs': [[job['realm_id'], job['job_id']] for job in jobs
+                      if job is not jobs[7]]}))
+        total = sum(self.app.get('/%s/status' % realm_id).json['total_jobs']
+                    for realm_id in REALMS)
+        self.assertEqual(total, 6)
+
+    def test_pull(self):
+        for i, realm_id in enumerate(REALMS):
+            self.add(realm_id, 'job%d' % i, i % 3)
+        jobs = self.app.get('/job?count=3').json
+        self.assertEqual(sorted(jobs), ['job0', 'job1', 'job3'])
+        self.assertEqual(jobs['job3'], ['router3', 0, None])
+        # the jobs pulled beyond the count were released, uncounted
+        for i in (2, 4, 5):
+            job = self.app.get('/%s/job/job%d' % (REALMS[i], i)).json
+            self.assertEqual(job['deliveries'], [[i % 3, 0]])
+        jobs = self.app.get('/job?count=10').json
+        self.assertEqual(sorted(jobs), ['job2', 'job4', 'job5'])
+        self.add('router4', 'job6', 0)
+        jobs = self.app.get('/job?count=10&realms=router1,router4').json
+        self.assertEqual(list(jobs), ['job6'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), "needs the asyncio server")
+    def test_pull_wait(self):
+        add = threading.Timer(0.3, self.add, ('router5', 'late', 0))
+        add.start()
+        t = time.time()
+        jobs = self.app.get('/job?count=1&wait=5').json
+        add.join()
+        self.assertEqual(list(jobs), ['late'])
+        self.assertTrue(time.time() - t < 3)
+
+    def test_large_bodies(self):
+        # larger than router.BUFSIZE, streamed through both ways
+        data = 'x' * (3 * router.BUFSIZE)
+        self.app.put('/router2/job/big',
+                     json.dumps({'queue_id': 0, 'data': data}))
+        job = self.app.get('/router2/job/big').json
+        self.assertEqual(job['data'], data)
+        r = self.app.post('/router2/jobs',
+                          '\n'.join(json.dumps({'job_id': 'big%d' % i,
+                                                 'queue_id': 0,
+                                                 'data': data})
+                                     for i in range(3)).encode('utf-8'),
+                          {'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(r.json['added'], 3)
+
+    def test_metrics(self):
+        text = self.app.get('/metrics').text
+        self.assertTrue('worker="0"' in text)
+        self.assertTrue('worker="1"' in text)
+
+    def test_profile(self):
+        status = self.app.post('/profile?interval=0.01').json
+        self.assertEqual(sorted(status), ['0', '1'])
+        self.assertTrue(status['1']['running'])
+        time.sleep(0.1)
+        lines = self.app.delete('/profile').text.splitlines()
+        self.assertEqual(set(line.split(';', 1)[0] for line in lines),
+                         set(['worker-0', 'worker-1']))